@@ -0,0 +1,164 @@
+import os
+import time
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class PersistentLRUCache:
+    """
+    SQLiteによる永続キャッシュと、メモリ上のLRUキャッシュを組み合わせたキー・バリューストア。
+    ディスク上の件数はmax_entriesを上限とし、最も長く参照されていないエントリから削除する。
+    複数スレッドから安全に利用でき、複数プロセスでの共有にはSQLiteのWALモードを使う。
+    ttl（秒）を指定した場合、作成から ttl 秒を過ぎたエントリは存在しないものとして扱う。
+    参照時刻（メモリ上のヒットを含む）はメモリに溜め、書き込み時・access_batch件溜まった時・close時に
+    まとめてディスクへ反映する（参照のたびにディスクへ書き込まない）。
+    """
+    def __init__(self, path, max_entries=100000, memory_entries=2048, ttl=None, access_batch=256):
+        self.path = path
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.ttl = ttl
+        self.access_batch = access_batch
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes_since_evict = 0
+        # ディスクへ未反映の参照時刻 {key: 時刻}
+        self._pending_accesses = {}
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self._conn.commit()
+
+    def _is_expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _remember(self, key, value, created):
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _record_access(self, key):
+        self._pending_accesses[key] = time.time()
+        if len(self._pending_accesses) >= self.access_batch:
+            self._flush_accesses()
+            self._conn.commit()
+
+    def _flush_accesses(self):
+        """
+        溜めた参照時刻をディスクに書き込む（コミットは呼び出し側で行う）。
+        """
+        if not self._pending_accesses:
+            return
+        self._conn.executemany(
+            "UPDATE cache SET accessed = ? WHERE key = ?",
+            [(accessed, key) for key, accessed in self._pending_accesses.items()]
+        )
+        self._pending_accesses.clear()
+
+    def get(self, key, default=None):
+        """
+        キーに対応する値を返す。メモリ、ディスクの順に参照する。
+        """
+        with self._lock:
+            if key in self._memory:
+                value, created = self._memory[key]
+                if not self._is_expired(created):
+                    self._memory.move_to_end(key)
+                    self._record_access(key)
+                    return value
+                del self._memory[key]
+            row = self._conn.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or self._is_expired(row[1]):
+                return default
+            value = pickle.loads(row[0])
+            self._remember(key, value, row[1])
+            self._record_access(key)
+            return value
+
+    def get_many(self, keys):
+        """
+        複数キーをまとめて参照し、見つかったものだけを {key: value} で返す。
+        """
+        found = {}
+        for key in keys:
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                found[key] = value
+        return found
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        """
+        複数のキー・バリューをまとめて書き込む（1トランザクション）。
+        """
+        if not items:
+            return
+        now = time.time()
+        rows = [(key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), now, now)
+                for key, value in items.items()]
+        with self._lock:
+            for key in items:
+                self._pending_accesses.pop(key, None)
+            # 溜めた参照時刻も同じトランザクションで反映する
+            self._flush_accesses()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+            for key, value in items.items():
+                self._remember(key, value, now)
+            self._writes_since_evict += len(rows)
+            # 件数確認のコストを抑えるため、一定件数の書き込みごとに上限を確認する
+            if self._writes_since_evict >= max(1, self.max_entries // 100):
+                self._evict()
+                self._writes_since_evict = 0
+
+    def _evict(self):
+        if self.ttl is not None:
+            self._conn.execute("DELETE FROM cache WHERE created < ?", (time.time() - self.ttl,))
+            self._conn.commit()
+        count = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY accessed ASC LIMIT ?)",
+                (excess,)
+            )
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._pending_accesses.clear()
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self._pending_accesses:
+                self._flush_accesses()
+                self._conn.commit()
+            self._conn.close()
+
+
+_MISSING = object()
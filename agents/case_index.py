@@ -0,0 +1,217 @@
+import os
+import json
+import threading
+import numpy as np
+from agents.hpo_ontology import load_hpo_ontology
+from agents.vector_index import ExactIndex, IVFIndex
+
+DEFAULT_CASE_INDEX_DIR = os.path.join(os.path.dirname(__file__), '../data/case_index')
+CASE_INDEX_FORMAT_VERSION = 1
+
+_index_cache = {}
+_index_lock = threading.Lock()
+
+
+class LocalCaseIndex:
+    """
+    Phenopacketなどの症例コーパスから構築するローカルの類似症例インデックス（TogoSeekの代替）。
+    各症例のHPOセットを祖先へ伝播させ、sqrt(IC)で重み付けした二値ベクトルを
+    固定の乱数射影でdim次元に圧縮・L2正規化して、メモリマップされた行列に保存する。
+    乱数射影はHPO IDから決まる種で生成するため、オントロジーの版が変わっても同じ向きを保つ。
+
+    ディレクトリ構成:
+        meta.json      形式バージョン・次元数・件数とcases.jsonlのバイト数（コミット済みの範囲を表す）
+        vectors.f32    float32の生ベクトル（件数 × 次元）
+        cases.jsonl    症例ごとのメタデータ（id, hpo_list, diagnosis）
+        ivf.*.npy      近似検索用のIVFインデックス（任意）
+    """
+    def __init__(self, directory=DEFAULT_CASE_INDEX_DIR, ontology=None, dim=256, seed=0, nprobe=8):
+        self.directory = directory
+        self.ontology = ontology or load_hpo_ontology()
+        self.nprobe = nprobe
+        self._lock = threading.Lock()
+        self._term_vectors = {}
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.cases_path = os.path.join(directory, "cases.jsonl")
+        self.ivf_prefix = os.path.join(directory, "ivf")
+
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("format_version") != CASE_INDEX_FORMAT_VERSION:
+                raise ValueError(f"未対応の症例インデックス形式です: {meta.get('format_version')}")
+        else:
+            meta = {"format_version": CASE_INDEX_FORMAT_VERSION, "dim": dim, "seed": seed,
+                    "count": 0, "cases_bytes": 0}
+        self.dim = meta["dim"]
+        self.seed = meta["seed"]
+        self.count = meta["count"]
+        self.cases_bytes = meta["cases_bytes"]
+        self.cases = self._load_cases()
+        self.vectors = self._open_vectors()
+        self.ivf = IVFIndex.load(self.ivf_prefix, nprobe=nprobe) \
+            if os.path.exists(self.ivf_prefix + ".centroids.npy") else None
+        if self.ivf is not None and len(self.ivf.assignments) != self.count:
+            # 追記の途中で中断された場合は割り当てを作り直す
+            self.ivf = IVFIndex(self.ivf.centroids, [], nprobe=nprobe)
+            self.ivf.add(self.vectors)
+
+    def _load_cases(self):
+        cases = []
+        if os.path.exists(self.cases_path):
+            with open(self.cases_path, "rb") as f:
+                content = f.read(self.cases_bytes)
+            cases = [json.loads(line) for line in content.decode("utf-8").splitlines() if line]
+        return cases
+
+    def _open_vectors(self):
+        if self.count == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(self.count, self.dim))
+
+    def __len__(self):
+        return self.count
+
+    def _term_vector(self, term_index):
+        vector = self._term_vectors.get(term_index)
+        if vector is None:
+            term_number = int(self.ontology.term_ids[term_index].split(":")[1])
+            rng = np.random.default_rng([self.seed, term_number])
+            vector = rng.standard_normal(self.dim).astype(np.float32)
+            self._term_vectors[term_index] = vector
+        return vector
+
+    def encode(self, hpo_ids):
+        """
+        HPOセットを検索用のL2正規化済みベクトルに変換する。
+        """
+        term_indices = self.ontology.indices(hpo_ids)
+        vector = np.zeros(self.dim, dtype=np.float32)
+        if len(term_indices) == 0:
+            return vector
+        propagated = np.unique(np.concatenate([self.ontology.ancestors_of(i) for i in term_indices]))
+        weights = np.sqrt(self.ontology.information_content[propagated])
+        for term_index, weight in zip(propagated, weights):
+            if weight > 0:
+                vector += weight * self._term_vector(int(term_index))
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _write_meta(self):
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "format_version": CASE_INDEX_FORMAT_VERSION,
+                "dim": self.dim,
+                "seed": self.seed,
+                "count": self.count,
+                "cases_bytes": self.cases_bytes
+            }, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def _truncate_uncommitted(self):
+        # meta.jsonの件数より後ろにある中断された書き込みを取り除く
+        if os.path.exists(self.vectors_path):
+            with open(self.vectors_path, "rb+") as f:
+                f.truncate(self.count * self.dim * 4)
+        if os.path.exists(self.cases_path):
+            with open(self.cases_path, "rb+") as f:
+                f.truncate(self.cases_bytes)
+
+    def append(self, records):
+        """
+        症例を追記する。records は {"id", "hpo_list", "diagnosis"} の辞書のイテラブル。
+        ベクトルとメタデータを書き込んだ後にmeta.jsonの件数を更新してコミットする。
+        Returns:
+            int: 追記した件数
+        """
+        records = [record for record in records if record.get("hpo_list")]
+        if not records:
+            return 0
+        new_vectors = np.stack([self.encode(record["hpo_list"]) for record in records]).astype(np.float32)
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            self._truncate_uncommitted()
+            with open(self.vectors_path, "ab") as f:
+                f.write(new_vectors.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            new_cases = [
+                {
+                    "id": record.get("id"),
+                    "hpo_list": list(record["hpo_list"]),
+                    "diagnosis": record.get("diagnosis", record.get("expected", []))
+                }
+                for record in records
+            ]
+            payload = "".join(json.dumps(case, ensure_ascii=False) + "\n" for case in new_cases).encode("utf-8")
+            with open(self.cases_path, "ab") as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            self.count += len(records)
+            self.cases_bytes += len(payload)
+            self._write_meta()
+            self.cases.extend(new_cases)
+            self.vectors = self._open_vectors()
+            if self.ivf is not None:
+                self.ivf.add(new_vectors)
+                self.ivf.save(self.ivf_prefix)
+        return len(records)
+
+    def train_ivf(self, nlist=None, n_iter=20):
+        """
+        現在の全症例からIVFインデックスを学習して保存する。
+        """
+        with self._lock:
+            self.ivf = IVFIndex.train(self.vectors, nlist=nlist, nprobe=self.nprobe, n_iter=n_iter, seed=self.seed)
+            self.ivf.save(self.ivf_prefix)
+
+    def search(self, hpo_ids, top_k=5, min_cosine_similarity=0.3, max_distance=1.3,
+               approximate=None, nprobe=None):
+        """
+        類似症例を検索する。TogoSeekと同様に、コサイン類似度がmin_cosine_similarity以上かつ
+        ユークリッド距離（正規化ベクトル間）がmax_distance以下の症例のみ返す。
+        Args:
+            approximate (bool): Trueの場合はIVFによる近似検索（Noneの場合はIVFがあれば使う）
+        Returns:
+            list: [{id, hpo_list, diagnosis, similarity, distance}, ...]
+        """
+        if self.count == 0:
+            return []
+        query = self.encode(hpo_ids)
+        if not query.any():
+            return []
+        vectors = self.vectors
+        use_ivf = self.ivf is not None if approximate is None else approximate and self.ivf is not None
+        if use_ivf:
+            indices, scores = self.ivf.search(vectors, query, top_k, nprobe=nprobe)
+        else:
+            indices, scores = ExactIndex().search(vectors, query, top_k)
+        results = []
+        for index, similarity in zip(indices[0], scores[0]):
+            if index < 0:
+                continue
+            similarity = float(similarity)
+            distance = float(np.sqrt(max(0.0, 2.0 - 2.0 * similarity)))
+            if similarity < min_cosine_similarity or distance > max_distance:
+                continue
+            results.append(dict(self.cases[index], similarity=similarity, distance=distance))
+        return results
+
+
+def load_case_index(directory=DEFAULT_CASE_INDEX_DIR, ontology=None):
+    """
+    LocalCaseIndexをプロセス内で一度だけ開いて共有する（スレッドセーフ）。
+    """
+    key = os.path.abspath(directory)
+    index = _index_cache.get(key)
+    if index is not None:
+        return index
+    with _index_lock:
+        index = _index_cache.get(key)
+        if index is None:
+            index = LocalCaseIndex(directory, ontology=ontology)
+            _index_cache[key] = index
+    return index
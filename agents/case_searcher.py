@@ -1,14 +1,31 @@
-import requests
-from time import sleep
+import re
+from agents.http_client import get_http_client
+from agents import tracing
 
 class CaseSearcher:
     """
     類似症例をTogoSeek API (collection: 'case') で検索するエージェント。
+    local_indexを指定した場合は、ローカルの症例インデックス（LocalCaseIndex）を同じ閾値で検索する。
     """
-    def __init__(self, top_k=5):
+    def __init__(self, top_k=5, http_client=None, local_index=None,
+                 min_cosine_similarity=0.3, max_distance=1.3, timeout=30):
         self.api_url = "https://togoseek.dbcls.jp/search"
         self.headers = {"Content-Type": "application/json"}
         self.top_k = top_k
+        self.min_cosine_similarity = min_cosine_similarity
+        self.max_distance = max_distance
+        self.local_index = local_index
+        self.timeout = timeout
+        self.http_client = http_client if local_index is not None else http_client or get_http_client()
+
+    @staticmethod
+    def canonicalize_query(hpo_query):
+        """
+        "HP:xxxxxxx:label" をカンマで連結したクエリを、重複除去・ソートした形に正規化する。
+        ラベル中のカンマで分割しないよう、"HP:" が続くカンマでのみ分割する。
+        """
+        terms = {term.strip() for term in re.split(r",\s*(?=HP:)", hpo_query) if term.strip()}
+        return ",".join(sorted(terms))
 
     def search(self, hpo_query):
         """
@@ -18,20 +35,43 @@ class CaseSearcher:
         Returns:
             list: 類似症例リスト
         """
+        backend = "local" if self.local_index is not None else "togoseek"
+        with tracing.span("case_search.search", backend=backend) as span:
+            results = self._search(hpo_query, span)
+            span.set(results=len(results))
+            return results
+
+    def _search(self, hpo_query, span):
+        if self.local_index is not None:
+            return self.local_index.search(
+                re.findall(r"HP:\d{7}", hpo_query),
+                top_k=self.top_k,
+                min_cosine_similarity=self.min_cosine_similarity,
+                max_distance=self.max_distance
+            )
+        import requests
         payload = {
             "query": hpo_query,
             "collection": "case",
             "metric": "euclid",
             "topK": self.top_k,
-            "minCosineSimilarity": 0.3,
-            "maxDistance": 1.3
+            "minCosineSimilarity": self.min_cosine_similarity,
+            "maxDistance": self.max_distance
         }
+        # APIには元のクエリを送り、正規化したクエリは順序違い・重複のリクエストで共有するキャッシュのキーにのみ使う
+        cache_key = self.http_client.make_cache_key(
+            "togoseek", dict(payload, query=self.canonicalize_query(hpo_query))
+        )
         try:
-            response = requests.post(self.api_url, headers=self.headers, json=payload, timeout=30)
-            response.raise_for_status()
-            result = response.json()
-            sleep(0.1)
+            result = self.http_client.post_json(
+                self.api_url,
+                payload,
+                headers=self.headers,
+                timeout=self.timeout,
+                cache_key=cache_key
+            )
             return result.get("results", [])
         except requests.exceptions.RequestException as e:
+            span.record_error(e)
             print(f"[CaseSearcher] APIリクエスト失敗: {e}")
             return []
@@ -0,0 +1,228 @@
+import re
+import json
+from agents.embedding_cache import normalize_text
+from agents.llm_gateway import estimate_tokens
+from agents import tracing
+
+DEFAULT_REPORT_TOKEN_BUDGET = 6000
+DEFAULT_JUDGE_CASES_TOKEN_BUDGET = 1200
+DEFAULT_JUDGE_KNOWLEDGE_TOKEN_BUDGET = 1500
+# 1件の根拠（Wikipediaの1ページ、1症例など）に使える最大トークン数
+DEFAULT_MAX_ITEM_TOKENS = 400
+# レポート用プロンプトでのセクションごとの予算の配分比（使い切らなかった分は他のセクションに回す）
+DEFAULT_SECTION_WEIGHTS = {"knowledge": 4, "cases": 3, "api": 2, "llm": 1}
+EMPTY_SECTION = "(none)"
+# WikipediaAPIWrapper.runの出力（"Page: ...\nSummary: ..." を空行で連結したもの）のページ区切り
+WIKIPEDIA_PAGE = re.compile(r"\n\n(?=Page: )")
+
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    estimate_tokensと同じ概算（約4文字で1トークン）でmax_tokens以内に切り詰める。
+    """
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind(" ", 0, max_chars)
+    if cut < max_chars * 0.8:
+        # 空白のない文（日本語など）は文字数で切る
+        cut = max_chars
+    return text[:cut].rstrip() + "…"
+
+
+def _compact_value(value):
+    if isinstance(value, float):
+        return round(value, 3)
+    if isinstance(value, dict):
+        compacted = {key: _compact_value(item) for key, item in value.items()}
+        return {key: item for key, item in compacted.items() if item not in (None, "", [], {})}
+    if isinstance(value, (list, tuple)):
+        return [_compact_value(item) for item in value if item not in (None, "", [], {})]
+    return value
+
+
+def compact_json(value):
+    """
+    空のフィールドを除き、小数を丸めた区切り文字なしのJSONにする（Pythonのreprより短い）。
+    """
+    return json.dumps(_compact_value(value), ensure_ascii=False, separators=(",", ":"))
+
+
+def allocate_budget(total, demands, weights):
+    """
+    予算totalを重みに応じて各セクションに配分する。必要量（demands）が配分に満たないセクションの
+    余りは、残りのセクションに重みに応じて配り直す。
+    Returns:
+        dict: {セクション名: トークン数}
+    """
+    allocation = {name: 0 for name in demands}
+    active = {name for name, demand in demands.items() if demand > 0}
+    budget = total
+    while active and budget > 0:
+        weight_sum = sum(weights.get(name, 1) for name in active)
+        shares = {name: budget * weights.get(name, 1) / weight_sum for name in active}
+        satisfied = {name for name in active if demands[name] <= shares[name]}
+        if not satisfied:
+            for name in active:
+                allocation[name] = int(shares[name])
+            break
+        for name in satisfied:
+            allocation[name] = demands[name]
+            budget -= demands[name]
+        active -= satisfied
+    return allocation
+
+
+def fit_lines(lines, budget):
+    """
+    関連度順に並んだ行を予算内に収まるだけ採用する。最初の1行は予算に合わせて切り詰めてでも残す。
+    Returns:
+        tuple: (本文, 省略した行数)
+    """
+    kept = []
+    used = 0
+    for line in lines:
+        tokens = estimate_tokens(line)
+        if used + tokens > budget:
+            if not kept and budget > 0:
+                kept.append(truncate_to_tokens(line, budget))
+            break
+        kept.append(line)
+        used += tokens
+    omitted = len(lines) - len(kept)
+    if not kept:
+        return EMPTY_SECTION, omitted
+    if omitted:
+        kept.append(f"(+{omitted} more omitted)")
+    return "\n".join(kept), omitted
+
+
+class ContextAssembler:
+    """
+    情報収集の結果（知識・類似症例・診断候補）をプロンプト用に整形するクラス。
+    - 冗長なPythonのreprの代わりに1件1行の短い形式で書き出す
+    - ソース内・ソース間で重複する根拠を除く（同じWikipediaページ、同じ症例、APIとLLMの両方に挙がった疾患）
+    - 関連度順に並べ、プロンプトごとのトークン予算に収まるよう切り詰める
+    """
+    def __init__(self, token_budget=DEFAULT_REPORT_TOKEN_BUDGET, max_item_tokens=DEFAULT_MAX_ITEM_TOKENS,
+                 section_weights=None):
+        self.token_budget = token_budget
+        self.max_item_tokens = max_item_tokens
+        self.section_weights = dict(section_weights or DEFAULT_SECTION_WEIGHTS)
+
+    def knowledge_lines(self, knowledge):
+        """
+        知識検索の結果（[{title, summary}, ...]）をページ単位の行にし、同じページを除く。
+        """
+        lines = []
+        seen = set()
+        for item in knowledge or []:
+            if not isinstance(item, dict):
+                item = {"title": "", "summary": str(item)}
+            for page in WIKIPEDIA_PAGE.split(item.get("summary") or ""):
+                match = re.match(r"Page: (.*)\nSummary: ", page)
+                if match:
+                    title, text = match.group(1), page[match.end():]
+                else:
+                    title, text = item.get("title") or "", page
+                text = re.sub(r"\s+", " ", text).strip()
+                if not text or text.startswith("No good Wikipedia Search Result"):
+                    continue
+                key = normalize_text(title) if match else normalize_text(text)
+                if key in seen:
+                    continue
+                seen.add(key)
+                line = f"- {title}: {text}" if title else f"- {text}"
+                lines.append(truncate_to_tokens(line, self.max_item_tokens))
+        return lines
+
+    def case_lines(self, cases):
+        """
+        類似症例を類似度の高い順に1行1件のJSONにし、同じ症例を除く。
+        """
+        if not isinstance(cases, list):
+            cases = [cases] if cases else []
+        ranked = sorted(
+            (case for case in cases if case),
+            key=lambda case: -(case.get("similarity") or 0) if isinstance(case, dict) else 0
+        )
+        lines = []
+        seen = set()
+        for case in ranked:
+            line = compact_json(case) if isinstance(case, dict) else str(case)
+            key = case.get("id", line) if isinstance(case, dict) else line
+            if key in seen:
+                continue
+            seen.add(key)
+            lines.append("- " + truncate_to_tokens(line, self.max_item_tokens))
+        return lines
+
+    def candidate_lines(self, candidates):
+        """
+        診断候補を (APIの行, LLMの行) に整形する。両方に挙がった疾患はAPIの行に印を付けてLLM側から除く。
+        """
+        candidates = candidates or {}
+        llm_names = {}
+        for item in candidates.get("gemini") or []:
+            if isinstance(item, dict) and item.get("label"):
+                llm_names.setdefault(normalize_text(item["label"]), item)
+        api_lines = []
+        seen = set()
+        for item in candidates.get("pubcasefinder") or []:
+            if not isinstance(item, dict) or not item.get("omim_disease_name_en"):
+                continue
+            key = normalize_text(item["omim_disease_name_en"])
+            if key in seen:
+                continue
+            seen.add(key)
+            line = f"- {item['omim_disease_name_en']}"
+            if item.get("score") is not None:
+                line += f" (score {_compact_value(item['score'])})"
+            if item.get("description"):
+                line += ": " + re.sub(r"\s+", " ", item["description"]).strip()
+            if key in llm_names:
+                line += " [also proposed by LLM]"
+            api_lines.append(truncate_to_tokens(line, self.max_item_tokens))
+        llm_lines = [
+            f"- {item['label']} ({item['id']})" if item.get("id") else f"- {item['label']}"
+            for key, item in llm_names.items() if key not in seen
+        ]
+        return api_lines, llm_lines
+
+    def format_knowledge(self, knowledge, budget=DEFAULT_JUDGE_KNOWLEDGE_TOKEN_BUDGET):
+        return fit_lines(self.knowledge_lines(knowledge), budget)[0]
+
+    def format_cases(self, cases, budget=DEFAULT_JUDGE_CASES_TOKEN_BUDGET):
+        return fit_lines(self.case_lines(cases), budget)[0]
+
+    def assemble_report(self, knowledge, cases, candidates, budget=None):
+        """
+        診断レポート用プロンプト（PROMPT4_TEMPLATE）の根拠部分を予算内で組み立てる。
+        Returns:
+            dict: web_diagnosis, llm_response, diagnosis_api_response, similar_case_detailed
+        """
+        budget = self.token_budget if budget is None else budget
+        api_lines, llm_lines = self.candidate_lines(candidates)
+        sections = {
+            "knowledge": self.knowledge_lines(knowledge),
+            "cases": self.case_lines(cases),
+            "api": api_lines,
+            "llm": llm_lines
+        }
+        demands = {name: sum(estimate_tokens(line) for line in lines) for name, lines in sections.items()}
+        allocation = allocate_budget(budget, demands, self.section_weights)
+        texts = {}
+        omitted = 0
+        for name, lines in sections.items():
+            texts[name], dropped = fit_lines(lines, allocation[name])
+            omitted += dropped
+        tracing.current_span().set(
+            context_tokens=sum(estimate_tokens(text) for text in texts.values()),
+            context_items_omitted=omitted
+        )
+        return {
+            "web_diagnosis": texts["knowledge"],
+            "llm_response": texts["llm"],
+            "diagnosis_api_response": texts["api"],
+            "similar_case_detailed": texts["cases"]
+        }
@@ -1,57 +1,267 @@
 import os
+import json
+import threading
 import numpy as np
 import pickle
-import google.generativeai as genai
+from agents.embedding_store import DEFAULT_EMBEDDING_MODEL, open_embedding_store, store_exists
+from agents.embedding_cache import embed_texts, get_embedding_cache
+from agents.llm_gateway import PRIORITY_REFLECTION
+from agents.vector_index import build_vector_index, index_path_prefix, load_vector_index
+from agents.lexical_index import LexicalIndex, DEFAULT_LEXICAL_THRESHOLD
+from agents import tracing
+
+DEFAULT_EMBEDDINGS_PATH = "./data/omim_embeddings.npy"
+LEGACY_EMBEDDINGS_PATH = "./data/omim_embeddings.pkl"
+
+# プロセス内で共有するOMIMインデックス（パスごとに一度だけロード）
+_index_cache = {}
+_index_lock = threading.Lock()
+_search_index_cache = {}
+_lexical_index_cache = {}
+_shared_normalizer = None
+_shared_normalizer_lock = threading.Lock()
+
+
+def _load_pickle_index(embeddings_path):
+    with open(embeddings_path, 'rb') as f:
+        normalized_data = pickle.load(f)
+    vectors = np.asarray(normalized_data['vectors'], dtype=np.float32)
+    if vectors is normalized_data['vectors']:
+        vectors = vectors.copy()
+    # ベクトルを正規化（L2ノルムで割る）
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors.setflags(write=False)
+    return {
+        'vectors': vectors,
+        'ids': list(normalized_data['ids']),
+        'labels': list(normalized_data['labels']),
+        'model': DEFAULT_EMBEDDING_MODEL
+    }
+
+
+def _load_index(embeddings_path):
+    if embeddings_path.endswith(".pkl"):
+        return _load_pickle_index(embeddings_path)
+    if not store_exists(embeddings_path) and os.path.exists(LEGACY_EMBEDDINGS_PATH):
+        print(f"[DiseaseNormalizer] {embeddings_path} が見つからないため旧形式の {LEGACY_EMBEDDINGS_PATH} を使用します。")
+        return _load_pickle_index(LEGACY_EMBEDDINGS_PATH)
+    return open_embedding_store(embeddings_path)
+
+
+def load_omim_index(embeddings_path=DEFAULT_EMBEDDINGS_PATH):
+    """
+    OMIMのembeddingインデックスをロードする。
+    同じパスはプロセス内で一度だけ読み込み、全エージェントで共有する（スレッドセーフ）。
+    .npy形式のストアはメモリマップで開き、.pklは旧形式としてヒープに読み込む。
+    Returns:
+        dict: {'vectors': 読み取り専用のL2正規化済み行列, 'ids': list, 'labels': list, 'model': str}
+    """
+    key = os.path.abspath(embeddings_path)
+    index = _index_cache.get(key)
+    if index is not None:
+        return index
+    with _index_lock:
+        index = _index_cache.get(key)
+        if index is None:
+            index = _load_index(embeddings_path)
+            _index_cache[key] = index
+    return index
+
+
+def index_params_key(index_params):
+    """
+    インデックスのパラメータ（dict）を、共有キャッシュのキーに使える文字列に変換する。
+    """
+    return json.dumps(index_params or {}, sort_keys=True)
+
+
+def load_search_index(embeddings_path, backend, vectors, index_params=None):
+    """
+    embeddingストアに対する検索インデックスを返す（パスとバックエンドごとにプロセス内で共有）。
+    近似インデックスはcreate_embedding.pyで保存したものを読み込み、なければ（またはストア・設定と合わなければ）
+    その場で構築する。
+    Args:
+        backend (str): "exact"（既定・全件の厳密検索） / "ivf" / "ivfpq"
+        index_params (dict): 構築時のパラメータ（nlist, nprobe, m, rerank）
+    """
+    index_params = index_params or {}
+    key = (os.path.abspath(embeddings_path), backend, index_params_key(index_params))
+    index = _search_index_cache.get(key)
+    if index is not None:
+        return index
+    with _index_lock:
+        index = _search_index_cache.get(key)
+        if index is None:
+            index = load_vector_index(
+                backend, index_path_prefix(embeddings_path, backend), shape=vectors.shape, **index_params
+            )
+            if index is None:
+                print(f"[DiseaseNormalizer] 使用できる保存済みの{backend}インデックスがないため構築します。")
+                index = build_vector_index(backend, vectors, **index_params)
+            _search_index_cache[key] = index
+    return index
+
+
+def load_lexical_index(embeddings_path, labels):
+    """
+    病名ラベルの字句インデックスを返す（パスごとにプロセス内で共有）。
+    """
+    key = os.path.abspath(embeddings_path)
+    index = _lexical_index_cache.get(key)
+    if index is not None:
+        return index
+    with _index_lock:
+        index = _lexical_index_cache.get(key)
+        if index is None:
+            index = LexicalIndex(labels)
+            _lexical_index_cache[key] = index
+    return index
+
+
+def get_disease_normalizer(embeddings_path=DEFAULT_EMBEDDINGS_PATH, index_backend="exact",
+                           lexical_threshold=DEFAULT_LEXICAL_THRESHOLD, index_params=None):
+    """
+    プロセス共通のDiseaseNormalizerを返す。初回呼び出し時にのみ生成する
+    （引数が前回と異なる場合は作り直す）。
+    """
+    global _shared_normalizer
+    key = (os.path.abspath(embeddings_path), index_backend, lexical_threshold, index_params_key(index_params))
+    normalizer = _shared_normalizer
+    if normalizer is not None and normalizer.shared_key == key:
+        return normalizer
+    with _shared_normalizer_lock:
+        normalizer = _shared_normalizer
+        if normalizer is None or normalizer.shared_key != key:
+            normalizer = DiseaseNormalizer(embeddings_path, index_backend=index_backend, index_params=index_params,
+                                           lexical_threshold=lexical_threshold)
+            _shared_normalizer = normalizer
+    return normalizer
+
 
 class DiseaseNormalizer:
-    def __init__(self, embeddings_path= "./data/omim_embeddings.pkl"):
+    def __init__(self, embeddings_path=DEFAULT_EMBEDDINGS_PATH, embedding_cache=None, use_cache=True,
+                 index_backend="exact", index_params=None, llm_gateway=None,
+                 lexical_threshold=DEFAULT_LEXICAL_THRESHOLD):
         """
-        コンストラクタ。事前計算されたembeddingデータをロードし、APIキーを設定する。
+        コンストラクタ。設定のみを保存し、embeddingデータと検索インデックスは初回の正規化時（またはload()）に読み込む。
+        embeddingデータはload_omim_indexによりプロセス内で共有される。
+        クエリのembeddingはembedding_cache（未指定時はプロセス共通キャッシュ）に保存し再利用する。
+        index_backendで検索方法（"exact" / "ivf" / "ivfpq"）を選べる。
+        llm_gatewayを指定した場合はクエリのembeddingにそのゲートウェイを使う。
+        病名ラベルとの完全一致・ファジー一致（LexicalIndex）のスコアがlexical_threshold以上の疾患名は
+        embeddingを使わずに正規化する（Noneの場合は常にembeddingで検索する）。
+        GOOGLE_API_KEYはembeddingが必要になった時点で確認する。
         """
-        # 環境変数からGoogle APIキーを読み込む
-        api_key = os.getenv("GOOGLE_API_KEY")
-        if not api_key:
-            raise ValueError("環境変数 'GOOGLE_API_KEY' が設定されていません。")
-        
-        genai.configure(api_key=api_key)
-
-        with open(embeddings_path, 'rb') as f:
-            normalized_data = pickle.load(f)
-            self.omim_vectors = normalized_data['vectors']
-            self.omim_ids = normalized_data['ids']
-            self.omim_labels = normalized_data['labels']
-        
-        # ベクトルを正規化（L2ノルムで割る）
-        self.omim_vectors /= np.linalg.norm(self.omim_vectors, axis=1, keepdims=True)
-        
+        self.embeddings_path = os.path.abspath(embeddings_path)
+        self.index_backend = index_backend
+        self.index_params = index_params
+        self.lexical_threshold = lexical_threshold
+        self.shared_key = (self.embeddings_path, index_backend, lexical_threshold, index_params_key(index_params))
+        if embedding_cache is None and use_cache:
+            embedding_cache = get_embedding_cache()
+        self.embedding_cache = embedding_cache
+        self.llm_gateway = llm_gateway
+        self._loaded = False
+        self._load_lock = threading.Lock()
+
+    def load(self):
+        """
+        embeddingデータ・検索インデックス・字句インデックスを読み込む（2回目以降は何もしない）。
+        起動時にまとめて読み込む場合（ウォームアップ）にも使う。
+        """
+        if self._loaded:
+            return self
+        with self._load_lock:
+            if self._loaded:
+                return self
+            index = load_omim_index(self.embeddings_path)
+            self.omim_vectors = index['vectors']
+            self.omim_ids = index['ids']
+            self.omim_labels = index['labels']
+            self.embedding_model = index.get('model', DEFAULT_EMBEDDING_MODEL)
+            self.search_index = load_search_index(
+                self.embeddings_path, self.index_backend, self.omim_vectors, self.index_params
+            )
+            self.lexical_index = (load_lexical_index(self.embeddings_path, self.omim_labels)
+                                  if self.lexical_threshold is not None else None)
+            self._loaded = True
         print("DiseaseNormalizerの準備ができました。")
+        return self
 
     def normalize(self, disease_name):
         """
         疾患名を受け取り、最も類似したOMIM疾患のIDと病名を返す。
         """
-        # 入力された疾患名をembedding
-        result = genai.embed_content(
-            model="models/embedding-001",
-            content=disease_name,
-            task_type="RETRIEVAL_QUERY"
+        matches = self.normalize_many([disease_name], k=1)[0]
+        return matches[0] if matches else None
+
+    def normalize_many(self, disease_names, k=5):
+        """
+        複数の疾患名を1回のembedding APIバッチ呼び出しでまとめて正規化する。
+        病名ラベルと字句的に一致する疾患名、キャッシュ済みの疾患名はAPIを呼ばずに正規化する。
+        Args:
+            disease_names (list): 疾患名リスト
+            k (int): 疾患名ごとに返す候補数
+        Returns:
+            list: 疾患名ごとの類似度上位k件 [{'id', 'name', 'label', 'similarity', 'match'}, ...] のリスト
+                  （matchは "exact" / "fuzzy" / "embedding"）
+        """
+        disease_names = list(disease_names)
+        if not disease_names:
+            return []
+        self.load()
+        with tracing.span("normalizer.normalize", names=len(disease_names), backend=self.index_backend) as span:
+            matches = [None] * len(disease_names)
+            if self.lexical_index is not None:
+                for i, name in enumerate(disease_names):
+                    matches[i] = self._lexical_matches(name, k)
+            pending = [i for i, match in enumerate(matches) if match is None]
+            span.set(lexical_matches=len(disease_names) - len(pending), embedding_queries=len(pending))
+            if pending:
+                for i, match in zip(pending, self._normalize_many([disease_names[i] for i in pending], k)):
+                    matches[i] = match
+            return matches
+
+    def _match(self, i, score, method):
+        return {
+            'id': self.omim_ids[i],
+            'name': self.omim_labels[i],
+            'label': self.omim_labels[i],
+            'similarity': float(score),
+            'match': method
+        }
+
+    def _lexical_matches(self, disease_name, k):
+        """
+        字句インデックスで照合し、最上位のスコアが閾値以上ならその結果を、そうでなければNoneを返す。
+        ファジー一致は病型の番号・記号が一致するラベルに限られ、一致しない病名はembeddingでの検索に回る。
+        """
+        found = self.lexical_index.lookup(disease_name, k, min_score=self.lexical_threshold)
+        if not found or found[0][1] < self.lexical_threshold:
+            return None
+        return [self._match(i, score, method) for i, score, method in found]
+
+    def _normalize_many(self, disease_names, k):
+        # 入力された疾患名をまとめてembedding（キャッシュ済みのものはAPIを呼ばない）
+        query_vectors = embed_texts(
+            disease_names,
+            model=self.embedding_model,
+            task_type="RETRIEVAL_QUERY",
+            cache=self.embedding_cache,
+            priority=PRIORITY_REFLECTION,
+            gateway=self.llm_gateway
         )
-        query_vector = np.array(result['embedding'])
 
         # ベクトルを正規化
-        query_vector /= np.linalg.norm(query_vector)
+        query_vectors /= np.linalg.norm(query_vectors, axis=1, keepdims=True)
 
-        # コサイン類似度を計算 (内積)
-        similarities = np.dot(self.omim_vectors, query_vector.T).flatten()
+        # コサイン類似度（内積）が高い疾患を検索インデックスで取得
+        top_indices, top_scores = self.search_index.search(self.omim_vectors, query_vectors, k)
 
-        # 最も類似度が高い疾患のインデックスを取得
-        closest_index = np.argmax(similarities)
-
-        return {
-            'id': self.omim_ids[closest_index],
-            'name': self.omim_labels[closest_index],
-            'similarity': similarities[closest_index]
-        }
+        matches = []
+        for indices, scores in zip(top_indices, top_scores):
+            matches.append([self._match(i, score, 'embedding') for i, score in zip(indices, scores) if i >= 0])
+        return matches
 
 """
 try:
@@ -67,4 +277,4 @@ try:
 except (ValueError, FileNotFoundError) as e:
     print(e)
     print("エラー: 'omim_embeddings.pkl' が見つかりません。先に事前準備のコードを実行してください。")
-"""
\ No newline at end of file
+"""
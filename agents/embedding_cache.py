@@ -0,0 +1,103 @@
+import re
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+from agents.cache import PersistentLRUCache
+from agents.llm_gateway import get_llm_gateway, PRIORITY_EMBEDDING
+from agents import tracing
+
+DEFAULT_EMBEDDING_CACHE_PATH = "./data/cache/embeddings.sqlite3"
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def normalize_text(text):
+    """
+    キャッシュキー用にテキストを正規化する（NFKC、大文字小文字の統一、空白の圧縮）。
+    """
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+class EmbeddingCache:
+    """
+    embeddingベクトルの永続キャッシュ。
+    正規化済みテキスト・モデル名・task_typeの組をキーとしてfloat32ベクトルを保存する。
+    """
+    def __init__(self, path=DEFAULT_EMBEDDING_CACHE_PATH, max_entries=200000, memory_entries=4096):
+        self.store = PersistentLRUCache(path, max_entries=max_entries, memory_entries=memory_entries)
+
+    @staticmethod
+    def make_key(text, model, task_type):
+        digest = hashlib.sha256(
+            "\x1f".join([model, task_type, normalize_text(text)]).encode("utf-8")
+        ).hexdigest()
+        return digest
+
+    def get_many(self, texts, model, task_type):
+        keys = [self.make_key(text, model, task_type) for text in texts]
+        found = self.store.get_many(keys)
+        return [found.get(key) for key in keys]
+
+    def set_many(self, texts, vectors, model, task_type):
+        self.store.set_many({
+            self.make_key(text, model, task_type): np.asarray(vector, dtype=np.float32)
+            for text, vector in zip(texts, vectors)
+        })
+
+
+def get_embedding_cache(path=DEFAULT_EMBEDDING_CACHE_PATH):
+    """
+    プロセス共通のEmbeddingCacheを返す。
+    """
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None or _shared_cache.store.path != path:
+            _shared_cache = EmbeddingCache(path)
+    return _shared_cache
+
+
+def embed_texts(texts, model, task_type, cache=None, priority=PRIORITY_EMBEDDING, gateway=None):
+    """
+    テキストのリストをembeddingする。キャッシュにあるものは再利用し、
+    キャッシュにないものだけを1回のembed_content呼び出しでまとめて取得する。
+    同じ正規化テキストが複数含まれる場合も1回だけ問い合わせる。
+    Args:
+        texts (list): テキストリスト
+        model (str): embeddingモデル名
+        task_type (str): "RETRIEVAL_QUERY" / "RETRIEVAL_DOCUMENT" など
+        cache (EmbeddingCache): 使用するキャッシュ（Noneの場合はキャッシュしない）
+        priority (int): LLMGatewayの優先度レーン
+        gateway (LLMGateway): 使用するゲートウェイ（Noneの場合はプロセス共通のもの）
+    Returns:
+        np.ndarray: (テキスト数, 次元) のfloat32行列
+    """
+    texts = list(texts)
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    vectors = cache.get_many(texts, model, task_type) if cache is not None else [None] * len(texts)
+
+    missing = {}
+    for i, (text, vector) in enumerate(zip(texts, vectors)):
+        if vector is None:
+            missing.setdefault(normalize_text(text), []).append(i)
+    span = tracing.current_span()
+    span.increment("embedding_cache_hits", sum(1 for vector in vectors if vector is not None))
+    span.increment("embedding_cache_misses", len(missing))
+    if missing:
+        query_texts = [texts[positions[0]] for positions in missing.values()]
+        result = (gateway or get_llm_gateway()).embed(
+            query_texts,
+            model=model,
+            task_type=task_type,
+            priority=priority
+        )
+        fetched = np.asarray(result['embedding'], dtype=np.float32).reshape(len(query_texts), -1)
+        for positions, vector in zip(missing.values(), fetched):
+            for i in positions:
+                vectors[i] = vector
+        if cache is not None:
+            cache.set_many(query_texts, fetched, model, task_type)
+    return np.stack(vectors).astype(np.float32, copy=False)
@@ -0,0 +1,104 @@
+import os
+import json
+import numpy as np
+
+STORE_FORMAT_VERSION = 1
+DEFAULT_EMBEDDING_MODEL = "models/embedding-001"
+
+
+def store_paths(path):
+    """
+    ストアのパス（接頭辞、.npy、.meta.jsonのいずれか）から
+    ベクトルファイルとメタデータファイルのパスを返す。
+    """
+    if path.endswith(".meta.json"):
+        prefix = path[:-len(".meta.json")]
+    elif path.endswith(".npy"):
+        prefix = path[:-len(".npy")]
+    else:
+        prefix = path
+    return prefix + ".npy", prefix + ".meta.json"
+
+
+def store_exists(path):
+    vectors_path, meta_path = store_paths(path)
+    return os.path.exists(vectors_path) and os.path.exists(meta_path)
+
+
+def save_embedding_store(vectors, ids, labels, path, model=DEFAULT_EMBEDDING_MODEL, dtype="float32"):
+    """
+    embeddingをL2正規化済みの.npyファイルと、ID・病名・モデル名・次元数を記録した
+    サイドカーJSONとして保存する。書き込みは一時ファイル経由で原子的に行う。
+    Args:
+        vectors (array-like): (件数, 次元) のembedding行列
+        ids (list): OMIM IDリスト
+        labels (list): 病名リスト
+        path (str): 保存先（接頭辞または.npyパス）
+        model (str): embeddingに使用したモデル名
+        dtype (str): 保存する型 ("float32" または "float16")
+    """
+    if dtype not in ("float32", "float16"):
+        raise ValueError(f"未対応のdtypeです: {dtype}")
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim != 2:
+        raise ValueError("vectorsは2次元配列である必要があります。")
+    if not (len(vectors) == len(ids) == len(labels)):
+        raise ValueError("vectors, ids, labels の件数が一致しません。")
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    vectors = (vectors / norms).astype(dtype)
+
+    vectors_path, meta_path = store_paths(path)
+    directory = os.path.dirname(os.path.abspath(vectors_path))
+    os.makedirs(directory, exist_ok=True)
+
+    tmp_vectors_path = vectors_path + ".tmp"
+    with open(tmp_vectors_path, "wb") as f:
+        np.save(f, vectors)
+    meta = {
+        "format_version": STORE_FORMAT_VERSION,
+        "model": model,
+        "dim": int(vectors.shape[1]),
+        "count": int(vectors.shape[0]),
+        "dtype": dtype,
+        "normalized": True,
+        "ids": list(ids),
+        "labels": list(labels)
+    }
+    tmp_meta_path = meta_path + ".tmp"
+    with open(tmp_meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_vectors_path, vectors_path)
+    os.replace(tmp_meta_path, meta_path)
+    return vectors_path, meta_path
+
+
+def open_embedding_store(path):
+    """
+    save_embedding_storeで保存したストアをメモリマップで開く（ゼロコピー）。
+    複数のワーカープロセスが同じページキャッシュを共有できる。
+    Returns:
+        dict: {'vectors': 読み取り専用memmap, 'ids', 'labels', 'model', 'dim', 'dtype'}
+    """
+    vectors_path, meta_path = store_paths(path)
+    with open(meta_path, encoding="utf-8") as f:
+        meta = json.load(f)
+    version = meta.get("format_version")
+    if version != STORE_FORMAT_VERSION:
+        raise ValueError(f"未対応のembeddingストア形式です: version={version}")
+
+    vectors = np.load(vectors_path, mmap_mode="r")
+    if vectors.shape != (meta["count"], meta["dim"]):
+        raise ValueError(
+            f"embeddingストアが破損しています: shape={vectors.shape}, "
+            f"meta=({meta['count']}, {meta['dim']})"
+        )
+    return {
+        "vectors": vectors,
+        "ids": meta["ids"],
+        "labels": meta["labels"],
+        "model": meta["model"],
+        "dim": meta["dim"],
+        "dtype": meta["dtype"]
+    }
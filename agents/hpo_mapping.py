@@ -17,3 +17,11 @@ class HPOMapping:
             label = self.mapping.get(hpoid, "Unknown")
             result.append(f"{hpoid}:{label}")
         return result
+
+
+def canonicalize_hpo_ids(hpo_list):
+    """
+    HPO IDリストを正規化する（前後の空白除去・大文字化・重複除去・ソート）。
+    キャッシュキーやリクエストの同一性判定に用いる。
+    """
+    return sorted({hpoid.strip().upper() for hpoid in hpo_list if hpoid and hpoid.strip()})
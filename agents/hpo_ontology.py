@@ -0,0 +1,294 @@
+import os
+import json
+import threading
+from collections import deque
+import numpy as np
+
+DEFAULT_HPO_PATH = os.path.join(os.path.dirname(__file__), '../data/HPO_matching/hp.obo')
+ROOT_TERM = "HP:0000001"
+PHENOTYPIC_ABNORMALITY = "HP:0000118"
+
+_ontology_cache = {}
+_ontology_lock = threading.Lock()
+
+
+def _parse_obo(path):
+    """
+    hp.oboを読み込み、{id: {"name", "parents", "alt_ids", "obsolete", "replaced_by"}} を返す
+    """
+    terms = {}
+    current = None
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('['):
+                current = {"parents": [], "alt_ids": [], "obsolete": False, "replaced_by": None} \
+                    if line == '[Term]' else None
+                continue
+            if current is None or ':' not in line:
+                continue
+            key, value = line.split(':', 1)
+            value = value.split(' ! ')[0].strip()
+            if key == 'id':
+                terms[value] = current
+            elif key == 'name':
+                current["name"] = value
+            elif key == 'is_a':
+                current["parents"].append(value.split()[0])
+            elif key == 'alt_id':
+                current["alt_ids"].append(value)
+            elif key == 'is_obsolete':
+                current["obsolete"] = value == 'true'
+            elif key == 'replaced_by':
+                current["replaced_by"] = value
+    return terms
+
+
+def _obo_purl_to_id(iri):
+    return iri.rsplit('/', 1)[-1].replace('_', ':')
+
+
+def _parse_obographs_json(path):
+    """
+    hp.json（OBO Graphs形式）を読み込み、_parse_oboと同じ形式で返す
+    """
+    with open(path, encoding='utf-8') as f:
+        graph = json.load(f)["graphs"][0]
+    terms = {}
+    for node in graph.get("nodes", []):
+        term_id = _obo_purl_to_id(node["id"])
+        if not term_id.startswith("HP:"):
+            continue
+        meta = node.get("meta", {})
+        alt_ids = [
+            value["val"] for value in meta.get("basicPropertyValues", [])
+            if value.get("pred", "").endswith("hasAlternativeId")
+        ]
+        terms[term_id] = {
+            "name": node.get("lbl", ""),
+            "parents": [],
+            "alt_ids": alt_ids,
+            "obsolete": meta.get("deprecated", False),
+            "replaced_by": None
+        }
+    for edge in graph.get("edges", []):
+        if edge.get("pred") != "is_a":
+            continue
+        child, parent = _obo_purl_to_id(edge["sub"]), _obo_purl_to_id(edge["obj"])
+        if child in terms and parent in terms:
+            terms[child]["parents"].append(parent)
+    return terms
+
+
+class HPOOntology:
+    """
+    HPOオントロジーを整数インデックスの配列として保持するクラス。
+    - 祖先の閉包（自身を含む）をCSR配列（ancestor_indptr, ancestor_indices）で事前計算する
+    - 各タームの情報量（IC）を保持し、Resnik/Lin類似度をベクトル演算で計算する
+    - 冗長な祖先タームを除いたクエリの正規化を行う
+    """
+    def __init__(self, path=DEFAULT_HPO_PATH):
+        if path.endswith('.json'):
+            terms = _parse_obographs_json(path)
+        else:
+            terms = _parse_obo(path)
+
+        self.term_ids = sorted(term_id for term_id, term in terms.items() if not term["obsolete"])
+        self.index = {term_id: i for i, term_id in enumerate(self.term_ids)}
+        self.labels = [terms[term_id].get("name", "") for term_id in self.term_ids]
+        # 旧ID・廃止IDを現行IDに対応付ける
+        self.aliases = {}
+        for term_id, term in terms.items():
+            if term["obsolete"]:
+                if term["replaced_by"] in self.index:
+                    self.aliases[term_id] = term["replaced_by"]
+                continue
+            for alt_id in term["alt_ids"]:
+                self.aliases[alt_id] = term_id
+
+        parents = [
+            [self.index[parent] for parent in terms[term_id]["parents"] if parent in self.index]
+            for term_id in self.term_ids
+        ]
+        self.parent_indptr, self.parent_indices = self._to_csr(parents)
+        self.ancestor_indptr, self.ancestor_indices = self._to_csr(self._ancestor_closure(parents))
+        self.descendant_counts = np.bincount(self.ancestor_indices, minlength=len(self.term_ids))
+        self.information_content = self.intrinsic_information_content()
+
+    @staticmethod
+    def _to_csr(rows):
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(row) for row in rows])
+        indices = np.fromiter((i for row in rows for i in row), dtype=np.int32, count=int(indptr[-1]))
+        return indptr, indices
+
+    @staticmethod
+    def _ancestor_closure(parents):
+        """
+        親リストから、自身を含む祖先集合をトポロジカル順に計算する
+        """
+        n = len(parents)
+        children = [[] for _ in range(n)]
+        pending = np.zeros(n, dtype=np.int32)
+        for child, row in enumerate(parents):
+            pending[child] = len(row)
+            for parent in row:
+                children[parent].append(child)
+        ancestors = [None] * n
+        queue = deque(i for i in range(n) if pending[i] == 0)
+        while queue:
+            i = queue.popleft()
+            closure = {i}
+            for parent in parents[i]:
+                closure.update(ancestors[parent])
+            ancestors[i] = closure
+            for child in children[i]:
+                pending[child] -= 1
+                if pending[child] == 0:
+                    queue.append(child)
+        # 循環があった場合に備え、未処理のタームは自身のみとする
+        return [sorted(closure) if closure is not None else [i] for i, closure in enumerate(ancestors)]
+
+    def __len__(self):
+        return len(self.term_ids)
+
+    def resolve(self, hpo_id):
+        """
+        HPO ID（旧IDを含む）を現行IDに変換する。未知のIDはNoneを返す。
+        """
+        hpo_id = hpo_id.strip().upper()
+        hpo_id = self.aliases.get(hpo_id, hpo_id)
+        return hpo_id if hpo_id in self.index else None
+
+    def indices(self, hpo_ids):
+        """
+        HPO IDリストを整数インデックス配列に変換する（未知のIDは除外）。
+        """
+        resolved = (self.resolve(hpo_id) for hpo_id in hpo_ids)
+        return np.array([self.index[hpo_id] for hpo_id in resolved if hpo_id], dtype=np.int32)
+
+    def label(self, hpo_id):
+        resolved = self.resolve(hpo_id)
+        return self.labels[self.index[resolved]] if resolved else None
+
+    def ancestors_of(self, term_index):
+        return self.ancestor_indices[self.ancestor_indptr[term_index]:self.ancestor_indptr[term_index + 1]]
+
+    def ancestor_mask(self, term_indices):
+        """
+        指定タームの祖先（自身を含む）の和集合を長さNのbool配列で返す。
+        """
+        mask = np.zeros(len(self.term_ids), dtype=bool)
+        for i in term_indices:
+            mask[self.ancestors_of(i)] = True
+        return mask
+
+    def intrinsic_information_content(self):
+        """
+        子孫数に基づく内在的な情報量 IC = -log(子孫数 / 全ターム数) を返す。
+        """
+        return -np.log(self.descendant_counts / len(self.term_ids)).astype(np.float32)
+
+    def annotation_information_content(self, annotations):
+        """
+        疾患アノテーションに基づく情報量 IC = -log(そのタームを（祖先伝播込みで）持つ疾患の割合) を計算する。
+        Args:
+            annotations (dict): {疾患ID: HPO IDリスト}
+        Returns:
+            np.ndarray: 各タームのIC（注釈のないタームは最大値）
+        """
+        counts = np.zeros(len(self.term_ids), dtype=np.float64)
+        for hpo_ids in annotations.values():
+            counts += self.ancestor_mask(self.indices(hpo_ids))
+        total = max(len(annotations), 1)
+        with np.errstate(divide='ignore'):
+            ic = -np.log(counts / total)
+        ic[~np.isfinite(ic)] = np.log(total)
+        return ic.astype(np.float32)
+
+    def set_information_content(self, information_content):
+        self.information_content = np.asarray(information_content, dtype=np.float32)
+
+    def canonicalize(self, hpo_ids):
+        """
+        HPO IDリストを正規化する。旧IDを現行IDに置き換え、重複と、
+        集合内の他のタームの祖先である冗長なタームを取り除いてソートして返す。
+        未知のIDはそのまま残す。
+        """
+        unknown = sorted({hpo_id.strip().upper() for hpo_id in hpo_ids if not self.resolve(hpo_id)})
+        term_indices = np.unique(self.indices(hpo_ids))
+        redundant = set()
+        for i in term_indices:
+            ancestors = self.ancestors_of(i)
+            redundant.update(int(a) for a in ancestors if a != i)
+        kept = [self.term_ids[i] for i in term_indices if int(i) not in redundant]
+        return sorted(kept) + unknown
+
+    def _ancestor_ic_matrix(self, term_indices):
+        """
+        (タームの数, N) の行列で、各行は祖先タームの位置にICを持ち、それ以外は0。
+        """
+        matrix = np.zeros((len(term_indices), len(self.term_ids)), dtype=np.float32)
+        for row, i in enumerate(term_indices):
+            ancestors = self.ancestors_of(i)
+            matrix[row, ancestors] = self.information_content[ancestors]
+        return matrix
+
+    def resnik_matrix(self, query_indices, target_indices):
+        """
+        ターム間のResnik類似度（最も情報量の多い共通祖先のIC）を (クエリ数, ターゲット数) で返す。
+        """
+        target_ic = self._ancestor_ic_matrix(target_indices)
+        scores = np.zeros((len(query_indices), len(target_indices)), dtype=np.float32)
+        for row, i in enumerate(query_indices):
+            ancestors = self.ancestors_of(i)
+            if len(target_indices):
+                scores[row] = target_ic[:, ancestors].max(axis=1)
+        return scores
+
+    def lin_matrix(self, query_indices, target_indices):
+        """
+        ターム間のLin類似度 2*IC(MICA) / (IC(q) + IC(t)) を返す。
+        """
+        resnik = self.resnik_matrix(query_indices, target_indices)
+        denominator = (self.information_content[query_indices][:, None]
+                       + self.information_content[target_indices][None, :])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lin = np.where(denominator > 0, 2 * resnik / denominator, 0.0)
+        return lin.astype(np.float32)
+
+    def set_similarity(self, query_ids, target_ids, method="resnik", symmetric=True):
+        """
+        2つの表現型セットの類似度をbest-match-averageで計算する。
+        Args:
+            method (str): "resnik" または "lin"
+            symmetric (bool): Trueの場合は両方向の平均を取る
+        """
+        query_indices = self.indices(query_ids)
+        target_indices = self.indices(target_ids)
+        if len(query_indices) == 0 or len(target_indices) == 0:
+            return 0.0
+        if method == "lin":
+            matrix = self.lin_matrix(query_indices, target_indices)
+        else:
+            matrix = self.resnik_matrix(query_indices, target_indices)
+        forward = float(matrix.max(axis=1).mean())
+        if not symmetric:
+            return forward
+        return (forward + float(matrix.max(axis=0).mean())) / 2
+
+
+def load_hpo_ontology(path=DEFAULT_HPO_PATH):
+    """
+    HPOOntologyをプロセス内で一度だけロードして共有する（スレッドセーフ）。
+    """
+    key = os.path.abspath(path)
+    ontology = _ontology_cache.get(key)
+    if ontology is not None:
+        return ontology
+    with _ontology_lock:
+        ontology = _ontology_cache.get(key)
+        if ontology is None:
+            ontology = HPOOntology(path)
+            _ontology_cache[key] = ontology
+    return ontology
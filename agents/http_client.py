@@ -0,0 +1,83 @@
+import json
+import hashlib
+import threading
+from agents.cache import PersistentLRUCache
+from agents import tracing
+
+DEFAULT_HTTP_CACHE_PATH = "./data/cache/http.sqlite3"
+DEFAULT_HTTP_CACHE_TTL = 7 * 24 * 60 * 60
+
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+
+class HTTPClient:
+    """
+    外部API（PubCaseFinder, TogoSeekなど）共通のHTTPクライアント。
+    コネクションプールを持つrequests.Sessionを共有し（keep-alive）、
+    一時的なエラーはバックオフ付きで再試行する。
+    cache_keyを指定したリクエストは成功したレスポンスをTTL付きでキャッシュする。
+    """
+    def __init__(self, pool_size=16, max_retries=3, backoff_factor=0.5, cache=None):
+        # requestsのimportは重いため、クライアントを生成する時点で読み込む
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        self.session = requests.Session()
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET", "POST"]),
+            respect_retry_after_header=True
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.cache = cache
+
+    @staticmethod
+    def make_cache_key(namespace, *parts):
+        """
+        名前空間と正規化済みのリクエスト内容からコンテンツアドレス型のキーを作る
+        """
+        payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return namespace + ":" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _cached(self, cache_key, fetch):
+        if self.cache is not None and cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                tracing.current_span().increment("http_cache_hits")
+                return cached
+            tracing.current_span().increment("http_cache_misses")
+        data = fetch()
+        if self.cache is not None and cache_key is not None:
+            self.cache.set(cache_key, data)
+        return data
+
+    def get_json(self, url, params=None, timeout=60, cache_key=None):
+        def fetch():
+            response = self.session.get(url, params=params, timeout=timeout)
+            response.raise_for_status()
+            return response.json()
+        return self._cached(cache_key, fetch)
+
+    def post_json(self, url, payload, headers=None, timeout=30, cache_key=None):
+        def fetch():
+            response = self.session.post(url, headers=headers, json=payload, timeout=timeout)
+            response.raise_for_status()
+            return response.json()
+        return self._cached(cache_key, fetch)
+
+
+def get_http_client(cache_path=DEFAULT_HTTP_CACHE_PATH, cache_ttl=DEFAULT_HTTP_CACHE_TTL):
+    """
+    プロセス共通のHTTPClientを返す（レスポンスキャッシュ付き）。
+    """
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None:
+            cache = PersistentLRUCache(cache_path, max_entries=50000, memory_entries=512, ttl=cache_ttl)
+            _shared_client = HTTPClient(cache=cache)
+    return _shared_client
@@ -1,11 +1,78 @@
-from langchain.utilities import WikipediaAPIWrapper
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from agents.cache import PersistentLRUCache
+from agents.http_client import HTTPClient
+from agents.embedding_cache import normalize_text
+from agents.knowledge_snapshot import KnowledgeSnapshot, DEFAULT_SNAPSHOT_PATH
+from agents import tracing
+
+DEFAULT_KNOWLEDGE_CACHE_PATH = "./data/cache/knowledge.sqlite3"
+DEFAULT_KNOWLEDGE_CACHE_TTL = 30 * 24 * 60 * 60
+KNOWLEDGE_BACKENDS = ("wikipedia", "snapshot", "snapshot_then_wikipedia")
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_knowledge_cache(path=DEFAULT_KNOWLEDGE_CACHE_PATH):
+    """
+    プロセス共通の知識検索キャッシュ（TTL付き）を返す。
+    """
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None or _shared_cache.path != path:
+            _shared_cache = PersistentLRUCache(path, max_entries=50000, ttl=DEFAULT_KNOWLEDGE_CACHE_TTL)
+    return _shared_cache
+
 
 class KnowledgeSearcher:
     """
     Wikipedia検索を使った知識検索エージェント
+    検索結果はバックエンド・言語・正規化済みクエリをキーとしてTTL付きで永続キャッシュする。
+    backend:
+        "wikipedia": WikipediaAPIWrapperでオンライン検索する（既定）
+        "snapshot": ローカルの知識スナップショット（SQLite FTS）のみを使う（オフライン）
+        "snapshot_then_wikipedia": スナップショットになければWikipediaを検索する
+    wikiを指定した場合はWikipediaAPIWrapperの代わりに使う（run(query)を持つオブジェクト）。
     """
-    def __init__(self, lang="ja"):
-        self.wiki = WikipediaAPIWrapper(lang=lang)
+    def __init__(self, lang="ja", backend="wikipedia", cache=None, use_cache=True,
+                 snapshot_path=DEFAULT_SNAPSHOT_PATH, prefetch_workers=8, wiki=None):
+        if backend not in KNOWLEDGE_BACKENDS:
+            raise ValueError(f"未対応のbackendです: {backend}")
+        self.lang = lang
+        self.backend = backend
+        self.prefetch_workers = prefetch_workers
+        if cache is None and use_cache:
+            cache = get_knowledge_cache()
+        self.cache = cache
+        self.wiki = wiki
+        self._wiki_lock = threading.Lock()
+        self.snapshot = KnowledgeSnapshot(snapshot_path) if backend != "wikipedia" else None
+
+    def make_cache_key(self, query):
+        return HTTPClient.make_cache_key("knowledge", self.backend, self.lang, normalize_text(query))
+
+    def get_wiki(self):
+        """
+        WikipediaAPIWrapperを初回の検索時に生成する（langchainのimportに時間がかかるため）。
+        """
+        if self.wiki is None:
+            with self._wiki_lock:
+                if self.wiki is None:
+                    from langchain.utilities import WikipediaAPIWrapper
+                    self.wiki = WikipediaAPIWrapper(lang=self.lang)
+        return self.wiki
+
+    def _fetch(self, query):
+        if self.snapshot is not None:
+            documents = self.snapshot.search(query, lang=self.lang)
+            if documents or self.backend == "snapshot":
+                return [{"title": document["title"], "summary": document["summary"]} for document in documents]
+        result = self.get_wiki().run(query)
+        return [{
+            "title": query,
+            "summary": result,
+        }]
 
     def search(self, query):
         """
@@ -13,11 +80,49 @@ class KnowledgeSearcher:
         Args:
             query (str): 検索クエリ
         Returns:
-            list: 検索結果リスト（タイトル・要約・URL）
+            list: 検索結果リスト（タイトル・要約）
         """
-        result = self.wiki.run(query)
-        url = f"https://{self.wiki.lang}.wikipedia.org/wiki/{query.replace(' ', '_')}"
-        return [{
-            "title": query,
-            "summary": result,
-        }]
+        with tracing.span("knowledge.search", backend=self.backend) as span:
+            cache_key = self.make_cache_key(query)
+            if self.cache is not None:
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    span.increment("knowledge_cache_hits")
+                    return cached
+                span.increment("knowledge_cache_misses")
+            result = self._fetch(query)
+            if self.cache is not None:
+                self.cache.set(cache_key, result)
+            return result
+
+    def prefetch(self, queries):
+        """
+        複数のクエリ（疾患名など）をまとめて検索してキャッシュに載せる。
+        キャッシュ済み・重複したクエリは検索せず、残りを並行して取得する。
+        Returns:
+            int: 新たに取得した件数
+        """
+        if self.cache is None:
+            # キャッシュがない場合は先読みしても再利用されない
+            return 0
+        pending = {}
+        for query in queries:
+            if query:
+                pending.setdefault(self.make_cache_key(query), query)
+        cached = self.cache.get_many(list(pending))
+        pending = {key: query for key, query in pending.items() if key not in cached}
+        if not pending:
+            return 0
+
+        def fetch(query):
+            try:
+                return self.search(query)
+            except Exception as e:
+                print(f"[KnowledgeSearcher] {query} の先読み失敗: {e}")
+                return None
+
+        with tracing.span("knowledge.prefetch", queries=len(pending)), \
+                ThreadPoolExecutor(max_workers=max(1, min(self.prefetch_workers, len(pending))),
+                                   thread_name_prefix="knowledge-prefetch") as executor:
+            fetched = list(executor.map(tracing.bind_context(fetch), pending.values()))
+        return sum(1 for result in fetched if result is not None)
@@ -0,0 +1,108 @@
+import os
+import re
+import sqlite3
+import threading
+from agents.embedding_cache import normalize_text
+
+DEFAULT_SNAPSHOT_PATH = os.path.join(os.path.dirname(__file__), '../data/knowledge_snapshot.sqlite3')
+# 日本語は空白で区切られないため、語の分割に依存しない文字trigramで索引する
+DEFAULT_SNAPSHOT_TOKENIZE = "trigram"
+
+
+class KnowledgeSnapshot:
+    """
+    Wikipediaの要約ダンプなどから作るオフラインの知識スナップショット。
+    documentsテーブル（title, summary, url, lang）をSQLite FTS5で全文索引し、
+    タイトルの完全一致 → クエリの全語を含む文書のBM25順の全文検索（タイトルを重視）の順に要約を返す。
+    "syndrome" などの共通の語だけが一致する別の疾患の記事は返さない。
+    tokenizeはFTS5のトークナイザで、作成時のみ使われる（既存のスナップショットは作成時のトークナイザで検索する）。
+    """
+    def __init__(self, path=DEFAULT_SNAPSHOT_PATH, tokenize=DEFAULT_SNAPSHOT_TOKENIZE):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "id INTEGER PRIMARY KEY, title TEXT NOT NULL, title_key TEXT NOT NULL, "
+            "summary TEXT NOT NULL, url TEXT, lang TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS documents_title ON documents (lang, title_key)")
+        self._conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5("
+            f"title, summary, content='documents', content_rowid='id', tokenize='{tokenize}')"
+        )
+        self._conn.commit()
+        created = self._conn.execute(
+            "SELECT sql FROM sqlite_master WHERE name = 'documents_fts'"
+        ).fetchone()[0]
+        self.trigram = "trigram" in created
+
+    def add_documents(self, documents, lang="ja"):
+        """
+        文書を追加する。documents は {"title", "summary", "url"(任意)} の辞書のイテラブル。
+        Returns:
+            int: 追加した件数
+        """
+        count = 0
+        with self._lock:
+            for document in documents:
+                if not document.get("title") or not document.get("summary"):
+                    continue
+                cursor = self._conn.execute(
+                    "INSERT INTO documents (title, title_key, summary, url, lang) VALUES (?, ?, ?, ?, ?)",
+                    (document["title"], normalize_text(document["title"]), document["summary"],
+                     document.get("url"), lang)
+                )
+                self._conn.execute(
+                    "INSERT INTO documents_fts (rowid, title, summary) VALUES (?, ?, ?)",
+                    (cursor.lastrowid, document["title"], document["summary"])
+                )
+                count += 1
+            self._conn.commit()
+        return count
+
+    def optimize(self):
+        with self._lock:
+            self._conn.execute("INSERT INTO documents_fts (documents_fts) VALUES ('optimize')")
+            self._conn.commit()
+
+    def _match_expression(self, query):
+        # FTS5の構文として解釈されないよう各語を引用符で囲み、すべての語を含む文書のみ一致させる（AND）。
+        # trigramのトークナイザでは3文字未満の語は一致しないため除く
+        tokens = re.findall(r"\w+", query)
+        if self.trigram:
+            tokens = [token for token in tokens if len(token) >= 3]
+        return " AND ".join('"' + token + '"' for token in tokens)
+
+    def search(self, query, lang="ja", top_k=1):
+        """
+        クエリに最も関連する文書を返す。
+        Returns:
+            list: [{"title", "summary", "url"}, ...]（見つからなければ空リスト）
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT title, summary, url FROM documents WHERE lang = ? AND title_key = ? LIMIT ?",
+                (lang, normalize_text(query), top_k)
+            ).fetchall()
+            expression = self._match_expression(query)
+            if len(rows) < top_k and expression:
+                rows += self._conn.execute(
+                    "SELECT d.title, d.summary, d.url FROM documents_fts "
+                    "JOIN documents d ON d.id = documents_fts.rowid "
+                    "WHERE documents_fts MATCH ? AND d.lang = ? "
+                    "ORDER BY bm25(documents_fts, 10.0, 1.0) LIMIT ?",
+                    (expression, lang, top_k - len(rows))
+                ).fetchall()
+        return [{"title": title, "summary": summary, "url": url} for title, summary, url in rows]
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,200 @@
+import re
+import math
+import unicodedata
+import numpy as np
+
+DEFAULT_LEXICAL_THRESHOLD = 0.85
+# ファジー一致の候補とする最小のDice係数（閾値未満でも上位k件を返す際の下限）
+MIN_FUZZY_SCORE = 0.5
+# prefix filterで候補1件のtrigramを照合するコスト（転置リスト1件の集計に対する相対値）
+PREFIX_COST = 1.0
+# 数字に揃えるローマ数字（"TYPE II" と "type 2" を同一視する）
+ROMAN_NUMERALS = {
+    "ii": "2", "iii": "3", "iv": "4", "v": "5", "vi": "6", "vii": "7", "viii": "8", "ix": "9", "x": "10",
+    "xi": "11", "xii": "12", "xiii": "13", "xiv": "14", "xv": "15", "xvi": "16", "xvii": "17",
+    "xviii": "18", "xix": "19", "xx": "20"
+}
+# 直後の "I" を1とみなす語（単独の "i" は英語の語としても現れるため）
+NUMBERED_WORDS = ("type", "group", "class", "grade", "complementation")
+
+
+def fold(text):
+    """
+    照合用に病名を正規化する（NFKC・大文字小文字の統一・記号の除去・ローマ数字を数字に）。
+    """
+    text = unicodedata.normalize("NFKC", text).casefold()
+    tokens = re.sub(r"[^\w]+", " ", text).split()
+    folded = []
+    for i, token in enumerate(tokens):
+        if token in ROMAN_NUMERALS:
+            token = ROMAN_NUMERALS[token]
+        elif token == "i" and i > 0 and tokens[i - 1] in NUMBERED_WORDS:
+            token = "1"
+        elif (i == len(tokens) - 1 or tokens[i - 1] in NUMBERED_WORDS) and i > 0 and len(token) > 1 \
+                and token[-1] in "abcd" and (token[:-1] == "i" or token[:-1] in ROMAN_NUMERALS):
+            # "TYPE IIIA" → "type 3a", "GLYCOGEN STORAGE DISEASE Ib" → "glycogen storage disease 1b"
+            token = ROMAN_NUMERALS.get(token[:-1], "1") + token[-1]
+        folded.append(token)
+    return " ".join(folded)
+
+
+def label_synonyms(label):
+    """
+    OMIMの病名ラベルから照合用の表記を返す。
+    "NAME, SUBTYPE; ABBREV" 形式のラベルは、ラベル全体・名称部分・略称をそれぞれ表記とする。
+    ";;" で区切られた別名もそれぞれ名称とする。
+    Returns:
+        tuple: (名称のリスト, 略称のリスト)
+    """
+    names = []
+    abbreviations = []
+    for title in label.split(";;"):
+        name, *symbols = [part.strip() for part in title.split(";")]
+        if name:
+            names.append(name)
+        abbreviations.extend(symbol for symbol in symbols if symbol)
+    if label.strip() and label.strip() not in names:
+        names.insert(0, label.strip())
+    return names, abbreviations
+
+
+def subtype_tokens(folded):
+    """
+    病型を区別する語（数字を含む語と1文字の語。"ataxia 3", "type 2a", "type a" など）を並べたタプルを返す。
+    これらが異なる病名はtrigramが大きく重なっても別の疾患であるため、ファジー一致ではこれが一致することを条件にする。
+    """
+    return tuple(sorted(
+        token for token in folded.split() if len(token) == 1 or any(c.isdigit() for c in token)
+    ))
+
+
+def trigrams(folded):
+    padded = f"  {folded} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class LexicalIndex:
+    """
+    OMIMの病名ラベルに対する字句インデックス。embeddingを使わずに疾患名を照合する。
+    - 完全一致: 正規化した名称・略称のハッシュ検索（略称は1疾患に特定できる場合のみ）
+    - ファジー一致: 文字trigramの転置インデックスで候補を集め、Dice係数で順位付けする
+      （病型を表す数字・記号（subtype_tokens）が一致する名称のみ。"SCA13" を "SCA3" に一致させない）
+    """
+    def __init__(self, labels):
+        self.exact = {}
+        abbreviation_owners = {}
+        keys = []
+        key_owners = []
+        for i, label in enumerate(labels):
+            names, abbreviations = label_synonyms(label)
+            for name in names:
+                key = fold(name)
+                if not key:
+                    continue
+                self.exact.setdefault(key, i)
+                keys.append(key)
+                key_owners.append(i)
+            for abbreviation in abbreviations:
+                key = fold(abbreviation)
+                if key:
+                    abbreviation_owners.setdefault(key, set()).add(i)
+        for key, owners in abbreviation_owners.items():
+            if len(owners) == 1 and key not in self.exact:
+                self.exact[key] = next(iter(owners))
+
+        # 名称ごとのtrigram（番号に変換してソート）をCSR形式で、trigramごとの名称を転置リストで持つ
+        self.subtype_ids = {}
+        self.key_subtypes = np.asarray(
+            [self.subtype_ids.setdefault(subtype_tokens(key), len(self.subtype_ids)) for key in keys], dtype=np.int64
+        )
+        self.gram_ids = {}
+        key_grams = []
+        offsets = [0]
+        postings = []
+        for key_id, key in enumerate(keys):
+            ids = sorted({self.gram_ids.setdefault(gram, len(self.gram_ids)) for gram in trigrams(key)})
+            for gram_id in ids:
+                if gram_id == len(postings):
+                    postings.append([])
+                postings[gram_id].append(key_id)
+            key_grams.extend(ids)
+            offsets.append(len(key_grams))
+        self.postings = [np.asarray(ids, dtype=np.int32) for ids in postings]
+        self.key_grams = np.asarray(key_grams, dtype=np.int32)
+        self.key_offsets = np.asarray(offsets, dtype=np.int64)
+        self.key_owners = np.asarray(key_owners, dtype=np.int64)
+        self.posting_sizes = np.asarray([len(ids) for ids in postings], dtype=np.int64)
+        self.mean_key_grams = len(key_grams) / max(1, len(keys))
+
+    def __len__(self):
+        return len(self.key_owners)
+
+    def lookup(self, name, k=1, min_score=MIN_FUZZY_SCORE):
+        """
+        疾患名に一致するラベルを返す。ファジー一致はDice係数がmin_score以上のもののみ返す。
+        Returns:
+            list: [(ラベルの番号, スコア（完全一致は1.0、ファジー一致はDice係数）, "exact"/"fuzzy"), ...]
+        """
+        key = fold(name)
+        if not key:
+            return []
+        exact = self.exact.get(key)
+        if exact is not None and k == 1:
+            return [(exact, 1.0, "exact")]
+        matches = [(exact, 1.0, "exact")] if exact is not None else []
+        for index, score in self.fuzzy(key, k, min_score):
+            if index != exact and len(matches) < k:
+                matches.append((index, score, "fuzzy"))
+        return matches
+
+    def fuzzy(self, key, k=1, min_score=MIN_FUZZY_SCORE):
+        """
+        正規化済みの名称keyに対し、trigramのDice係数がmin_score以上のラベルを上位k件返す。
+        Dice係数がmin_score以上になるには一定数以上のtrigramを共有する必要があるため、
+        出現頻度の低いtrigramから必要な数だけを使って候補を絞り込み（prefix filter）、候補についてのみ重なりを数える。
+        """
+        subtype = self.subtype_ids.get(subtype_tokens(key))
+        if subtype is None:
+            return []
+        grams = trigrams(key)
+        query = np.fromiter((self.gram_ids[gram] for gram in grams if gram in self.gram_ids), dtype=np.int64)
+        min_overlap = max(1, math.ceil(min_score * len(grams) / (2 - min_score)))
+        prefix = len(query) - min_overlap + 1
+        if prefix <= 0:
+            return []
+        posting_sizes = self.posting_sizes[query]
+        order = np.argsort(posting_sizes, kind="stable")
+        query = query[order]
+        posting_sizes = posting_sizes[order]
+        prefix_cost = posting_sizes[:prefix].sum() * self.mean_key_grams * PREFIX_COST
+        if prefix_cost < posting_sizes.sum() + len(self.key_owners):
+            candidates = np.unique(np.concatenate([self.postings[gram_id] for gram_id in query[:prefix]]))
+            starts = self.key_offsets[candidates]
+            lengths = self.key_offsets[candidates + 1] - starts
+            # 候補の名称のtrigramを連結して取り出し、クエリのtrigramと一致する数を名称ごとに合計する
+            positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            in_query = np.zeros(len(self.postings), dtype=bool)
+            in_query[query] = True
+            member = in_query[self.key_grams[positions]]
+            overlaps = np.add.reduceat(member.astype(np.int32), np.cumsum(lengths) - lengths)
+        else:
+            # 頻出するtrigramばかりで候補を絞り込めない場合は、全trigramの転置リストから重なりを直接数える
+            counts = np.bincount(np.concatenate([self.postings[gram_id] for gram_id in query]),
+                                 minlength=len(self.key_owners))
+            candidates = np.flatnonzero(counts)
+            overlaps = counts[candidates]
+            lengths = self.key_offsets[candidates + 1] - self.key_offsets[candidates]
+        scores = 2.0 * overlaps / (len(grams) + lengths)
+        passing = np.flatnonzero((scores >= min_score) & (self.key_subtypes[candidates] == subtype))
+        results = []
+        seen = set()
+        for position in passing[np.argsort(-scores[passing], kind="stable")]:
+            score = float(scores[position])
+            owner = int(self.key_owners[candidates[position]])
+            if owner in seen:
+                continue
+            seen.add(owner)
+            results.append((owner, score))
+            if len(results) >= k:
+                break
+        return results
@@ -0,0 +1,273 @@
+import os
+import time
+import heapq
+import random
+import itertools
+import threading
+from agents.rate_limiter import TokenBucket
+from agents import tracing
+
+DEFAULT_GENERATION_MODEL = "gemini-2.5-flash"
+
+# 優先度レーン（値が小さいほど優先される）
+PRIORITY_REFLECTION = 0
+PRIORITY_REPORT = 1
+PRIORITY_CANDIDATES = 2
+PRIORITY_EMBEDDING = 3
+
+# 生成呼び出しで出力分として事前に確保するトークン数
+_OUTPUT_TOKEN_RESERVE = 1024
+
+_shared_gateway = None
+_shared_gateway_lock = threading.Lock()
+
+
+def _genai():
+    """
+    google.generativeaiを初回の呼び出し時にimportする（importに数秒かかるため起動時には読み込まない）。
+    """
+    import google.generativeai as genai
+    return genai
+
+
+def estimate_tokens(content):
+    """
+    文字数からトークン数を概算する（約4文字で1トークン）。
+    """
+    if isinstance(content, (list, tuple)):
+        return sum(estimate_tokens(item) for item in content)
+    return max(1, len(str(content)) // 4)
+
+
+def is_rate_limit_error(error):
+    """
+    Gemini APIのクォータ超過（HTTP 429 / ResourceExhausted）かどうかを判定する。
+    """
+    if type(error).__name__ in ("ResourceExhausted", "TooManyRequests"):
+        return True
+    # メッセージ中の"429"（トークン数やIDの一部など）では判定しない
+    return getattr(error, "code", None) == 429 or getattr(error, "status_code", None) == 429
+
+
+def is_transient_error(error):
+    """
+    再試行で回復し得る一時的なエラー（5xx・タイムアウト）かどうかを判定する。
+    """
+    return type(error).__name__ in (
+        "ServiceUnavailable", "InternalServerError", "DeadlineExceeded", "GatewayTimeout"
+    )
+
+
+class LLMGateway:
+    """
+    Gemini API呼び出しを一元管理するゲートウェイ。
+    - genai.configureとGenerativeModelの生成を一度だけ行う
+    - 1分あたりのリクエスト数・トークン数をトークンバケットで制限する
+    - 待機中の呼び出しは優先度レーン順（自己評価 > レポート > 候補生成 > embedding）に実行する
+    - 429を受けた場合は指数バックオフで再試行し、リクエスト速度を一時的に下げる
+    """
+    def __init__(self, api_key=None, requests_per_minute=60, tokens_per_minute=1000000,
+                 max_retries=5, base_backoff=2.0, max_backoff=60.0):
+        self.api_key = api_key or os.getenv("GOOGLE_API_KEY")
+        self.requests_per_minute = requests_per_minute
+        self.current_requests_per_minute = requests_per_minute
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._models = {}
+        self._configured = False
+        self._lock = threading.Lock()
+        self._queue = []
+        self._queue_cond = threading.Condition()
+        self._sequence = itertools.count()
+
+    def _configure(self):
+        with self._lock:
+            if not self._configured:
+                # APIキーは実際にGeminiを呼び出す時点で確認する（字句一致やキャッシュのみで済む処理では不要）
+                if not self.api_key:
+                    raise ValueError("環境変数 'GOOGLE_API_KEY' が設定されていません。")
+                _genai().configure(api_key=self.api_key)
+                self._configured = True
+
+    def get_model(self, model_name=DEFAULT_GENERATION_MODEL):
+        self._configure()
+        with self._lock:
+            model = self._models.get(model_name)
+            if model is None:
+                model = _genai().GenerativeModel(model_name)
+                self._models[model_name] = model
+        return model
+
+    def _admit(self, priority, tokens):
+        """
+        優先度順に並び、リクエスト数とトークン数の両方の枠が空くまで待つ。
+        """
+        ticket = (priority, next(self._sequence))
+        with self._queue_cond:
+            heapq.heappush(self._queue, ticket)
+            try:
+                while True:
+                    if self._queue[0] == ticket:
+                        wait = max(self.request_bucket.wait_time(1), self.token_bucket.wait_time(tokens))
+                        if wait <= 0:
+                            self.request_bucket.consume(1)
+                            self.token_bucket.consume(min(tokens, self.token_bucket.capacity))
+                            return
+                    else:
+                        wait = None
+                    self._queue_cond.wait(timeout=wait)
+            finally:
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+                self._queue_cond.notify_all()
+
+    def _on_rate_limited(self):
+        with self._lock:
+            self.current_requests_per_minute = max(1.0, self.current_requests_per_minute / 2)
+            self.request_bucket.set_rate(self.current_requests_per_minute)
+
+    def _on_success(self):
+        with self._lock:
+            if self.current_requests_per_minute < self.requests_per_minute:
+                self.current_requests_per_minute = min(
+                    self.requests_per_minute, self.current_requests_per_minute + 1
+                )
+                self.request_bucket.set_rate(self.current_requests_per_minute)
+
+    def _backoff(self, attempt):
+        delay = min(self.max_backoff, self.base_backoff * (2 ** attempt))
+        time.sleep(delay * (0.5 + random.random() / 2))
+
+    def call(self, func, priority, estimated_tokens, span=None):
+        """
+        レート制限と429時の再試行のもとでfuncを実行する。
+        再試行回数を超えた場合は最後の例外をそのまま送出する。
+        spanを省略した場合は現在のspanに待ち時間と再試行回数を記録する。
+        """
+        span = span or tracing.current_span()
+        for attempt in range(self.max_retries + 1):
+            admit_started = time.perf_counter()
+            self._admit(priority, estimated_tokens)
+            span.increment("queue_wait_ms", (time.perf_counter() - admit_started) * 1000)
+            try:
+                result = func()
+            except Exception as e:
+                rate_limited = is_rate_limit_error(e)
+                if rate_limited:
+                    self._on_rate_limited()
+                if attempt >= self.max_retries or not (rate_limited or is_transient_error(e)):
+                    raise
+                span.increment("retries")
+                print(f"[LLMGateway] 再試行します ({attempt + 1}/{self.max_retries}): {e}")
+                self._backoff(attempt)
+                continue
+            self._on_success()
+            return result
+
+    @staticmethod
+    def _record_usage(span, usage, prompt):
+        """
+        usage_metadataのトークン数をspanに記録する（取得できない場合は概算値）。
+        """
+        span.set(
+            prompt_tokens=getattr(usage, "prompt_token_count", None) or estimate_tokens(prompt),
+            response_tokens=getattr(usage, "candidates_token_count", None) or 0,
+            # 暗黙のプロンプトキャッシュ（共通の接頭辞）で処理されたトークン数
+            cached_prompt_tokens=getattr(usage, "cached_content_token_count", None) or 0
+        )
+
+    def generate(self, prompt, model=DEFAULT_GENERATION_MODEL, priority=PRIORITY_REPORT, timeout=None):
+        """
+        テキストを生成して返す。timeout（秒）を指定した場合は1回のAPI呼び出しをその時間で打ち切る。
+        """
+        with tracing.span("llm.generate", model=model, priority=priority) as span:
+            gemini_model = self.get_model(model)
+            estimated = estimate_tokens(prompt) + _OUTPUT_TOKEN_RESERVE
+            request_options = {"timeout": timeout} if timeout is not None else None
+            response = self.call(
+                lambda: gemini_model.generate_content(prompt, request_options=request_options), priority, estimated
+            )
+            usage = getattr(response, "usage_metadata", None)
+            self._record_usage(span, usage, prompt)
+            actual = getattr(usage, "total_token_count", None)
+            if actual:
+                # 実際の使用トークン数との差を精算する
+                self.token_bucket.consume(actual - estimated)
+            return response.text
+
+    def generate_stream(self, prompt, model=DEFAULT_GENERATION_MODEL, priority=PRIORITY_REPORT):
+        """
+        テキストをストリーミングで生成し、受信した断片を順に返すジェネレータ。
+        レート制限と再試行は最初の応答を受け取るまでに適用する（途中で失敗した場合は例外を送出する）。
+        """
+        # 受信は呼び出し側（別スレッドのこともある）で進むため、spanは現在のspanにせず受信完了まで開いておく
+        span = tracing.open_span("llm.generate_stream", model=model, priority=priority)
+        started = time.perf_counter()
+        try:
+            gemini_model = self.get_model(model)
+            estimated = estimate_tokens(prompt) + _OUTPUT_TOKEN_RESERVE
+            response = self.call(
+                lambda: gemini_model.generate_content(prompt, stream=True), priority, estimated, span=span
+            )
+            usage = None
+            first_chunk = True
+            for chunk in response:
+                if first_chunk:
+                    span.set(first_chunk_ms=(time.perf_counter() - started) * 1000)
+                    first_chunk = False
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # 本文を含まない断片（終了理由のみなど）は読み飛ばす
+                    continue
+                if text:
+                    yield text
+            self._record_usage(span, usage, prompt)
+            actual = getattr(usage, "total_token_count", None)
+            if actual:
+                self.token_bucket.consume(actual - estimated)
+        except GeneratorExit:
+            # 呼び出し側が受信を途中で打ち切った
+            span.set(cancelled=True)
+            raise
+        except BaseException as e:
+            span.record_error(e)
+            raise
+        finally:
+            span.end()
+
+    def embed(self, content, model, task_type, priority=PRIORITY_EMBEDDING):
+        """
+        genai.embed_contentを呼び出し、結果をそのまま返す。
+        """
+        with tracing.span("llm.embed", model=model, task_type=task_type) as span:
+            self._configure()
+            estimated = estimate_tokens(content)
+            span.set(prompt_tokens=estimated, texts=len(content) if isinstance(content, (list, tuple)) else 1)
+            return self.call(
+                lambda: self._embed_content(model, content, task_type),
+                priority,
+                estimated
+            )
+
+    def _embed_content(self, model, content, task_type):
+        return _genai().embed_content(model=model, content=content, task_type=task_type)
+
+
+def get_llm_gateway():
+    """
+    プロセス共通のLLMGatewayを返す。
+    レートは環境変数 GEMINI_REQUESTS_PER_MINUTE / GEMINI_TOKENS_PER_MINUTE で設定できる。
+    """
+    global _shared_gateway
+    with _shared_gateway_lock:
+        if _shared_gateway is None:
+            _shared_gateway = LLMGateway(
+                requests_per_minute=float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "60")),
+                tokens_per_minute=float(os.getenv("GEMINI_TOKENS_PER_MINUTE", "1000000"))
+            )
+    return _shared_gateway
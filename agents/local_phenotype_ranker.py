@@ -0,0 +1,181 @@
+import os
+import threading
+import numpy as np
+from scipy import sparse
+from agents.hpo_ontology import load_hpo_ontology, DEFAULT_HPO_PATH
+
+DEFAULT_HPOA_PATH = os.path.join(os.path.dirname(__file__), '../data/HPO_matching/phenotype.hpoa')
+
+_ranker_cache = {}
+_ranker_lock = threading.Lock()
+
+
+def load_hpoa_annotations(hpoa_path, databases=("OMIM",)):
+    """
+    phenotype.hpoaから表現型アノテーション（aspect=P, NOT以外）を読み込む。
+    Returns:
+        tuple: ({疾患ID: HPO IDリスト}, {疾患ID: 疾患名})
+    """
+    annotations = {}
+    names = {}
+    with open(hpoa_path, encoding='utf-8') as f:
+        header = None
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if header is None:
+                header = {name: i for i, name in enumerate(fields)}
+                continue
+            disease_id = fields[header["database_id"]]
+            if databases and disease_id.split(':')[0] not in databases:
+                continue
+            if fields[header["aspect"]] != "P" or fields[header["qualifier"]] == "NOT":
+                continue
+            annotations.setdefault(disease_id, []).append(fields[header["hpo_id"]])
+            names[disease_id] = fields[header["disease_name"]]
+    return annotations, names
+
+
+class LocalPhenotypeRanker:
+    """
+    phenotype.hpoaから疾患×HPOタームの疎行列を構築し、患者のHPOセットに対して
+    全疾患をローカルでスコアリングするランカー（PubCaseFinder APIの代替）。
+    アノテーションは祖先タームへ伝播させ、疾患アノテーション頻度に基づくICで重み付けする。
+    method:
+        "ic_overlap": 共通タームのIC合計をIC加重ノルムで正規化したスコア（行列積1回）
+        "bma": 患者タームごとのResnik最良一致の平均（best-match-average）
+    """
+    def __init__(self, ontology=None, hpoa_path=DEFAULT_HPOA_PATH, databases=("OMIM",), method="ic_overlap"):
+        if method not in ("ic_overlap", "bma"):
+            raise ValueError(f"未対応のmethodです: {method}")
+        self.ontology = ontology or load_hpo_ontology()
+        self.method = method
+        annotations, names = load_hpoa_annotations(hpoa_path, databases)
+        self.disease_ids = sorted(annotations)
+        self.disease_names = [names[disease_id] for disease_id in self.disease_ids]
+        self.information_content = self.ontology.annotation_information_content(annotations)
+
+        rows, cols = [], []
+        for row, disease_id in enumerate(self.disease_ids):
+            terms = self._propagate(self.ontology.indices(annotations[disease_id]))
+            rows.append(np.full(len(terms), row, dtype=np.int32))
+            cols.append(terms)
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int32)
+        cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int32)
+        shape = (len(self.disease_ids), len(self.ontology))
+        # 伝播済みの二値行列
+        self.annotation_matrix = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=shape
+        )
+        # sqrt(IC)で重み付けし行ごとにL2正規化した行列（内積 = 共通タームのIC合計 / ノルム積）
+        weights = np.sqrt(self.information_content)
+        weighted = self.annotation_matrix.multiply(weights[None, :]).tocsr()
+        norms = np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        self.weighted_matrix = sparse.diags(1.0 / norms).dot(weighted).tocsr().astype(np.float32)
+        self.annotation_matrix_csc = self.annotation_matrix.tocsc()
+
+    def _propagate(self, term_indices):
+        if len(term_indices) == 0:
+            return np.zeros(0, dtype=np.int32)
+        return np.unique(np.concatenate([self.ontology.ancestors_of(i) for i in term_indices]))
+
+    def _query_matrix(self, hpo_lists):
+        """
+        患者ごとの伝播済みHPOセットを、sqrt(IC)重み・L2正規化した疎行列 (患者数, N) に変換する
+        """
+        weights = np.sqrt(self.information_content)
+        rows, cols, values = [], [], []
+        for row, hpo_list in enumerate(hpo_lists):
+            terms = self._propagate(self.ontology.indices(hpo_list))
+            term_weights = weights[terms]
+            norm = np.linalg.norm(term_weights)
+            rows.append(np.full(len(terms), row, dtype=np.int32))
+            cols.append(terms)
+            values.append(term_weights / norm if norm > 0 else term_weights)
+        return sparse.csr_matrix(
+            (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(len(hpo_lists), len(self.ontology)),
+            dtype=np.float32
+        )
+
+    def _bma_scores(self, hpo_lists):
+        """
+        患者タームごとに各疾患とのResnik類似度（最も情報量の多い共通祖先のIC）を求め、
+        患者タームにわたって平均する。同じタームの計算結果はバッチ内で再利用する。
+        """
+        scores = np.zeros((len(hpo_lists), len(self.disease_ids)), dtype=np.float32)
+        term_cache = {}
+        for row, hpo_list in enumerate(hpo_lists):
+            term_indices = np.unique(self.ontology.indices(hpo_list))
+            if len(term_indices) == 0:
+                continue
+            for i in term_indices:
+                best = term_cache.get(int(i))
+                if best is None:
+                    ancestors = self.ontology.ancestors_of(i)
+                    columns = self.annotation_matrix_csc[:, ancestors].multiply(
+                        self.information_content[ancestors][None, :]
+                    )
+                    best = np.asarray(columns.max(axis=1).todense()).ravel().astype(np.float32)
+                    term_cache[int(i)] = best
+                scores[row] += best
+            scores[row] /= len(term_indices)
+        return scores
+
+    def score_many(self, hpo_lists):
+        """
+        複数患者を一括でスコアリングし、(患者数, 疾患数) のスコア行列を返す。
+        """
+        hpo_lists = [list(hpo_list) for hpo_list in hpo_lists]
+        if not hpo_lists:
+            return np.zeros((0, len(self.disease_ids)), dtype=np.float32)
+        if self.method == "bma":
+            return self._bma_scores(hpo_lists)
+        query = self._query_matrix(hpo_lists)
+        return np.asarray(query.dot(self.weighted_matrix.T).todense(), dtype=np.float32)
+
+    def rank_many(self, hpo_lists, top_k=5):
+        """
+        複数患者の上位top_k件の疾患を、PubCaseFinderと同じ形式の辞書リストで返す。
+        Returns:
+            list: 患者ごとの [{omim_disease_name_en, description, score}, ...]
+        """
+        scores = self.score_many(hpo_lists)
+        results = []
+        k = min(top_k, len(self.disease_ids))
+        for row in scores:
+            if k == 0:
+                results.append([])
+                continue
+            top = np.argpartition(-row, k - 1)[:k]
+            top = top[np.argsort(-row[top], kind="stable")]
+            results.append([
+                {
+                    "omim_disease_name_en": self.disease_names[i],
+                    "description": f"{self.disease_ids[i]} (local HPO annotation match)",
+                    "score": float(row[i])
+                }
+                for i in top if row[i] > 0
+            ])
+        return results
+
+    def rank(self, hpo_list, top_k=5):
+        return self.rank_many([hpo_list], top_k=top_k)[0]
+
+
+def load_local_phenotype_ranker(hpoa_path=DEFAULT_HPOA_PATH, hpo_path=DEFAULT_HPO_PATH, method="ic_overlap"):
+    """
+    LocalPhenotypeRankerをプロセス内で一度だけ構築して共有する（スレッドセーフ）。
+    """
+    key = (os.path.abspath(hpoa_path), os.path.abspath(hpo_path), method)
+    ranker = _ranker_cache.get(key)
+    if ranker is not None:
+        return ranker
+    with _ranker_lock:
+        ranker = _ranker_cache.get(key)
+        if ranker is None:
+            ranker = LocalPhenotypeRanker(load_hpo_ontology(hpo_path), hpoa_path, method=method)
+            _ranker_cache[key] = ranker
+    return ranker
@@ -1,33 +1,65 @@
-import requests
 import os
-from time import sleep
 import re
-from agents.disease_normalizer import DiseaseNormalizer
-from agents.hpo_mapping import HPOMapping
+from concurrent.futures import ThreadPoolExecutor
+from agents.disease_normalizer import get_disease_normalizer
+from agents.hpo_mapping import HPOMapping, canonicalize_hpo_ids
+from agents.http_client import get_http_client
+from agents.llm_gateway import get_llm_gateway, PRIORITY_CANDIDATES
+from agents import tracing
+
+# PubCaseFinder APIとGemini APIそれぞれの呼び出しの既定のタイムアウト（秒）
+DEFAULT_ANALYZER_TIMEOUT = 60
 
 class PhenotypeAnalyzer:
     """
     HPOリストから診断候補を生成するエージェント。
     PubCaseFinder API（GET）とGemini API（LLMゼロショット）を併用。
     """
-    def __init__(self, gemini_api_key=None):
+    def __init__(self, gemini_api_key=None, disease_normalizer=None, hpo_mapper=None, http_client=None,
+                 llm_gateway=None, local_ranker=None, timeout=DEFAULT_ANALYZER_TIMEOUT):
         self.gemini_api_key = gemini_api_key or os.getenv("GOOGLE_API_KEY")
-        self.hpo_mapper = HPOMapping()
+        self.llm_gateway = llm_gateway or get_llm_gateway()
+        self.api_url = "https://pubcasefinder.dbcls.jp/api/pcf_get_ranked_list"
+        self.http_client = http_client or get_http_client()
+        # 指定された場合はPubCaseFinder APIの代わりにローカルのランカー（LocalPhenotypeRanker）を使う
+        self.local_ranker = local_ranker
+        self.hpo_mapper = hpo_mapper or HPOMapping()
+        # 未指定の場合はプロセス共通のDiseaseNormalizerを初回利用時に取得する
+        self.disease_normalizer = disease_normalizer
+        # 外部APIの呼び出しを打ち切る時間（秒）。呼び出し側のタイムアウト後もスレッドを占有し続けないようにする
+        self.timeout = timeout
 
     def analyze_with_pubcasefinder(self, hpo_list):
         """
         PubCaseFinder APIで診断候補を取得し、必要な情報のみ抽出して返す。
+        HPOセットは正規化（ソート・重複除去）してから問い合わせ、レスポンスはキャッシュする。
+        local_rankerが設定されている場合はAPIを呼ばずにローカルでランキングする。
         Args:
             hpo_list (list): HPOタームリスト
         Returns:
             list: 上位5件の {omim_disease_name_en, description, score} のみのリスト
         """
-        hpo_ids = ",".join(hpo_list)
-        url = f"https://pubcasefinder.dbcls.jp/api/pcf_get_ranked_list?target=omim&format=json&hpo_id={hpo_ids}"
+        backend = "local" if self.local_ranker is not None else "pubcasefinder"
+        with tracing.span("phenotype.pubcasefinder", backend=backend) as span:
+            return self._analyze_with_pubcasefinder(hpo_list, span)
+
+    def _analyze_with_pubcasefinder(self, hpo_list, span):
+        if self.local_ranker is not None:
+            try:
+                return self.local_ranker.rank(canonicalize_hpo_ids(hpo_list), top_k=5)
+            except Exception as e:
+                span.record_error(e)
+                print(f"[PhenotypeAnalyzer] ローカルランキング失敗: {e}")
+                return []
+        hpo_ids = ",".join(canonicalize_hpo_ids(hpo_list))
+        params = {"target": "omim", "format": "json", "hpo_id": hpo_ids}
         try:
-            response = requests.get(url, timeout=60)
-            response.raise_for_status()
-            data = response.json()
+            data = self.http_client.get_json(
+                self.api_url,
+                params=params,
+                timeout=self.timeout,
+                cache_key=self.http_client.make_cache_key("pubcasefinder", params)
+            )
             # 上位5件のみ、必要なフィールドだけ抽出
             top5 = []
             for item in data[:5]:
@@ -38,6 +70,7 @@ class PhenotypeAnalyzer:
                 })
             return top5
         except Exception as e:
+            span.record_error(e)
             print(f"[PhenotypeAnalyzer] PubCaseFinder API失敗: {e}")
             return []
 
@@ -49,18 +82,17 @@ class PhenotypeAnalyzer:
         Returns:
             list: 診断候補リスト
         """
-        import google.generativeai as genai
-        genai.configure(api_key=self.gemini_api_key)
-        model = genai.GenerativeModel("gemini-2.5-flash")
         # hpoid→id:label
         hpo_id_label_list = self.hpo_mapper.convert(hpo_list)
         prompt = self._build_prompt(hpo_id_label_list)
-        try:
-            response = model.generate_content(prompt)
-            return response.text.split("\n")
-        except Exception as e:
-            print(f"[PhenotypeAnalyzer] Gemini API失敗: {e}")
-            return []
+        with tracing.span("phenotype.gemini") as span:
+            try:
+                text = self.llm_gateway.generate(prompt, priority=PRIORITY_CANDIDATES, timeout=self.timeout)
+                return text.split("\n")
+            except Exception as e:
+                span.record_error(e)
+                print(f"[PhenotypeAnalyzer] Gemini API失敗: {e}")
+                return []
 
     def _build_prompt(self, hpo_id_label_list):
         hpo_str = ", ".join(hpo_id_label_list)
@@ -96,10 +128,12 @@ class PhenotypeAnalyzer:
         return disease_names
 
     def normalize_gemini_diseases(self,gemini_disease_names):
-        normalizer = DiseaseNormalizer()
+        if self.disease_normalizer is None:
+            self.disease_normalizer = get_disease_normalizer()
+        normalizer = self.disease_normalizer
         normalized_list = []
-        for name in gemini_disease_names:
-            result = normalizer.normalize(name)
+        for matches in normalizer.normalize_many(gemini_disease_names, k=1):
+            result = matches[0] if matches else None
             if result and "id" in result and "name" in result:
                 normalized_list.append(
                     {
@@ -114,9 +148,13 @@ class PhenotypeAnalyzer:
         """
         PubCaseFinderとGemini両方の診断候補を統合して返す。
         Gemini出力は正規化用に疾患名リストも返す。
+        PubCaseFinderとGeminiは互いに独立しているため並行して呼び出す。
         """
-        pubcase_candidates = self.analyze_with_pubcasefinder(hpo_list)
-        gemini_candidates_raw = self.analyze_with_gemini(hpo_list)
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="phenotype-analyzer") as executor:
+            pubcase_future = executor.submit(tracing.bind_context(self.analyze_with_pubcasefinder), hpo_list)
+            gemini_future = executor.submit(tracing.bind_context(self.analyze_with_gemini), hpo_list)
+            pubcase_candidates = pubcase_future.result()
+            gemini_candidates_raw = gemini_future.result()
         gemini_disease_names = self.extract_disease_names_from_gemini(gemini_candidates_raw)
         gemini_candidates = self.normalize_gemini_diseases(gemini_disease_names)
         return {
@@ -0,0 +1,77 @@
+import time
+import threading
+
+
+class TokenBucket:
+    """
+    スレッドセーフなトークンバケット。
+    rate_per_minute の速度でトークンを補充し、最大 capacity 個まで貯められる。
+    """
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1.0, float(rate_per_minute))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate_per_second)
+        self.updated = now
+
+    def set_rate(self, rate_per_minute):
+        """
+        補充速度を変更する（適応的な流量制御用）。
+        """
+        with self._lock:
+            self._refill()
+            self.rate_per_second = rate_per_minute / 60.0
+
+    def consume(self, tokens):
+        """
+        待たずにトークンを消費する。残量は負（借り）になり得る。
+        負の値を渡すと返却となる（上限はcapacity）。
+        """
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - tokens)
+
+    def try_acquire(self, tokens=1):
+        """
+        トークンを取得できればTrue、足りなければ待たずにFalseを返す。
+        """
+        with self._lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def wait_time(self, tokens=1):
+        """
+        tokens個のトークンが貯まるまでの待ち時間（秒）を返す。
+        """
+        with self._lock:
+            self._refill()
+            missing = min(tokens, self.capacity) - self.tokens
+            if missing <= 0:
+                return 0.0
+            return missing / self.rate_per_second
+
+    def acquire(self, tokens=1, timeout=None):
+        """
+        トークンを取得できるまで待つ。timeout秒以内に取得できなければFalseを返す。
+        capacityを超える要求はcapacity分のトークンで許可する。
+        """
+        tokens = min(tokens, self.capacity)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self.try_acquire(tokens):
+                return True
+            wait = self.wait_time(tokens)
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(max(wait, 0.001))
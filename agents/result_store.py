@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from agents.hpo_mapping import canonicalize_hpo_ids
+
+DEFAULT_RESULT_STORE_PATH = "./data/results.sqlite3"
+# 2: 失敗を含む結果を保存しないようにした（それ以前に保存された結果は再利用しない）
+RESULT_STORE_FORMAT_VERSION = 2
+
+
+def hpo_set_key(hpo_list):
+    """
+    HPO IDリストを正規化（重複除去・ソート）した検索キーに変換する。
+    """
+    return ",".join(canonicalize_hpo_ids(hpo_list))
+
+
+def fingerprint(value):
+    """
+    設定などのJSONに変換できる値から、内容が同じなら同じになる指紋（sha256の先頭16桁）を作る。
+    """
+    text = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+class DiagnosisResultStore:
+    """
+    診断結果を保存するSQLiteのストア。
+    - runs: 1回の診断（run）の結果（根拠・レポート・自己評価・trace）と設定。HPOセットと設定の指紋で検索する
+    - evidence: 情報収集の結果（knowledge / cases / candidates）。HPOセットと情報収集に関わる設定の指紋で検索する
+    値はJSONで保存するため、sqlite3のJSON関数で設定ごとの比較などを直接集計できる。
+    """
+    def __init__(self, path=DEFAULT_RESULT_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            "id INTEGER PRIMARY KEY, hpo_key TEXT NOT NULL, fingerprint TEXT NOT NULL, "
+            "created REAL NOT NULL, config TEXT NOT NULL, result TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS runs_lookup ON runs (hpo_key, fingerprint, created)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS evidence ("
+            "hpo_key TEXT NOT NULL, fingerprint TEXT NOT NULL, created REAL NOT NULL, evidence TEXT NOT NULL, "
+            "PRIMARY KEY (hpo_key, fingerprint))"
+        )
+        self._conn.commit()
+
+    def save_run(self, hpo_list, run_fingerprint, config, result):
+        """
+        runの結果を追加する（同じキーの過去の結果も残す）。
+        Returns:
+            int: 保存した結果のID
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO runs (hpo_key, fingerprint, created, config, result) VALUES (?, ?, ?, ?, ?)",
+                (hpo_set_key(hpo_list), run_fingerprint, time.time(), _dumps(config), _dumps(result))
+            )
+            self._conn.commit()
+            return cursor.lastrowid
+
+    def latest_run(self, hpo_list, run_fingerprint, max_age=None):
+        """
+        同じHPOセット・設定の最新の結果を返す。max_age（秒）より古いものは無視する。
+        Returns:
+            dict: {"id", "created", "result"}（見つからない場合はNone）
+        """
+        oldest = time.time() - max_age if max_age is not None else 0
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, created, result FROM runs WHERE hpo_key = ? AND fingerprint = ? AND created >= ? "
+                "ORDER BY created DESC LIMIT 1",
+                (hpo_set_key(hpo_list), run_fingerprint, oldest)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"id": row[0], "created": row[1], "result": json.loads(row[2])}
+
+    def save_evidence(self, hpo_list, evidence_fingerprint, evidence):
+        """
+        情報収集の結果を保存する（同じキーの結果は置き換える）。
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO evidence (hpo_key, fingerprint, created, evidence) VALUES (?, ?, ?, ?)",
+                (hpo_set_key(hpo_list), evidence_fingerprint, time.time(), _dumps(evidence))
+            )
+            self._conn.commit()
+
+    def load_evidence(self, hpo_list, evidence_fingerprint, max_age=None):
+        """
+        保存済みの情報収集の結果を返す（見つからない・max_ageより古い場合はNone）。
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT created, evidence FROM evidence WHERE hpo_key = ? AND fingerprint = ?",
+                (hpo_set_key(hpo_list), evidence_fingerprint)
+            ).fetchone()
+        if row is None or (max_age is not None and time.time() - row[0] > max_age):
+            return None
+        return json.loads(row[1])
+
+    def iter_runs(self, hpo_list=None, run_fingerprint=None):
+        """
+        保存済みの結果を古い順に返すジェネレータ（設定の比較などの集計用）。
+        """
+        conditions = []
+        params = []
+        if hpo_list is not None:
+            conditions.append("hpo_key = ?")
+            params.append(hpo_set_key(hpo_list))
+        if run_fingerprint is not None:
+            conditions.append("fingerprint = ?")
+            params.append(run_fingerprint)
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, hpo_key, fingerprint, created, config, result FROM runs {where}ORDER BY id",
+                params
+            ).fetchall()
+        for row in rows:
+            yield {
+                "id": row[0],
+                "hpo_list": row[1].split(",") if row[1] else [],
+                "fingerprint": row[2],
+                "created": row[3],
+                "config": json.loads(row[4]),
+                "result": json.loads(row[5])
+            }
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,31 +1,63 @@
 import re
 import os
-import google.generativeai as genai
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from agents.llm_gateway import get_llm_gateway, PRIORITY_REFLECTION
+from agents.context_assembler import ContextAssembler
+from agents import tracing
 
-PROMPT6_TEMPLATE = """
+# 1回の自己評価で全診断に共通する部分（指示・患者情報・類似症例）。
+# 診断ごとに変わる部分より前に置き、全評価でプロンプトの先頭を同一にする（暗黙のプロンプトキャッシュが効く）
+PROMPT6_PREFIX_TEMPLATE = """
 Assume you are a doctor specialized in rare disease diagnosis.
 Based on the patient information, similar case diagnoses, and disease knowledge, evaluate whether the proposed diagnosis is correct for this patient.
 Begin with a clear 'DIAGNOSIS ASSESSMENT: [Correct/Incorrect]' statement, followed by your reasoning.
 Structure your analysis as follows:
 1. PATIENT SUMMARY: Briefly summarize the patient's key symptoms
-2. PROPOSED DIAGNOSIS ANALYSIS: Evaluate the proposed diagnosis ({diagnosis_to_judge}) in relation to the patient's symptoms
+2. PROPOSED DIAGNOSIS ANALYSIS: Evaluate the proposed diagnosis (given below) in relation to the patient's symptoms
 3. REFERENCES: Extract and number the most relevant evidence from the provided medical literature that supports your conclusion
 Patient phenotype: {patient_info}
-Similar cases: {similar_case_detailed}
-Medical literature: {disease_knowledge}
+Similar cases:
+{similar_case_detailed}
 """
 
+PROMPT6_TEMPLATE = """{prefix}Proposed diagnosis: {diagnosis_to_judge}
+Medical literature:
+{disease_knowledge}
+"""
+
+DIAGNOSIS_HEADING = re.compile(r'## \*\*(.+?)\*\* \(Rank #[0-9]+/5\)')
+# ストリーミング時にブロックの終わりとみなす見出し行（"## "で始まる完結した行）
+SECTION_HEADING = re.compile(r'^## [^\n]*\n', re.MULTILINE)
+
+
+@functools.lru_cache(maxsize=64)
+def judge_prompt_prefix(patient_info, similar_case_detailed):
+    """
+    自己評価プロンプトの共通部分を返す（同じ患者の評価では同一の文字列を再利用する）。
+    """
+    return PROMPT6_PREFIX_TEMPLATE.format(patient_info=patient_info, similar_case_detailed=similar_case_detailed)
+
 class SelfReflectionAgent:
     """
     診断レポートから各疾患の妥当性を自己評価し、必要に応じて再診断を行うエージェント。
     """
-    def __init__(self, disease_normalizer, knowledge_searcher, gemini_api_key=None):
+    def __init__(self, disease_normalizer, knowledge_searcher, gemini_api_key=None,
+                 max_concurrency=5, min_accepted=None, llm_gateway=None, context_assembler=None):
+        """
+        Args:
+            max_concurrency (int): 同時に評価する診断の最大数（1の場合は逐次評価）
+            min_accepted (int): この件数が採択された時点で残りの評価を打ち切る（Noneの場合は全件評価）
+        """
         self.disease_normalizer = disease_normalizer
         self.knowledge_searcher = knowledge_searcher
+        self.max_concurrency = max_concurrency
+        self.min_accepted = min_accepted
         
         self.gemini_api_key = gemini_api_key or os.getenv("GOOGLE_API_KEY")
-        genai.configure(api_key=self.gemini_api_key)
-        self.model = genai.GenerativeModel("gemini-2.5-flash")
+        self.llm_gateway = llm_gateway or get_llm_gateway()
+        self.context_assembler = context_assembler or ContextAssembler()
 
     def extract_disease_names(self, diagnosis_report):
         """
@@ -38,8 +70,8 @@ class SelfReflectionAgent:
         DiseaseNormalizerで病名を正規化し、id/labelリストを返す
         """
         normalized = []
-        for name in disease_names:
-            result = self.disease_normalizer.normalize(name)
+        for matches in self.disease_normalizer.normalize_many(disease_names, k=1):
+            result = matches[0] if matches else None
             if result and "id" in result and "label" in result:
                 normalized.append({"id": result["id"], "label": result["label"]})
         return normalized
@@ -56,45 +88,224 @@ class SelfReflectionAgent:
         Prompt6を使って診断評価をGeminiで実行
         """
         prompt = PROMPT6_TEMPLATE.format(
-            patient_info=patient_info,
-            similar_case_detailed=similar_case_detailed,
+            prefix=judge_prompt_prefix(patient_info, similar_case_detailed),
             disease_knowledge=disease_knowledge,
             diagnosis_to_judge=diagnosis_to_judge
         )
         try:
-            response = self.model.generate_content(prompt)
-            return response.text
+            return self.llm_gateway.generate(prompt, priority=PRIORITY_REFLECTION)
         except Exception as e:
+            tracing.current_span().record_error(e)
             print(f"[SelfReflectionAgent] Gemini診断評価失敗: {e}")
             return "診断評価生成に失敗しました。"
 
-    def reflect(self, diagnosis_report, patient_info, similar_case_detailed):
-        
-        diagnosis_blocks = re.split(r'## \*\*(.+?)\*\* \(Rank #[0-9]+/5\)', diagnosis_report)
+    def split_diagnosis_blocks(self, diagnosis_report):
+        """
+        診断レポートを "## **NAME** (Rank #X/5)" の見出しで分割し、(病名, 本文) のリストを返す
+        """
+        diagnosis_blocks = DIAGNOSIS_HEADING.split(diagnosis_report)
         disease_blocks = []
         for idx in range(1, len(diagnosis_blocks), 2):
             disease_name = diagnosis_blocks[idx].strip()
             block_text = diagnosis_blocks[idx+1] if idx+1 < len(diagnosis_blocks) else ''
             disease_blocks.append((disease_name, block_text))
-        accepted = []
-        for disease_name, block_text in disease_blocks:
-            norm = self.disease_normalizer.normalize(disease_name)
-            if not (norm and 'id' in norm and 'label' in norm):
-                continue
+        return disease_blocks
+
+    def iter_diagnosis_blocks(self, text_chunks):
+        """
+        ストリーミング中のレポート断片を受け取り、診断ブロックが完結した時点で (病名, 本文) を順に返す。
+        ブロックは次の "## " 見出し行（次の診断や "## References:"）が届いた時点、
+        またはストリームの終了時に完結したとみなす。
+        """
+        text = ""
+        scan = 0
+        current_name = None
+        body_start = 0
+        for chunk in text_chunks:
+            text += chunk
+            while True:
+                heading = SECTION_HEADING.search(text, scan)
+                if heading is None:
+                    break
+                scan = heading.end()
+                if current_name is not None:
+                    yield current_name, text[body_start:heading.start()]
+                    current_name = None
+                diagnosis = DIAGNOSIS_HEADING.search(heading.group())
+                if diagnosis:
+                    current_name = diagnosis.group(1).strip()
+                    body_start = heading.end()
+        if current_name is not None:
+            yield current_name, text[body_start:]
+
+    def judge_block(self, disease_name, block_text, norm, patient_info, similar_case_detailed):
+        """
+        1件の診断について知識検索とGeminiによる評価を行い、評価結果を返す
+        """
+        with tracing.span("reflection.judge", disease=norm["id"]) as span:
             know = self.knowledge_searcher.search(norm["label"])
             eval_result = self.evaluate_diagnosis(
                     patient_info=patient_info,
                     similar_case_detailed=similar_case_detailed,
-                    disease_knowledge=str(know),
+                    disease_knowledge=self.context_assembler.format_knowledge(know),
                     diagnosis_to_judge=disease_name+block_text
             )
-            if "DIAGNOSIS ASSESSMENT: [Correct]" in eval_result:
-                accepted.append({
-                        "disease": norm,
-                        "eval": eval_result,
-                        "block_text": block_text,
-                        "eval_result": eval_result
+            span.set(accepted="DIAGNOSIS ASSESSMENT: [Correct]" in eval_result)
+        return {
+                "disease_name": disease_name,
+                "disease": norm,
+                "eval": eval_result,
+                "block_text": block_text,
+                "eval_result": eval_result,
+                "is_accepted": "DIAGNOSIS ASSESSMENT: [Correct]" in eval_result
+        }
+
+    def judge_streamed_block(self, rank, disease_name, block_text, patient_info, similar_case_detailed):
+        """
+        ストリーミング中に完結した1ブロックについて、病名の正規化・知識検索・評価を行う。
+        正規化できなかった場合はNoneを返す。
+        """
+        matches = self.disease_normalizer.normalize_many([disease_name], k=1)[0]
+        norm = matches[0] if matches else None
+        if not (norm and 'id' in norm and 'label' in norm):
+            return None
+        result = self.judge_block(disease_name, block_text, norm, patient_info, similar_case_detailed)
+        result["rank"] = rank
+        return result
+
+    def summarize(self, results):
+        """
+        {順位: 評価結果} を、採択・却下それぞれ元の順位順に並べた形式に変換する。
+        """
+        accepted = []
+        rejected = []
+        for rank in sorted(results):
+            result = results[rank]
+            if result is None:
+                continue
+            verdict = {key: value for key, value in result.items() if key != "is_accepted"}
+            verdict["rank"] = rank
+            if result["is_accepted"]:
+                accepted.append(verdict)
+            else:
+                rejected.append({
+                    "rank": rank,
+                    "disease_name": result["disease_name"],
+                    "disease": result["disease"],
+                    "eval_result": result["eval_result"]
                 })
-        if accepted:
-            return {"accepted": accepted }
-        return {"accepted": [] }
+        return {"accepted": accepted, "rejected": rejected}
+
+    async def reflect_stream(self, text_chunks, patient_info, similar_case_detailed,
+                             max_concurrency=None, min_accepted=None):
+        """
+        ストリーミング中の診断レポートを評価する非同期ジェネレータ。
+        text_chunks（レポート断片の同期イテラブル）を別スレッドで読み進め、
+        診断ブロックが完結するたびに正規化・知識検索・評価を開始し、後続のブロックの生成と並行させる。
+        評価が終わった診断から順に、順位（rank）と is_accepted を含む評価結果を返す。
+        min_accepted件が採択された後に完結したブロックは評価しない。
+        """
+        max_concurrency = max_concurrency or self.max_concurrency
+        min_accepted = min_accepted if min_accepted is not None else self.min_accepted
+        loop = asyncio.get_running_loop()
+        blocks = asyncio.Queue()
+        finished_marker = object()
+
+        def read_blocks():
+            try:
+                for rank, (disease_name, block_text) in enumerate(self.iter_diagnosis_blocks(text_chunks), start=1):
+                    loop.call_soon_threadsafe(blocks.put_nowait, (rank, disease_name, block_text))
+            except Exception as e:
+                print(f"[SelfReflectionAgent] 診断レポートの受信失敗: {e}")
+            finally:
+                loop.call_soon_threadsafe(blocks.put_nowait, finished_marker)
+
+        # レポートの読み込みに1スレッド、評価にmax_concurrencyスレッドを使う
+        executor = ThreadPoolExecutor(max_workers=max(1, max_concurrency) + 1, thread_name_prefix="self-reflection")
+        reader = loop.run_in_executor(executor, tracing.bind_context(read_blocks))
+        judge = tracing.bind_context(self.judge_streamed_block)
+        next_block = asyncio.ensure_future(blocks.get())
+        judging = set()
+        stream_finished = False
+        accepted_count = 0
+        try:
+            while not stream_finished or judging:
+                waiting = set(judging) if stream_finished else judging | {next_block}
+                done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task is next_block:
+                        item = task.result()
+                        if item is finished_marker:
+                            stream_finished = True
+                            continue
+                        if not (min_accepted and accepted_count >= min_accepted):
+                            judging.add(loop.run_in_executor(
+                                executor, judge, *item, patient_info, similar_case_detailed
+                            ))
+                        next_block = asyncio.ensure_future(blocks.get())
+                        continue
+                    judging.discard(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        print(f"[SelfReflectionAgent] 診断評価失敗: {e}")
+                        continue
+                    if result is None:
+                        continue
+                    if result["is_accepted"]:
+                        accepted_count += 1
+                    yield result
+            await reader
+        finally:
+            if not next_block.done():
+                next_block.cancel()
+            # 途中で反復をやめた場合も、実行中の評価やレポートの受信の完了は待たない
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def reflect(self, diagnosis_report, patient_info, similar_case_detailed,
+                max_concurrency=None, min_accepted=None):
+        """
+        診断レポートの各診断を評価する。評価はmax_concurrency件まで並行して行い、
+        採択・却下された診断はそれぞれ元の順位順で返す。
+        min_accepted件が採択された時点で未着手の評価は打ち切る。
+        """
+        max_concurrency = max_concurrency or self.max_concurrency
+        min_accepted = min_accepted if min_accepted is not None else self.min_accepted
+
+        disease_blocks = self.split_diagnosis_blocks(diagnosis_report)
+        # 全候補の病名を1回のバッチ呼び出しで正規化
+        normalized = self.disease_normalizer.normalize_many([name for name, _ in disease_blocks], k=1)
+        jobs = []
+        for rank, ((disease_name, block_text), matches) in enumerate(zip(disease_blocks, normalized), start=1):
+            norm = matches[0] if matches else None
+            if not (norm and 'id' in norm and 'label' in norm):
+                continue
+            jobs.append((rank, disease_name, block_text, norm))
+
+        results = {}
+        if jobs:
+            executor = ThreadPoolExecutor(
+                max_workers=max(1, min(max_concurrency, len(jobs))),
+                thread_name_prefix="self-reflection"
+            )
+            try:
+                judge = tracing.bind_context(self.judge_block)
+                futures = {
+                    executor.submit(judge, disease_name, block_text, norm,
+                                    patient_info, similar_case_detailed): rank
+                    for rank, disease_name, block_text, norm in jobs
+                }
+                for future in as_completed(futures):
+                    try:
+                        results[futures[future]] = future.result()
+                    except Exception as e:
+                        print(f"[SelfReflectionAgent] 診断評価失敗: {e}")
+                        results[futures[future]] = None
+                    accepted_count = sum(1 for result in results.values() if result and result["is_accepted"])
+                    if min_accepted and accepted_count >= min_accepted:
+                        break
+            finally:
+                # 打ち切った場合は未着手の評価をキャンセルし、実行中の評価の完了は待たない
+                executor.shutdown(wait=False, cancel_futures=True)
+
+        return self.summarize(results)
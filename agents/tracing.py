@@ -0,0 +1,384 @@
+import os
+import json
+import time
+import uuid
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+SERVICE_NAME = "rare-disease-agent"
+
+# 生成モデルの料金（USD / 100万トークン）。費用の概算にのみ使う
+MODEL_PRICES = {
+    "gemini-2.5-flash": {"input": 0.30, "output": 2.50},
+    "gemini-2.5-pro": {"input": 1.25, "output": 10.00},
+}
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def classify_error(error):
+    """
+    例外を集計用の分類名に変換する。
+    """
+    name = type(error).__name__
+    if name in ("ResourceExhausted", "TooManyRequests") or 429 in (getattr(error, "code", None),
+                                                                   getattr(error, "status_code", None)):
+        return "rate_limit"
+    if "Timeout" in name or "DeadlineExceeded" in name:
+        return "timeout"
+    if name in ("ServiceUnavailable", "InternalServerError", "GatewayTimeout"):
+        return "server_error"
+    if name in ("ConnectionError", "ConnectTimeout", "ProxyError", "SSLError"):
+        return "connection"
+    if name == "HTTPError":
+        return "http_error"
+    if isinstance(error, (ValueError, KeyError, TypeError, json.JSONDecodeError)):
+        return "invalid_response"
+    return "other"
+
+
+class Span:
+    """
+    1回の処理（エージェント呼び出し・LLM呼び出しなど）の計測結果。
+    attributesには所要時間以外の情報（キャッシュヒット数、トークン数、再試行回数など）を記録する。
+    """
+    def __init__(self, trace, name, parent=None, attributes=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = dict(attributes or {})
+        self.status = "ok"
+        self.error_type = None
+        self.error_message = None
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration_ms = None
+        self._lock = threading.Lock()
+
+    def set(self, **attributes):
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def increment(self, key, value=1):
+        with self._lock:
+            self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def record_error(self, error):
+        """
+        例外を記録してspanを失敗扱いにする（例外を握りつぶす箇所でも呼び出す）。
+        """
+        with self._lock:
+            self.status = "error"
+            self.error_type = classify_error(error)
+            self.error_message = str(error)[:500]
+
+    def end(self):
+        if self.duration_ms is None:
+            self.duration_ms = (time.perf_counter() - self._start) * 1000
+            self.trace.add(self)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time": self.start_time,
+            "duration_ms": self.duration_ms,
+            "status": self.status,
+            "error_type": self.error_type,
+            "error_message": self.error_message,
+            "attributes": dict(self.attributes)
+        }
+
+
+class _NullSpan:
+    """
+    トレース外で呼ばれた場合のspan（何も記録しない）。
+    """
+    span_id = None
+
+    def set(self, **attributes):
+        pass
+
+    def increment(self, key, value=1):
+        pass
+
+    def record_error(self, error):
+        pass
+
+    def end(self):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Trace:
+    """
+    1回の診断実行（run）で記録されたspanの集まり。
+    """
+    def __init__(self, name, attributes=None):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.spans = []
+        self._lock = threading.Lock()
+        self.root = Span(self, name, attributes=attributes)
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def summary(self):
+        """
+        ステージごとの所要時間・LLMのトークン数と概算費用・キャッシュヒット数・エラーを集計する。
+        """
+        with self._lock:
+            spans = list(self.spans)
+        stages = {}
+        llm = {"calls": 0, "retries": 0, "prompt_tokens": 0, "cached_prompt_tokens": 0, "response_tokens": 0,
+               "queue_wait_ms": 0.0, "estimated_cost_usd": 0.0}
+        cache = {}
+        errors = []
+        for span in spans:
+            if span is self.root:
+                continue
+            stage = stages.setdefault(span.name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "errors": 0})
+            stage["count"] += 1
+            stage["total_ms"] += span.duration_ms
+            stage["max_ms"] = max(stage["max_ms"], span.duration_ms)
+            attributes = span.attributes
+            if span.status == "error":
+                stage["errors"] += 1
+                errors.append({"span": span.name, "error_type": span.error_type, "message": span.error_message})
+            if span.name.startswith("llm."):
+                llm["calls"] += 1
+                llm["retries"] += attributes.get("retries", 0)
+                llm["queue_wait_ms"] += attributes.get("queue_wait_ms", 0.0)
+                prompt_tokens = attributes.get("prompt_tokens", 0)
+                response_tokens = attributes.get("response_tokens", 0)
+                llm["prompt_tokens"] += prompt_tokens
+                llm["cached_prompt_tokens"] += attributes.get("cached_prompt_tokens", 0)
+                llm["response_tokens"] += response_tokens
+                price = MODEL_PRICES.get(attributes.get("model", "").split("/")[-1])
+                if price:
+                    llm["estimated_cost_usd"] += (prompt_tokens * price["input"]
+                                                  + response_tokens * price["output"]) / 1e6
+            for key, value in attributes.items():
+                for suffix in ("_cache_hits", "_cache_misses"):
+                    if key.endswith(suffix):
+                        counts = cache.setdefault(key[:-len(suffix)], {"hits": 0, "misses": 0})
+                        counts["hits" if suffix == "_cache_hits" else "misses"] += value
+        for stage in stages.values():
+            stage["total_ms"] = round(stage["total_ms"], 1)
+            stage["max_ms"] = round(stage["max_ms"], 1)
+        llm["queue_wait_ms"] = round(llm["queue_wait_ms"], 1)
+        llm["estimated_cost_usd"] = round(llm["estimated_cost_usd"], 6)
+        return {
+            "trace_id": self.trace_id,
+            "wall_time_ms": round(self.root.duration_ms or 0.0, 1),
+            "status": self.root.status,
+            "stages": stages,
+            "llm": llm,
+            "cache": cache,
+            "errors": errors
+        }
+
+
+def current_span():
+    """
+    現在のspanを返す。トレース外の場合は何も記録しないspanを返す。
+    """
+    return _current_span.get() or NULL_SPAN
+
+
+def begin_trace(name, **attributes):
+    """
+    トレースを開始し、ルートspanを現在のspanにする。終了時はend_traceを呼ぶ。
+    Returns:
+        tuple: (trace, 開始前のspan)
+    """
+    trace = Trace(name, attributes)
+    previous = _current_span.get()
+    _current_span.set(trace.root)
+    return trace, previous
+
+
+def end_trace(trace, previous=None, exporters=()):
+    """
+    ルートspanを終了して現在のspanを元に戻し、エクスポーターへ書き出す。
+    """
+    trace.root.end()
+    _current_span.set(previous)
+    for exporter in exporters:
+        try:
+            exporter.export(trace)
+        except Exception as e:
+            print(f"[Tracing] トレースの書き出し失敗: {e}")
+
+
+@contextmanager
+def start_trace(name, exporters=(), **attributes):
+    trace, previous = begin_trace(name, **attributes)
+    try:
+        yield trace
+    except BaseException as e:
+        trace.root.record_error(e)
+        raise
+    finally:
+        end_trace(trace, previous, exporters)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    処理をspanで囲んで計測する。トレース外では何も記録しない。
+    例外が送出された場合はエラーとして記録してから再送出する。
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield NULL_SPAN
+        return
+    current = Span(parent.trace, name, parent, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.record_error(e)
+        raise
+    finally:
+        current.end()
+        _current_span.reset(token)
+
+
+def open_span(name, **attributes):
+    """
+    現在のspanの子spanを開始する。現在のspanには切り替えないため、ジェネレータのように
+    呼び出し側のスレッド・コンテキストで処理が進む場合に使う。終了時はend()を呼ぶ。
+    トレース外では何も記録しないspanを返す。
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return NULL_SPAN
+    return Span(parent.trace, name, parent, attributes)
+
+
+def traced(name):
+    """
+    関数全体をspanで囲むデコレータ。
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bind_context(func):
+    """
+    呼び出し時点のspanを引き継いでfuncを実行する関数を返す。
+    ThreadPoolExecutorなど別スレッドで実行する処理を同じトレースに記録するために使う。
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _current_span.set(parent)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current_span.reset(token)
+    return wrapper
+
+
+class JSONLSpanExporter:
+    """
+    spanを1行1件のJSONとしてファイルに追記する。
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def export(self, trace):
+        lines = "".join(json.dumps(span.to_dict(), ensure_ascii=False) + "\n" for span in trace.spans)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OTLPJSONExporter:
+    """
+    トレースをOpenTelemetryのOTLP/JSON形式（1行1トレースのresourceSpans）でファイルに追記する。
+    OpenTelemetry Collectorのfilelogやotlpjsonfileレシーバーで取り込める。
+    """
+    def __init__(self, path, service_name=SERVICE_NAME):
+        self.path = path
+        self.service_name = service_name
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def _span(self, span):
+        attributes = dict(span.attributes)
+        if span.error_type:
+            attributes["error.type"] = span.error_type
+        start = int(span.start_time * 1e9)
+        otlp_span = {
+            "traceId": span.trace.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,
+            "startTimeUnixNano": str(start),
+            "endTimeUnixNano": str(start + int(span.duration_ms * 1e6)),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()],
+            "status": {"code": 2, "message": span.error_message or ""} if span.status == "error" else {"code": 1}
+        }
+        if span.parent_id:
+            otlp_span["parentSpanId"] = span.parent_id
+        return otlp_span
+
+    def export(self, trace):
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+                "scopeSpans": [{
+                    "scope": {"name": "agents.tracing"},
+                    "spans": [self._span(span) for span in trace.spans]
+                }]
+            }]
+        }
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+
+
+def build_exporters(path=None, export_format="jsonl"):
+    """
+    設定からエクスポーターのリストを作る。pathがNoneの場合は書き出さない。
+    Args:
+        export_format (str): "jsonl"（span単位のJSONL） または "otlp"（OTLP/JSON）
+    """
+    if not path:
+        return []
+    if export_format == "otlp":
+        return [OTLPJSONExporter(path)]
+    if export_format == "jsonl":
+        return [JSONLSpanExporter(path)]
+    raise ValueError(f"未対応のトレース形式です: {export_format}")
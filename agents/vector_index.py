@@ -0,0 +1,367 @@
+import os
+import json
+import numpy as np
+
+# float16などfloat32以外の行列を計算する際に一度にfloat32へ変換する行数
+_SIMILARITY_BLOCK_ROWS = 65536
+
+INDEX_BACKENDS = ("exact", "ivf", "ivfpq")
+
+
+def cosine_similarities(vectors, query_vectors):
+    """
+    正規化済み行列とクエリベクトル（1件または複数件）の内積を計算する。
+    float16ストアはブロックごとにfloat32へ変換して計算し、行列全体の複製を避ける。
+    Returns:
+        np.ndarray: クエリが1次元なら (件数,)、2次元なら (クエリ数, 件数)
+    """
+    queries = np.atleast_2d(query_vectors)
+    if vectors.dtype == np.float32:
+        similarities = np.dot(queries, vectors.T)
+    else:
+        similarities = np.empty((len(queries), len(vectors)), dtype=np.float32)
+        for start in range(0, len(vectors), _SIMILARITY_BLOCK_ROWS):
+            block = np.asarray(vectors[start:start + _SIMILARITY_BLOCK_ROWS], dtype=np.float32)
+            similarities[:, start:start + len(block)] = np.dot(queries, block.T)
+    if np.ndim(query_vectors) == 1:
+        return similarities[0]
+    return similarities
+
+
+def top_k_indices(similarities, k):
+    """
+    各行の類似度上位k件のインデックスを降順で返す（np.argpartitionで全件ソートを避ける）。
+    """
+    k = min(k, similarities.shape[-1])
+    if k <= 0:
+        return np.zeros(similarities.shape[:-1] + (0,), dtype=np.int64)
+    partitioned = np.argpartition(-similarities, k - 1, axis=-1)[..., :k]
+    partitioned_scores = np.take_along_axis(similarities, partitioned, axis=-1)
+    order = np.argsort(-partitioned_scores, axis=-1, kind="stable")
+    return np.take_along_axis(partitioned, order, axis=-1)
+
+
+def spherical_kmeans(vectors, n_clusters, n_iter=20, sample_size=100000, seed=0):
+    """
+    L2正規化済みベクトルに対する球面k-means。重心も正規化して返す。
+    大規模データではsample_size件を抽出して学習する。
+    """
+    rng = np.random.default_rng(seed)
+    n = len(vectors)
+    if n > sample_size:
+        sample = np.asarray(vectors[np.sort(rng.choice(n, sample_size, replace=False))], dtype=np.float32)
+    else:
+        sample = np.asarray(vectors, dtype=np.float32)
+    n_clusters = max(1, min(n_clusters, len(sample)))
+    centroids = sample[rng.choice(len(sample), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0
+        # 空のクラスタはランダムな点で初期化し直す
+        if empty.any():
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+            norms[empty] = 1.0
+        centroids = (sums / norms).astype(np.float32)
+    return centroids
+
+
+def assign_to_centroids(vectors, centroids, block_rows=65536):
+    """
+    各ベクトルを最も近い重心に割り当てる（ブロック単位で計算）。
+    """
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block_rows):
+        block = np.asarray(vectors[start:start + block_rows], dtype=np.float32)
+        assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+class ExactIndex:
+    """
+    全件の内積を計算する厳密検索。
+    """
+    def search(self, vectors, queries, k):
+        """
+        Returns:
+            tuple: (インデックス (クエリ数, k), 類似度 (クエリ数, k))
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if len(vectors) == 0:
+            empty = np.zeros((len(queries), 0))
+            return empty.astype(np.int64), empty.astype(np.float32)
+        similarities = cosine_similarities(vectors, queries)
+        indices = top_k_indices(similarities, k)
+        return indices, np.take_along_axis(similarities, indices, axis=-1)
+
+    def fits(self, shape, **params):
+        return True
+
+
+class IVFIndex:
+    """
+    転置ファイル（IVF）による近似最近傍検索。
+    ベクトルを球面k-meansのクラスタに分け、検索時は重心に近いnprobe個のクラスタのみを走査する。
+    nprobeを増やすほど再現率が上がり、検索は遅くなる。
+    """
+    def __init__(self, centroids, assignments, nprobe=8):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.nprobe = nprobe
+        self.assignments = np.asarray(assignments, dtype=np.int32)
+        self._build_lists()
+
+    @classmethod
+    def train(cls, vectors, nlist=None, nprobe=8, n_iter=20, seed=0):
+        nlist = nlist or max(1, int(np.sqrt(len(vectors))))
+        centroids = spherical_kmeans(vectors, nlist, n_iter=n_iter, seed=seed)
+        return cls(centroids, assign_to_centroids(vectors, centroids), nprobe=nprobe)
+
+    def _build_lists(self):
+        order = np.argsort(self.assignments, kind="stable")
+        counts = np.bincount(self.assignments, minlength=len(self.centroids))
+        self.list_indptr = np.concatenate([[0], np.cumsum(counts)])
+        self.list_indices = order.astype(np.int64)
+
+    def add(self, vectors):
+        """
+        追加されたベクトルを既存の重心に割り当てる（重心は再学習しない）。
+        """
+        self.assignments = np.concatenate([self.assignments, assign_to_centroids(vectors, self.centroids)])
+        self._build_lists()
+
+    def candidates(self, query, nprobe=None):
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        probes = top_k_indices(self.centroids @ query, nprobe)
+        return np.concatenate([
+            self.list_indices[self.list_indptr[c]:self.list_indptr[c + 1]] for c in probes
+        ])
+
+    def search(self, vectors, queries, k, nprobe=None):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        k = min(k, len(vectors))
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for row, query in enumerate(queries):
+            candidates = self.candidates(query, nprobe)
+            if len(candidates) == 0:
+                continue
+            candidates.sort()
+            similarities = np.asarray(vectors[candidates], dtype=np.float32) @ query
+            top = top_k_indices(similarities, k)
+            indices[row, :len(top)] = candidates[top]
+            scores[row, :len(top)] = similarities[top]
+        return indices, scores
+
+    def fits(self, shape, nlist=None, **params):
+        """
+        ベクトル（件数, 次元数）のストアに対して構築されたインデックスか（nlistを指定した場合はその値でも比較する）。
+        """
+        return (
+            len(self.assignments) == shape[0]
+            and self.centroids.shape[1] == shape[1]
+            and (nlist is None or len(self.centroids) == nlist)
+        )
+
+    def save(self, path_prefix):
+        np.save(path_prefix + ".centroids.npy", self.centroids)
+        np.save(path_prefix + ".assignments.npy", self.assignments)
+
+    @classmethod
+    def load(cls, path_prefix, nprobe=8):
+        return cls(
+            np.load(path_prefix + ".centroids.npy"),
+            np.load(path_prefix + ".assignments.npy"),
+            nprobe=nprobe
+        )
+
+
+def euclidean_kmeans(vectors, n_clusters, n_iter=20, seed=0):
+    """
+    ユークリッド距離によるk-means（直積量子化のサブ空間コードブック学習用）。
+    """
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    n_clusters = max(1, min(n_clusters, len(vectors)))
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    squared_norms = (vectors ** 2).sum(axis=1)
+    for _ in range(n_iter):
+        distances = squared_norms[:, None] - 2 * vectors @ centroids.T + (centroids ** 2).sum(axis=1)[None, :]
+        assignments = np.argmin(distances, axis=1)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        if (~filled).any():
+            centroids[~filled] = vectors[rng.choice(len(vectors), int((~filled).sum()), replace=False)]
+    return centroids
+
+
+class ProductQuantizer:
+    """
+    直積量子化（PQ）。ベクトルをm個のサブ空間に分け、各サブ空間を最大256個の代表ベクトルで
+    1バイトに符号化する。内積は問い合わせごとのルックアップ表で近似計算する（ADC）。
+    """
+    def __init__(self, codebooks):
+        self.codebooks = np.asarray(codebooks, dtype=np.float32)
+        self.m, self.ksub, self.dsub = self.codebooks.shape
+
+    @classmethod
+    def train(cls, vectors, m=16, ksub=256, n_iter=20, sample_size=50000, seed=0):
+        dim = vectors.shape[1]
+        if dim % m != 0:
+            raise ValueError(f"次元数 {dim} はサブ空間数 m={m} で割り切れる必要があります。")
+        rng = np.random.default_rng(seed)
+        n = len(vectors)
+        sample_rows = np.sort(rng.choice(n, min(n, sample_size), replace=False))
+        sample = np.asarray(vectors[sample_rows], dtype=np.float32)
+        dsub = dim // m
+        ksub = min(ksub, len(sample))
+        codebooks = np.stack([
+            euclidean_kmeans(sample[:, j * dsub:(j + 1) * dsub], ksub, n_iter=n_iter, seed=seed + j)
+            for j in range(m)
+        ])
+        return cls(codebooks)
+
+    def encode(self, vectors, block_rows=65536):
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        for start in range(0, len(vectors), block_rows):
+            block = np.asarray(vectors[start:start + block_rows], dtype=np.float32)
+            for j in range(self.m):
+                sub = block[:, j * self.dsub:(j + 1) * self.dsub]
+                codebook = self.codebooks[j]
+                distances = -2 * sub @ codebook.T + (codebook ** 2).sum(axis=1)[None, :]
+                codes[start:start + len(block), j] = np.argmin(distances, axis=1)
+        return codes
+
+    def inner_product_table(self, query):
+        """
+        クエリと各サブ空間の代表ベクトルとの内積表 (m, ksub) を返す。
+        """
+        return np.einsum("jkd,jd->jk", self.codebooks, query.reshape(self.m, self.dsub))
+
+    def approximate_scores(self, table, codes):
+        return table[np.arange(self.m)[None, :], codes].sum(axis=1)
+
+
+class IVFPQIndex:
+    """
+    IVFで走査するクラスタを絞り込み、PQ符号で近似スコアを計算する近似最近傍検索。
+    近似スコアの上位rerank件は元のベクトル（メモリマップ）で厳密に再計算する。
+    nprobe・rerankを増やすほど再現率が上がり、検索は遅くなる。
+    """
+    def __init__(self, ivf, pq, codes, rerank=64):
+        self.ivf = ivf
+        self.pq = pq
+        self.codes = np.asarray(codes, dtype=np.uint8)
+        self.rerank = rerank
+
+    @classmethod
+    def train(cls, vectors, nlist=None, m=16, nprobe=8, rerank=64, n_iter=20, seed=0):
+        ivf = IVFIndex.train(vectors, nlist=nlist, nprobe=nprobe, n_iter=n_iter, seed=seed)
+        pq = ProductQuantizer.train(vectors, m=m, n_iter=n_iter, seed=seed)
+        return cls(ivf, pq, pq.encode(vectors), rerank=rerank)
+
+    def search(self, vectors, queries, k, nprobe=None, rerank=None):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        rerank = self.rerank if rerank is None else rerank
+        k = min(k, len(self.codes))
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for row, query in enumerate(queries):
+            candidates = self.ivf.candidates(query, nprobe)
+            if len(candidates) == 0:
+                continue
+            approximate = self.pq.approximate_scores(self.pq.inner_product_table(query), self.codes[candidates])
+            if vectors is not None and rerank > 0:
+                shortlist = candidates[top_k_indices(approximate, max(k, rerank))]
+                shortlist.sort()
+                similarities = np.asarray(vectors[shortlist], dtype=np.float32) @ query
+            else:
+                shortlist = candidates
+                similarities = approximate.astype(np.float32)
+            top = top_k_indices(similarities, k)
+            indices[row, :len(top)] = shortlist[top]
+            scores[row, :len(top)] = similarities[top]
+        return indices, scores
+
+    def fits(self, shape, nlist=None, m=None, **params):
+        return (
+            self.ivf.fits(shape, nlist=nlist)
+            and len(self.codes) == shape[0]
+            and self.pq.m * self.pq.dsub == shape[1]
+            and (m is None or self.pq.m == m)
+        )
+
+    def save(self, path_prefix):
+        np.savez(
+            path_prefix + ".npz",
+            centroids=self.ivf.centroids,
+            assignments=self.ivf.assignments,
+            codebooks=self.pq.codebooks,
+            codes=self.codes,
+            params=json.dumps({"nprobe": self.ivf.nprobe, "rerank": self.rerank})
+        )
+
+    @classmethod
+    def load(cls, path_prefix, nprobe=None, rerank=None):
+        """
+        保存済みのインデックスを読み込む。nprobe・rerankを指定した場合は保存時の値の代わりに使う。
+        """
+        data = np.load(path_prefix + ".npz")
+        params = json.loads(str(data["params"]))
+        ivf = IVFIndex(data["centroids"], data["assignments"], nprobe=nprobe or params["nprobe"])
+        rerank = params["rerank"] if rerank is None else rerank
+        return cls(ivf, ProductQuantizer(data["codebooks"]), data["codes"], rerank=rerank)
+
+
+def index_path_prefix(store_path, backend):
+    """
+    embeddingストアに対応する近似インデックスの保存先（接頭辞）を返す。
+    """
+    prefix = store_path[:-len(".npy")] if store_path.endswith(".npy") else store_path
+    return f"{prefix}.{backend}"
+
+
+def build_vector_index(backend, vectors, **params):
+    """
+    指定したバックエンドのインデックスを構築する。
+    Args:
+        backend (str): "exact" / "ivf" / "ivfpq"
+        params: nlist, nprobe, m, rerank など
+    """
+    if backend == "exact":
+        return ExactIndex()
+    if backend == "ivf":
+        return IVFIndex.train(vectors, nlist=params.get("nlist"), nprobe=params.get("nprobe", 8))
+    if backend == "ivfpq":
+        return IVFPQIndex.train(
+            vectors,
+            nlist=params.get("nlist"),
+            m=params.get("m", 16),
+            nprobe=params.get("nprobe", 8),
+            rerank=params.get("rerank", 64)
+        )
+    raise ValueError(f"未対応のインデックスバックエンドです: {backend}")
+
+
+def load_vector_index(backend, path_prefix, shape=None, **params):
+    """
+    保存済みのインデックスを読み込む。検索時のパラメータ（nprobe, rerank）は指定した値を使う。
+    存在しない場合、またはshape（ストアのベクトルの件数, 次元数）・構築時のパラメータ（nlist, m）と
+    合わない場合（古いストアに対して構築されたものなど）はNoneを返す。
+    """
+    if backend == "exact":
+        return ExactIndex()
+    if backend == "ivf" and os.path.exists(path_prefix + ".centroids.npy"):
+        index = IVFIndex.load(path_prefix, nprobe=params.get("nprobe", 8))
+    elif backend == "ivfpq" and os.path.exists(path_prefix + ".npz"):
+        index = IVFPQIndex.load(path_prefix, nprobe=params.get("nprobe"), rerank=params.get("rerank"))
+    else:
+        return None
+    if shape is not None and not index.fits(shape, **params):
+        print(f"[VectorIndex] {path_prefix} はembeddingストアまたは設定と一致しないため使用しません。")
+        return None
+    return index
@@ -0,0 +1,362 @@
+import os
+import sys
+import json
+import time
+import types
+import hashlib
+import threading
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from agents.llm_gateway import LLMGateway, DEFAULT_GENERATION_MODEL
+from agents.http_client import HTTPClient
+from agents.embedding_cache import normalize_text
+
+FIXTURE_FORMAT_VERSION = 1
+FIXTURE_KINDS = ("llm", "embeddings", "http", "knowledge")
+SYNTHETIC_EMBEDDING_DIM = 768
+
+
+def fixture_key(*parts):
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def synthetic_embedding(text, dim=SYNTHETIC_EMBEDDING_DIM):
+    """
+    正規化テキストから決まる擬似的なembedding（同じ病名は常に同じベクトル）。
+    """
+    seed = int(hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()[:16], 16)
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def _seeded_choice(items, seed_text, count):
+    seed = int(hashlib.sha256(seed_text.encode("utf-8")).hexdigest()[:16], 16)
+    rng = np.random.default_rng(seed)
+    indices = rng.choice(len(items), size=min(count, len(items)), replace=False)
+    return [items[i] for i in indices], rng
+
+
+class FixtureStore:
+    """
+    記録済みレスポンス（LLM・embedding・HTTP・Wikipedia）と患者・ラベル情報を保持するJSONファイル。
+    再生時のヒット・ミス（記録がなく合成レスポンスで代替した件数）を種類ごとに数える。
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        data = {}
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("format_version") != FIXTURE_FORMAT_VERSION:
+                raise ValueError(f"未対応のフィクスチャ形式です: {data.get('format_version')}")
+        self.patients = data.get("patients", [])
+        self.hpo_labels = data.get("hpo_labels", {})
+        self.omim_labels = data.get("omim_labels", {})
+        self.entries = {kind: data.get(kind, {}) for kind in FIXTURE_KINDS}
+        self.stats = {kind: {"hits": 0, "misses": 0} for kind in FIXTURE_KINDS}
+
+    def lookup(self, kind, key):
+        with self._lock:
+            entry = self.entries[kind].get(key)
+            self.stats[kind]["hits" if entry is not None else "misses"] += 1
+        return entry
+
+    def record(self, kind, key, entry):
+        with self._lock:
+            self.entries[kind][key] = entry
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {kind: {"hits": 0, "misses": 0} for kind in FIXTURE_KINDS}
+
+    def save(self, path=None):
+        path = path or self.path
+        with self._lock:
+            data = {
+                "format_version": FIXTURE_FORMAT_VERSION,
+                "patients": self.patients,
+                "hpo_labels": self.hpo_labels,
+                "omim_labels": self.omim_labels
+            }
+            data.update(self.entries)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def synthetic(cls, patients=20, omim_size=8000, hpo_size=2000, terms_per_patient=8, seed=0):
+        """
+        記録済みのフィクスチャがない場合に使う合成データ（全レスポンスを合成で代替する）。
+        """
+        store = cls()
+        rng = np.random.default_rng(seed)
+        store.omim_labels = {f"OMIM:{100000 + i}": f"SYNTHETIC DISEASE {i}, TYPE {i % 7 + 1}" for i in range(omim_size)}
+        store.hpo_labels = {f"HP:{i:07d}": f"Synthetic phenotype {i}" for i in range(1, hpo_size + 1)}
+        hpo_ids = list(store.hpo_labels)
+        store.patients = [
+            {"id": f"synthetic-{i}",
+             "hpo_list": sorted(rng.choice(hpo_ids, size=terms_per_patient, replace=False).tolist())}
+            for i in range(patients)
+        ]
+        return store
+
+
+class _Response:
+    def __init__(self, text, prompt_tokens, response_tokens):
+        self.text = text
+        self.usage_metadata = types.SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=response_tokens,
+            total_token_count=prompt_tokens + response_tokens
+        )
+
+
+class _ReplayModel:
+    def __init__(self, gateway, model_name):
+        self.gateway = gateway
+        self.model_name = model_name
+
+    def generate_content(self, prompt, stream=False, request_options=None):
+        entry = self.gateway.fixtures.lookup("llm", fixture_key(self.model_name, prompt))
+        if entry is None:
+            entry = self.gateway.synthetic_generation(prompt)
+        if not stream:
+            self.gateway.sleep(entry.get("latency_ms", 0))
+            return _Response(entry["text"], entry.get("prompt_tokens", 0), entry.get("response_tokens", 0))
+        return self._stream(entry)
+
+    def _stream(self, entry):
+        # 最初の断片までの待ち時間と残りの受信時間を半分ずつとして再現する
+        text = entry["text"]
+        chunk_size = self.gateway.stream_chunk_chars
+        chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)] or [""]
+        per_chunk = entry.get("latency_ms", 0) / 2 / len(chunks)
+        self.gateway.sleep(entry.get("latency_ms", 0) / 2)
+        for i, chunk in enumerate(chunks):
+            self.gateway.sleep(per_chunk)
+            last = i == len(chunks) - 1
+            yield _Response(chunk, entry.get("prompt_tokens", 0) if last else 0,
+                            entry.get("response_tokens", 0) if last else 0)
+
+
+class ReplayLLMGateway(LLMGateway):
+    """
+    記録済みのGemini応答を再生するLLMGateway。レート制限・優先度・トレースは本物の実装をそのまま通る。
+    記録にないプロンプトには、プロンプトの種類（診断レポート・評価・候補生成）に応じた
+    決定的な合成応答を返す。待ち時間は記録値 × latency_scale だけ再現する。
+    """
+    def __init__(self, fixtures, latency_scale=1.0, synthetic_latency_ms=0.0, stream_chunk_chars=200,
+                 requests_per_minute=1e9, tokens_per_minute=1e12):
+        super().__init__(api_key="replay", requests_per_minute=requests_per_minute,
+                         tokens_per_minute=tokens_per_minute)
+        self.fixtures = fixtures
+        self.latency_scale = latency_scale
+        self.synthetic_latency_ms = synthetic_latency_ms
+        self.stream_chunk_chars = stream_chunk_chars
+        self.disease_labels = list(fixtures.omim_labels.values()) or ["SYNTHETIC DISEASE"]
+
+    def sleep(self, latency_ms):
+        if latency_ms and self.latency_scale:
+            time.sleep(latency_ms * self.latency_scale / 1000)
+
+    def _configure(self):
+        pass
+
+    def get_model(self, model_name=DEFAULT_GENERATION_MODEL):
+        return _ReplayModel(self, model_name)
+
+    def synthetic_generation(self, prompt):
+        names, rng = _seeded_choice(self.disease_labels, prompt, 5)
+        if "DIAGNOSIS ASSESSMENT" in prompt:
+            verdict = "Correct" if rng.random() < 0.3 else "Incorrect"
+            text = f"DIAGNOSIS ASSESSMENT: [{verdict}]\n1. PATIENT SUMMARY: synthetic\n2. PROPOSED DIAGNOSIS ANALYSIS: synthetic\n"
+        elif "(Rank #X/5)" in prompt:
+            text = "".join(
+                f"## **{name}** (Rank #{rank}/5)\n### Diagnostic Reasoning:\n- Synthetic reasoning for {name} [1].\n\n"
+                for rank, name in enumerate(names, start=1)
+            ) + "## References:\n- [1] Synthetic reference.\n"
+        else:
+            text = "\n".join(f"**{name}**" for name in names)
+        return {
+            "text": text,
+            "latency_ms": self.synthetic_latency_ms,
+            "prompt_tokens": max(1, len(prompt) // 4),
+            "response_tokens": max(1, len(text) // 4)
+        }
+
+    def _embed_content(self, model, content, task_type):
+        texts = content if isinstance(content, (list, tuple)) else [content]
+        entry = self.fixtures.lookup("embeddings", fixture_key(model, task_type, list(texts)))
+        if entry is None:
+            entry = {"vectors": [synthetic_embedding(text).tolist() for text in texts],
+                     "latency_ms": self.synthetic_latency_ms}
+        self.sleep(entry.get("latency_ms", 0))
+        vectors = entry["vectors"]
+        return {"embedding": vectors if isinstance(content, (list, tuple)) else vectors[0]}
+
+
+class ReplayHTTPClient:
+    """
+    PubCaseFinder・TogoSeekの記録済みレスポンスを再生するHTTPClient互換クライアント。
+    """
+    make_cache_key = staticmethod(HTTPClient.make_cache_key)
+
+    def __init__(self, fixtures, latency_scale=1.0, synthetic_latency_ms=0.0):
+        self.fixtures = fixtures
+        self.latency_scale = latency_scale
+        self.synthetic_latency_ms = synthetic_latency_ms
+        self.disease_labels = list(fixtures.omim_labels.items()) or [("OMIM:000000", "SYNTHETIC DISEASE")]
+
+    def _replay(self, key, url, request):
+        entry = self.fixtures.lookup("http", key)
+        if entry is None:
+            entry = {"response": self.synthetic_response(url, request), "latency_ms": self.synthetic_latency_ms}
+        if entry.get("latency_ms") and self.latency_scale:
+            time.sleep(entry["latency_ms"] * self.latency_scale / 1000)
+        return entry["response"]
+
+    def synthetic_response(self, url, request):
+        diseases, rng = _seeded_choice(self.disease_labels, json.dumps(request, sort_keys=True), 10)
+        if "pubcasefinder" in url:
+            return [
+                {"omim_disease_name_en": label, "description": f"{omim_id} synthetic", "score": round(1.0 - i * 0.05, 3)}
+                for i, (omim_id, label) in enumerate(diseases)
+            ]
+        return {"results": [
+            {"id": f"case-{i}", "diagnosis": [label], "similarity": round(float(rng.uniform(0.3, 0.9)), 3)}
+            for i, (_, label) in enumerate(diseases[:5])
+        ]}
+
+    def get_json(self, url, params=None, timeout=60, cache_key=None):
+        return self._replay(fixture_key("GET", url, params), url, params)
+
+    def post_json(self, url, payload, headers=None, timeout=30, cache_key=None):
+        return self._replay(fixture_key("POST", url, payload), url, payload)
+
+
+class ReplayWikipedia:
+    """
+    WikipediaAPIWrapper.run の記録済み結果を再生する。
+    """
+    def __init__(self, fixtures, lang="ja", latency_scale=1.0, synthetic_latency_ms=0.0):
+        self.fixtures = fixtures
+        self.lang = lang
+        self.latency_scale = latency_scale
+        self.synthetic_latency_ms = synthetic_latency_ms
+
+    def run(self, query):
+        entry = self.fixtures.lookup("knowledge", fixture_key(self.lang, query))
+        if entry is None:
+            entry = {"text": f"Page: {query}\nSummary: Synthetic summary of {query}. " * 3,
+                     "latency_ms": self.synthetic_latency_ms}
+        if entry.get("latency_ms") and self.latency_scale:
+            time.sleep(entry["latency_ms"] * self.latency_scale / 1000)
+        return entry["text"]
+
+
+def _elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+class _RecordingModel:
+    def __init__(self, gateway, model_name, model):
+        self.gateway = gateway
+        self.model_name = model_name
+        self.model = model
+
+    def generate_content(self, prompt, stream=False, request_options=None):
+        started = time.perf_counter()
+        response = self.model.generate_content(prompt, stream=stream, request_options=request_options)
+        if not stream:
+            self._record(prompt, response.text, response, started)
+            return response
+        return self._stream(prompt, response, started)
+
+    def _stream(self, prompt, response, started):
+        texts = []
+        last = None
+        for chunk in response:
+            last = chunk
+            try:
+                texts.append(chunk.text)
+            except ValueError:
+                pass
+            yield chunk
+        self._record(prompt, "".join(texts), last, started)
+
+    def _record(self, prompt, text, response, started):
+        usage = getattr(response, "usage_metadata", None)
+        self.gateway.fixtures.record("llm", fixture_key(self.model_name, prompt), {
+            "text": text,
+            "latency_ms": _elapsed_ms(started),
+            "prompt_tokens": getattr(usage, "prompt_token_count", 0) or 0,
+            "response_tokens": getattr(usage, "candidates_token_count", 0) or 0
+        })
+
+
+class RecordingLLMGateway(LLMGateway):
+    """
+    本物のGemini APIを呼び出し、応答と所要時間をフィクスチャに記録するLLMGateway。
+    """
+    def __init__(self, fixtures, **kwargs):
+        super().__init__(**kwargs)
+        self.fixtures = fixtures
+
+    def get_model(self, model_name=DEFAULT_GENERATION_MODEL):
+        return _RecordingModel(self, model_name, super().get_model(model_name))
+
+    def _embed_content(self, model, content, task_type):
+        started = time.perf_counter()
+        result = super()._embed_content(model, content, task_type)
+        texts = content if isinstance(content, (list, tuple)) else [content]
+        vectors = result["embedding"] if isinstance(content, (list, tuple)) else [result["embedding"]]
+        self.fixtures.record("embeddings", fixture_key(model, task_type, list(texts)), {
+            "vectors": [list(map(float, vector)) for vector in vectors],
+            "latency_ms": _elapsed_ms(started)
+        })
+        return result
+
+
+class RecordingHTTPClient(HTTPClient):
+    """
+    本物のAPIを（キャッシュを使わずに）呼び出し、レスポンスをフィクスチャに記録するHTTPClient。
+    """
+    def __init__(self, fixtures, **kwargs):
+        super().__init__(**kwargs)
+        self.fixtures = fixtures
+
+    def get_json(self, url, params=None, timeout=60, cache_key=None):
+        started = time.perf_counter()
+        response = super().get_json(url, params=params, timeout=timeout)
+        self.fixtures.record("http", fixture_key("GET", url, params),
+                             {"response": response, "latency_ms": _elapsed_ms(started)})
+        return response
+
+    def post_json(self, url, payload, headers=None, timeout=30, cache_key=None):
+        started = time.perf_counter()
+        response = super().post_json(url, payload, headers=headers, timeout=timeout)
+        self.fixtures.record("http", fixture_key("POST", url, payload),
+                             {"response": response, "latency_ms": _elapsed_ms(started)})
+        return response
+
+
+class RecordingWikipedia:
+    """
+    WikipediaAPIWrapperの結果をフィクスチャに記録する。
+    """
+    def __init__(self, fixtures, lang="ja"):
+        from langchain.utilities import WikipediaAPIWrapper
+        self.fixtures = fixtures
+        self.lang = lang
+        self.wiki = WikipediaAPIWrapper(lang=lang)
+
+    def run(self, query):
+        started = time.perf_counter()
+        text = self.wiki.run(query)
+        self.fixtures.record("knowledge", fixture_key(self.lang, query),
+                             {"text": text, "latency_ms": _elapsed_ms(started)})
+        return text
@@ -0,0 +1,397 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from agents.embedding_store import save_embedding_store
+from agents.disease_normalizer import DiseaseNormalizer, DEFAULT_EMBEDDINGS_PATH
+from agents.lexical_index import DEFAULT_LEXICAL_THRESHOLD
+from agents.hpo_mapping import HPOMapping
+from replay import (FixtureStore, ReplayLLMGateway, ReplayHTTPClient, ReplayWikipedia,
+                    RecordingLLMGateway, RecordingHTTPClient, RecordingWikipedia, synthetic_embedding)
+
+REPORT_FORMAT_VERSION = 1
+# 記録と再生で同じ設定を使う（キャッシュは無効にして毎回すべての呼び出しを通す）
+BENCHMARK_CONFIG = {
+    "knowledge_searcher": True,
+    "case_searcher": True,
+    "case_search_backend": "remote",
+    "phenotype_analyzer": True,
+    "disease_normalizer": True,
+    "self_reflection": True,
+    "knowledge_cache": False
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def latency_stats(values):
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return {}
+    return {
+        "mean": round(float(values.mean()), 1),
+        "p50": round(float(np.percentile(values, 50)), 1),
+        "p90": round(float(np.percentile(values, 90)), 1),
+        "p99": round(float(np.percentile(values, 99)), 1),
+        "max": round(float(values.max()), 1)
+    }
+
+
+class BenchmarkEnvironment:
+    """
+    フィクスチャから再生用のクライアント・HPOマッピング・embeddingストアを用意する。
+    storeを指定しない場合は、フィクスチャのOMIM病名を合成embeddingで並べたストアを作業ディレクトリに作る。
+    """
+    def __init__(self, fixtures, workdir, latency_scale=1.0, synthetic_latency_ms=0.0, store_path=None):
+        self.fixtures = fixtures
+        self.gateway = ReplayLLMGateway(fixtures, latency_scale, synthetic_latency_ms)
+        self.http_client = ReplayHTTPClient(fixtures, latency_scale, synthetic_latency_ms)
+        self.wiki = ReplayWikipedia(fixtures, "ja", latency_scale, synthetic_latency_ms)
+
+        self.hpo_mapping_path = os.path.join(workdir, "phenotype_mapping.json")
+        with open(self.hpo_mapping_path, "w", encoding="utf-8") as f:
+            json.dump(fixtures.hpo_labels, f, ensure_ascii=False)
+        if store_path is None:
+            store_path = os.path.join(workdir, "omim_embeddings.npy")
+            ids = list(fixtures.omim_labels)
+            labels = [fixtures.omim_labels[omim_id] for omim_id in ids]
+            vectors = np.stack([synthetic_embedding(label) for label in labels])
+            save_embedding_store(vectors, ids, labels, store_path)
+        self.store_path = store_path
+
+    def normalizer(self, index_backend="exact", lexical_threshold=DEFAULT_LEXICAL_THRESHOLD):
+        return DiseaseNormalizer(self.store_path, use_cache=False, index_backend=index_backend,
+                                 llm_gateway=self.gateway, lexical_threshold=lexical_threshold)
+
+    def host_factory(self, index_backend="exact"):
+        from host import RareDiseaseDiagnosisHost
+
+        def factory():
+            return RareDiseaseDiagnosisHost(
+                dict(BENCHMARK_CONFIG, normalizer_index_backend=index_backend),
+                llm_gateway=self.gateway,
+                http_client=self.http_client,
+                knowledge_client=self.wiki,
+                hpo_mapping=HPOMapping(self.hpo_mapping_path),
+                disease_normalizer=self.normalizer(index_backend)
+            )
+        return factory
+
+
+def bench_cold_start(repeat=3):
+    """
+    別プロセスでhostのimportとRareDiseaseDiagnosisHostの生成にかかる時間（ミリ秒、中央値）を測る。
+    """
+    script = (
+        "import time\n"
+        "started = time.perf_counter()\n"
+        "from host import RareDiseaseDiagnosisHost\n"
+        f"RareDiseaseDiagnosisHost({BENCHMARK_CONFIG!r})\n"
+        "print((time.perf_counter() - started) * 1000)\n"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    timings = []
+    for _ in range(repeat):
+        try:
+            completed = subprocess.run([sys.executable, "-c", script], cwd=root, capture_output=True,
+                                       text=True, check=True)
+        except subprocess.CalledProcessError as e:
+            print(f"[Benchmark] 起動時間の計測に失敗しました: {e.stderr.strip()[-500:]}")
+            return None
+        timings.append(float(completed.stdout.strip().splitlines()[-1]))
+    return round(float(np.median(timings)), 1)
+
+
+def bench_pipeline(host_factory, patients, concurrency, repeat=1):
+    """
+    concurrency個のワーカーで全患者をrepeat回実行し、スループット・エンドツーエンドの遅延・
+    ステージごとの平均所要時間（run()のtrace集計）を返す。
+    """
+    local = threading.local()
+
+    def run_one(patient):
+        host = getattr(local, "host", None)
+        if host is None:
+            host = local.host = host_factory()
+        started = time.perf_counter()
+        result = host.run(patient["hpo_list"])
+        return (time.perf_counter() - started) * 1000, result["trace"]
+
+    jobs = [patient for _ in range(repeat) for patient in patients]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="benchmark") as executor:
+        results = list(executor.map(run_one, jobs))
+    wall = time.perf_counter() - started
+
+    stages = {}
+    llm_calls = 0
+    errors = 0
+    for _, trace in results:
+        llm_calls += trace["llm"]["calls"]
+        errors += len(trace["errors"])
+        for name, stage in trace["stages"].items():
+            stages[name] = stages.get(name, 0.0) + stage["total_ms"]
+    return {
+        "concurrency": concurrency,
+        "runs": len(jobs),
+        "wall_sec": round(wall, 3),
+        "throughput_runs_per_sec": round(len(jobs) / wall, 3),
+        "latency_ms": latency_stats([elapsed for elapsed, _ in results]),
+        "stage_mean_ms": {name: round(total / len(jobs), 1) for name, total in sorted(stages.items())},
+        "llm_calls_per_run": round(llm_calls / len(jobs), 2),
+        "errors": errors
+    }
+
+
+def bench_memory(host_factory, patients):
+    """
+    Pythonヒープのピーク（tracemalloc）とプロセスの最大RSSを測る。計測のオーバーヘッドがあるため遅延の計測とは分ける。
+    """
+    tracemalloc.start()
+    host = host_factory()
+    for patient in patients:
+        host.run(patient["hpo_list"])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    memory = {"python_heap_peak_mb": round(peak / 2 ** 20, 2)}
+    try:
+        import resource
+        # Linuxではキロバイト単位
+        memory["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+    except ImportError:
+        pass
+    return memory
+
+
+def perturb(label, rng):
+    """
+    LLMの出力を模して病名を崩す（大文字小文字・末尾の語の欠落）。
+    """
+    words = label.split()
+    if len(words) > 2 and rng.random() < 0.5:
+        words = words[:-1]
+    text = " ".join(words)
+    return text.lower() if rng.random() < 0.5 else text.title()
+
+
+def bench_normalizer(env, backends, names=2000, batch_size=5, seed=0):
+    """
+    インデックスのバックエンドごとに、病名の正規化スループット（names/sec）、正解率、
+    最初のバックエンドとのtop-1一致率を測る。batch_sizeは自己評価での1回の問い合わせ件数に相当する。
+    バックエンド名に "+lexical" を付けた場合は字句一致を先に試す（付けない場合はembeddingのみ）。
+    """
+    rng = np.random.default_rng(seed)
+    ids = list(env.fixtures.omim_labels)
+    picked = rng.integers(0, len(ids), size=names)
+    queries = [perturb(env.fixtures.omim_labels[ids[i]], rng) for i in picked]
+    truth = [ids[i] for i in picked]
+    batches = [queries[i:i + batch_size] for i in range(0, len(queries), batch_size)]
+    reference = None
+    results = []
+    for backend in backends:
+        started = time.perf_counter()
+        index_backend, _, tier = backend.partition("+")
+        # normalizerは遅延ロードのため、インデックスの読み込み・構築を明示的に行って計測から除く
+        normalizer = env.normalizer(index_backend, DEFAULT_LEXICAL_THRESHOLD if tier == "lexical" else None).load()
+        setup_sec = time.perf_counter() - started
+        started = time.perf_counter()
+        top1 = []
+        for batch in batches:
+            top1.extend(matches[0]["id"] if matches else None for matches in normalizer.normalize_many(batch, k=1))
+        elapsed = time.perf_counter() - started
+        if reference is None:
+            reference = top1
+        results.append({
+            "backend": backend,
+            "names": len(queries),
+            "names_per_sec": round(len(queries) / elapsed, 1),
+            "setup_sec": round(setup_sec, 3),
+            "top1_accuracy": round(float(np.mean([a == b for a, b in zip(top1, truth)])), 4),
+            "top1_agreement_with_first": round(float(np.mean([a == b for a, b in zip(top1, reference)])), 4)
+        })
+    return results
+
+
+def run_benchmark(args):
+    os.environ.setdefault("GOOGLE_API_KEY", "replay")
+    if args.fixtures:
+        fixtures = FixtureStore(args.fixtures)
+    else:
+        fixtures = FixtureStore.synthetic(patients=args.patients, omim_size=args.omim_size)
+    patients = fixtures.patients[:args.patients]
+    concurrency_levels = [int(value) for value in args.concurrency.split(",")]
+    backends = args.backends.split(",")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        env = BenchmarkEnvironment(fixtures, workdir, args.latency_scale, args.synthetic_latency_ms, args.store)
+        host_factory = env.host_factory(args.pipeline_backend)
+        # ウォームアップ（インデックスの構築・モデルのロードなどを計測から除く）
+        host = host_factory()
+        startup = {"cold_start_ms": bench_cold_start(), "warm_up_ms": host.warm_up()}
+        host.run(patients[0]["hpo_list"])
+        fixtures.reset_stats()
+
+        pipeline = [bench_pipeline(host_factory, patients, level, args.repeat) for level in concurrency_levels]
+        fixture_stats = dict(fixtures.stats)
+        memory = bench_memory(host_factory, patients[:args.memory_patients])
+        normalizer = bench_normalizer(env, backends, names=args.normalizer_names)
+
+    return {
+        "format_version": REPORT_FORMAT_VERSION,
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "fixtures": args.fixtures or "synthetic",
+            "patients": len(patients),
+            "latency_scale": args.latency_scale,
+            "synthetic_latency_ms": args.synthetic_latency_ms,
+            "pipeline_backend": args.pipeline_backend
+        },
+        "fixture_stats": fixture_stats,
+        "startup": startup,
+        "pipeline": pipeline,
+        "memory": memory,
+        "normalizer": normalizer
+    }
+
+
+def key_metrics(report):
+    """
+    コミット間で比較する指標を {名前: (値, 大きいほど良いか)} で返す。
+    """
+    metrics = {}
+    for level in report["pipeline"]:
+        prefix = f"pipeline.c{level['concurrency']}"
+        metrics[prefix + ".throughput_runs_per_sec"] = (level["throughput_runs_per_sec"], True)
+        metrics[prefix + ".latency_p50_ms"] = (level["latency_ms"].get("p50"), False)
+        metrics[prefix + ".latency_p90_ms"] = (level["latency_ms"].get("p90"), False)
+    startup = report.get("startup", {})
+    if startup.get("cold_start_ms") is not None:
+        metrics["startup.cold_start_ms"] = (startup["cold_start_ms"], False)
+    if startup.get("warm_up_ms"):
+        metrics["startup.warm_up_ms"] = (round(sum(startup["warm_up_ms"].values()), 1), False)
+    for name, value in report["memory"].items():
+        metrics["memory." + name] = (value, False)
+    for result in report["normalizer"]:
+        metrics[f"normalizer.{result['backend']}.names_per_sec"] = (result["names_per_sec"], True)
+    return metrics
+
+
+def compare_reports(baseline, current):
+    """
+    2つのレポートの主要指標を比較した表（文字列）を返す。
+    """
+    base_metrics = key_metrics(baseline)
+    current_metrics = key_metrics(current)
+    lines = [
+        f"baseline: {baseline['meta'].get('commit')}  current: {current['meta'].get('commit')}",
+        f"{'metric':<48}{'baseline':>12}{'current':>12}{'change':>10}"
+    ]
+    for name, (value, higher_is_better) in current_metrics.items():
+        base_value = base_metrics.get(name, (None, True))[0]
+        if base_value in (None, 0) or value is None:
+            change = ""
+        else:
+            ratio = (value - base_value) / base_value * 100
+            better = ratio > 0 if higher_is_better else ratio < 0
+            change = f"{ratio:+.1f}%" + ("" if abs(ratio) < 1 else (" +" if better else " -"))
+        lines.append(f"{name:<48}{str(base_value):>12}{str(value):>12}{change:>10}")
+    return "\n".join(lines)
+
+
+def record_fixtures(args):
+    """
+    本物のAPIで患者を実行し、応答をフィクスチャとして記録する（GOOGLE_API_KEYが必要）。
+    """
+    from host import RareDiseaseDiagnosisHost
+    from cohort_runner import iter_patient_records
+
+    fixtures = FixtureStore(args.output)
+    hpo_mapping = HPOMapping()
+    gateway = RecordingLLMGateway(fixtures)
+    normalizer = DiseaseNormalizer(args.store, use_cache=False, llm_gateway=gateway).load()
+    # 再生時は病名ラベルから合成embeddingのストアを作り直すため、ラベルのみ保存する
+    fixtures.omim_labels = dict(zip(normalizer.omim_ids, normalizer.omim_labels))
+    host = RareDiseaseDiagnosisHost(
+        dict(BENCHMARK_CONFIG),
+        llm_gateway=gateway,
+        http_client=RecordingHTTPClient(fixtures),
+        knowledge_client=RecordingWikipedia(fixtures),
+        hpo_mapping=hpo_mapping,
+        disease_normalizer=normalizer
+    )
+    recorded = {patient["id"] for patient in fixtures.patients}
+    for i, record in enumerate(iter_patient_records(args.patients)):
+        if args.limit is not None and i >= args.limit:
+            break
+        if record["id"] in recorded or not record["hpo_list"]:
+            continue
+        host.run(record["hpo_list"])
+        fixtures.patients.append({"id": record["id"], "hpo_list": record["hpo_list"]})
+        for hpo_id in record["hpo_list"]:
+            fixtures.hpo_labels[hpo_id] = hpo_mapping.mapping.get(hpo_id, "Unknown")
+        # 途中で中断しても記録済みの患者は残るよう、患者ごとに保存する
+        fixtures.save()
+        print(f"[Benchmark] {record['id']} の応答を記録しました。")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="診断パイプラインのベンチマーク（記録済みレスポンスを再生）")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="ベンチマークを実行する")
+    run_parser.add_argument("--fixtures", default=None, help="記録済みフィクスチャ（省略時は合成データ）")
+    run_parser.add_argument("--patients", type=int, default=20, help="実行する患者数")
+    run_parser.add_argument("--omim-size", type=int, default=8000, help="合成データのOMIM疾患数")
+    run_parser.add_argument("--store", default=None, help="使用するembeddingストア（省略時は合成ストア）")
+    run_parser.add_argument("--concurrency", default="1,4,8", help="スループットを測る同時実行数（カンマ区切り）")
+    run_parser.add_argument("--repeat", type=int, default=1, help="各同時実行数で全患者を繰り返す回数")
+    run_parser.add_argument("--latency-scale", type=float, default=1.0, help="記録済みの待ち時間に掛ける係数（0で待たない）")
+    run_parser.add_argument("--synthetic-latency-ms", type=float, default=0.0, help="合成レスポンスの待ち時間")
+    run_parser.add_argument("--pipeline-backend", default="exact", help="パイプラインで使う正規化インデックス")
+    run_parser.add_argument("--backends", default="exact,ivf,ivfpq,exact+lexical",
+                            help="正規化スループットを測るインデックス（+lexicalで字句一致を併用）")
+    run_parser.add_argument("--normalizer-names", type=int, default=2000)
+    run_parser.add_argument("--memory-patients", type=int, default=5)
+    run_parser.add_argument("--output", default=None, help="レポートJSONの保存先")
+    run_parser.add_argument("--compare", default=None, help="比較対象のレポートJSON")
+
+    record_parser = subparsers.add_parser("record", help="本物のAPIの応答をフィクスチャとして記録する")
+    record_parser.add_argument("patients", help="患者レコードのJSONL、またはPhenopacketのディレクトリ")
+    record_parser.add_argument("--output", default="./benchmarks/fixtures.json")
+    record_parser.add_argument("--store", default=DEFAULT_EMBEDDINGS_PATH, help="OMIMのembeddingストア")
+    record_parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record_fixtures(args)
+    else:
+        report = run_benchmark(args)
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        if args.compare:
+            with open(args.compare, encoding="utf-8") as f:
+                print(compare_reports(json.load(f), report))
@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from agents.rate_limiter import TokenBucket
+
+
+def load_phenopacket(phenopacket):
+    """
+    Phenopacket（v2のJSON）から患者IDと、除外されていないHPO IDのリスト、正解疾患IDを取り出す。
+    """
+    hpo_list = []
+    for feature in phenopacket.get("phenotypicFeatures", []):
+        if feature.get("excluded"):
+            continue
+        term_id = feature.get("type", {}).get("id")
+        if term_id and term_id.startswith("HP:"):
+            hpo_list.append(term_id)
+    expected = []
+    for interpretation in phenopacket.get("interpretations", []):
+        disease = interpretation.get("diagnosis", {}).get("disease", {})
+        if disease.get("id"):
+            expected.append(disease["id"])
+    for disease in phenopacket.get("diseases", []):
+        term_id = disease.get("term", {}).get("id")
+        if term_id and term_id not in expected:
+            expected.append(term_id)
+    return {
+        "id": phenopacket.get("id"),
+        "hpo_list": hpo_list,
+        "expected": expected
+    }
+
+
+def _to_record(data, fallback_id):
+    if "phenotypicFeatures" in data:
+        record = load_phenopacket(data)
+    else:
+        record = {
+            "id": data.get("id"),
+            "hpo_list": list(data.get("hpo_list", [])),
+            "expected": list(data.get("expected", []))
+        }
+    if not record["id"]:
+        record["id"] = fallback_id
+    return record
+
+
+def iter_patient_records(path):
+    """
+    患者レコードを逐次読み込むジェネレータ。
+    - JSONLファイル: 1行ごとに {"id", "hpo_list", "expected"} またはPhenopacket
+    - ディレクトリ: 配下の *.json をPhenopacketとして再帰的に読み込む
+    """
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if not name.endswith(".json"):
+                    continue
+                file_path = os.path.join(root, name)
+                with open(file_path, encoding="utf-8") as f:
+                    data = json.load(f)
+                yield _to_record(data, os.path.relpath(file_path, path))
+    else:
+        with open(path, encoding="utf-8") as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if line:
+                    yield _to_record(json.loads(line), f"line-{line_number}")
+
+
+class CohortRunner:
+    """
+    多数の患者に対してRareDiseaseDiagnosisHostを実行するバッチランナー。
+    結果は1患者ごとにJSONLへ逐次追記し、再実行時は完了済みの患者をスキップして再開する。
+    情報源の失敗・レポート生成の失敗を含む結果は"degraded"として記録し、retry_errorsの場合はエラーと同様に再実行する。
+    runs_per_minuteを指定した場合、全ワーカー合計での患者処理の開始数をその値に制限する。
+    """
+    def __init__(self, output_path, host_factory=None, workers=4, runs_per_minute=None, retry_errors=True,
+                 config=None):
+        self.output_path = output_path
+        self.host_factory = host_factory or self._default_host_factory
+        self.workers = workers
+        self.rate_limiter = TokenBucket(runs_per_minute, capacity=1) if runs_per_minute else None
+        self.retry_errors = retry_errors
+        self.config = config
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        # ワーカーごとのhost（run()の終了時に閉じる）
+        self._hosts = []
+        self._hosts_lock = threading.Lock()
+
+    def _default_host_factory(self):
+        from host import RareDiseaseDiagnosisHost
+        return RareDiseaseDiagnosisHost(dict(self.config) if self.config else None)
+
+    def _host(self):
+        # RareDiseaseDiagnosisHostはmemoryを持つため、ワーカースレッドごとに1つ生成する
+        host = getattr(self._local, "host", None)
+        if host is None:
+            host = self.host_factory()
+            self._local.host = host
+            with self._hosts_lock:
+                self._hosts.append(host)
+        return host
+
+    def close_hosts(self):
+        """
+        ワーカーごとのhostを閉じる（情報収集のスレッドと結果ストアの接続を解放する）。
+        """
+        with self._hosts_lock:
+            hosts, self._hosts = self._hosts, []
+        for host in hosts:
+            host.close()
+        self._local = threading.local()
+
+    def warm_up(self):
+        """
+        ワーカーの開始前に、hostを生成せずにプロセス共通のデータ（OMIMのembedding・インデックスなど）を読み込む。
+        読み込むデータはconfig（未指定の場合はhostの既定の設定）で決まる。
+        Returns:
+            dict: {データ名: 読み込みにかかった時間（ミリ秒）}
+        """
+        from host import warm_up_shared_data
+        return warm_up_shared_data(self.config)
+
+    def load_checkpoint(self):
+        """
+        出力JSONLから処理済みの患者IDを読み込む。
+        途中で書き込みが中断された末尾の不完全な行は切り詰める。
+        """
+        done = set()
+        if not os.path.exists(self.output_path):
+            return done
+        with open(self.output_path, "rb+") as f:
+            content = f.read()
+            if content and not content.endswith(b"\n"):
+                f.truncate(content.rfind(b"\n") + 1)
+                content = content[:content.rfind(b"\n") + 1]
+        for line in content.decode("utf-8").splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            # "error"・"degraded"はretry_errorsの場合に再実行する
+            if entry.get("status") == "ok" or not self.retry_errors:
+                done.add(entry.get("id"))
+        return done
+
+    def _write(self, entry):
+        line = json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+        with self._write_lock:
+            with open(self.output_path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _process(self, record):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        started = time.time()
+        entry = {"id": record["id"], "hpo_list": record["hpo_list"], "expected": record.get("expected", [])}
+        try:
+            host = self._host()
+            entry["result"] = host.run(record["hpo_list"])
+            entry["status"] = "degraded" if host.is_degraded(entry["result"]) else "ok"
+        except Exception as e:
+            print(f"[CohortRunner] {record['id']} の処理に失敗しました: {e}")
+            entry["status"] = "error"
+            entry["error"] = f"{type(e).__name__}: {e}"
+        entry["elapsed_sec"] = round(time.time() - started, 3)
+        self._write(entry)
+        return entry["status"]
+
+    def run(self, records, limit=None):
+        """
+        患者レコードを処理する。処理中のレコード数はワーカー数の2倍までに抑え、
+        入力全体をメモリに載せずにストリーム処理し、終了後はワーカーごとのhostを閉じる。
+        Returns:
+            dict: {"ok", "degraded", "error", "skipped"} の件数
+        """
+        directory = os.path.dirname(os.path.abspath(self.output_path))
+        os.makedirs(directory, exist_ok=True)
+        done = self.load_checkpoint()
+        counts = {"ok": 0, "degraded": 0, "error": 0, "skipped": 0}
+        counts_lock = threading.Lock()
+        slots = threading.BoundedSemaphore(self.workers * 2)
+
+        def finished(future):
+            # 完了したfutureは保持せず件数のみ数える（患者数に比例してメモリが増えないようにする）
+            try:
+                status = future.result()
+            except Exception as e:
+                print(f"[CohortRunner] ワーカーで予期しないエラー: {e}")
+                status = "error"
+            with counts_lock:
+                counts[status] += 1
+            slots.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cohort") as executor:
+                submitted = 0
+                for record in records:
+                    if limit is not None and submitted >= limit:
+                        break
+                    if record["id"] in done:
+                        with counts_lock:
+                            counts["skipped"] += 1
+                        continue
+                    if not record["hpo_list"]:
+                        print(f"[CohortRunner] {record['id']} はHPOタームがないためスキップします")
+                        with counts_lock:
+                            counts["skipped"] += 1
+                        continue
+                    slots.acquire()
+                    executor.submit(self._process, record).add_done_callback(finished)
+                    submitted += 1
+        finally:
+            self.close_hosts()
+        return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="複数患者に対して診断パイプラインを実行する")
+    parser.add_argument("input", help="患者レコードのJSONL、またはPhenopacketのディレクトリ")
+    parser.add_argument("--output", default="./data/cohort_results.jsonl", help="結果を追記するJSONL")
+    parser.add_argument("--workers", type=int, default=4, help="同時に処理する患者数")
+    parser.add_argument("--runs-per-minute", type=float, default=None, help="1分あたりに開始する患者数の上限")
+    parser.add_argument("--limit", type=int, default=None, help="処理する患者数の上限")
+    parser.add_argument("--warm-up", action="store_true", help="処理の開始前にエージェントとデータを読み込む")
+    args = parser.parse_args()
+
+    runner = CohortRunner(
+        args.output,
+        workers=args.workers,
+        runs_per_minute=args.runs_per_minute
+    )
+    if args.warm_up:
+        print(f"[CohortRunner] 初期化にかかった時間(ms): {runner.warm_up()}")
+    counts = runner.run(iter_patient_records(args.input), limit=args.limit)
+    print(f"完了: {counts}")
@@ -0,0 +1,321 @@
+import json
+import asyncio
+import argparse
+import itertools
+from agents.result_store import hpo_set_key
+
+DEFAULT_SERVICE_HOST = "127.0.0.1"
+DEFAULT_SERVICE_PORT = 8765
+# 実行待ちのジョブ数の上限（これを超えるリクエストはasyncio.QueueFullで拒否する）
+DEFAULT_MAX_QUEUE = 32
+# 接続1行あたりの最大長（HPOリストのJSON）
+MAX_REQUEST_BYTES = 64 * 1024
+TERMINAL_EVENTS = ("result", "error")
+
+
+class _Job:
+    """
+    同じHPOセットのリクエストをまとめた1回のパイプライン実行。
+    発生したイベントを購読者（リクエストごとのasyncio.Queue）に配り、途中から合流した購読者には履歴を再送する。
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self, key, hpo_list, loop):
+        self.id = next(self._ids)
+        self.key = key
+        self.hpo_list = list(hpo_list)
+        self.enqueued = loop.time()
+        self.events = []
+        self.subscribers = set()
+        self.task = None
+        self.abandoned = False
+        self.done = False
+
+    def publish(self, event):
+        self.events.append(event)
+        for subscriber in self.subscribers:
+            subscriber.put_nowait(event)
+
+    def subscribe(self):
+        subscriber = asyncio.Queue()
+        for event in self.events:
+            subscriber.put_nowait(event)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+
+class DiagnosisService:
+    """
+    RareDiseaseDiagnosisHostを複数の利用者から並行して使うためのasyncioのサービス。
+    - 実行中・実行待ちのリクエストと同じHPOセット（重複除去・ソート済み）のリクエストは、同じ実行に合流させる
+    - 実行待ちのジョブはmax_queue件までとし、超えた分はasyncio.QueueFullで即座に拒否する（バックプレッシャー）
+    - リクエストごとの期限（秒）を過ぎると、そのリクエストには"deadline"のerrorイベントを返す。
+      すべてのリクエストが期限切れ・中断になったジョブは、実行待ちなら実行せず、実行中ならキャンセルする
+    - 各ジョブの進行（queued, started, stage, verdict, result/error）をイベントとして逐次返す
+    hostはmemoryを持つため、ワーカーごとに1つhost_factoryで生成する。
+    """
+    def __init__(self, host_factory=None, workers=2, max_queue=DEFAULT_MAX_QUEUE, default_deadline=None):
+        self.host_factory = host_factory or self._default_host_factory
+        self.workers = workers
+        self.max_queue = max_queue
+        self.default_deadline = default_deadline
+        self.stats = {
+            "accepted": 0, "coalesced": 0, "rejected": 0, "expired": 0,
+            "dropped": 0, "cancelled": 0, "completed": 0, "failed": 0
+        }
+        self._queue = None
+        self._inflight = {}
+        self._worker_tasks = []
+        # ワーカーごとのhost（停止時・作り直し時にcloseする）
+        self._hosts = {}
+
+    @staticmethod
+    def _default_host_factory():
+        from host import RareDiseaseDiagnosisHost
+        return RareDiseaseDiagnosisHost()
+
+    async def _new_host(self):
+        return await asyncio.get_running_loop().run_in_executor(None, self.host_factory)
+
+    async def start(self, warm_up=False):
+        """
+        ワーカーを起動する。warm_upがTrueの場合はプロセス共通のデータを先に読み込む。
+        Returns:
+            dict: {コンポーネント名: 初期化にかかった時間（ミリ秒）}（warm_upしない場合は空）
+        """
+        if self._worker_tasks:
+            return {}
+        self._queue = asyncio.Queue(self.max_queue)
+        timings = {}
+        if warm_up:
+            host = await self._new_host()
+            try:
+                timings = await asyncio.get_running_loop().run_in_executor(None, host.warm_up)
+            finally:
+                host.close()
+        self._worker_tasks = [
+            asyncio.ensure_future(self._worker(index)) for index in range(self.workers)
+        ]
+        return timings
+
+    async def stop(self):
+        """
+        ワーカーを停止し、各ワーカーのhostを閉じる。完了していないジョブの購読者には"stopped"のerrorイベントを返す。
+        """
+        for task in self._worker_tasks:
+            task.cancel()
+        for job in list(self._inflight.values()):
+            if job.task is not None:
+                job.task.cancel()
+            job.publish({"event": "error", "job_id": job.id, "reason": "stopped", "error": "service stopped"})
+            job.done = True
+        self._inflight.clear()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        for host in self._hosts.values():
+            host.close()
+        self._hosts.clear()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    def status(self):
+        return {
+            "workers": len(self._worker_tasks),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "inflight": len(self._inflight),
+            "stats": dict(self.stats)
+        }
+
+    async def _worker(self, index):
+        host = self._hosts[index] = await self._new_host()
+        while True:
+            job = await self._queue.get()
+            try:
+                if job.abandoned:
+                    self.stats["dropped"] += 1
+                    continue
+                job.task = asyncio.ensure_future(self._execute(host, job))
+                # asyncio.waitはワーカー自身のキャンセル時にジョブをキャンセルしない（stopで個別にキャンセルする）
+                await asyncio.wait([job.task])
+                if job.task.cancelled():
+                    # executorのスレッドがまだhostを使っている可能性があるため、閉じて以降は新しいhostで処理する
+                    self.stats["cancelled"] += 1
+                    host.close()
+                    host = self._hosts[index] = await self._new_host()
+            finally:
+                self._queue.task_done()
+
+    async def _execute(self, host, job):
+        loop = asyncio.get_running_loop()
+        job.publish({
+            "event": "started", "job_id": job.id,
+            "queued_ms": round((loop.time() - job.enqueued) * 1000, 1)
+        })
+        try:
+            async for event in host.run_stream(job.hpo_list):
+                job.publish(dict(event, job_id=job.id))
+            self.stats["completed"] += 1
+        except Exception as e:
+            print(f"[DiagnosisService] ジョブ{job.id}の実行に失敗しました: {e}")
+            self.stats["failed"] += 1
+            job.publish({"event": "error", "job_id": job.id, "reason": "failed", "error": f"{type(e).__name__}: {e}"})
+        finally:
+            job.done = True
+            if self._inflight.get(job.key) is job:
+                del self._inflight[job.key]
+
+    def _abandon(self, job):
+        job.abandoned = True
+        if self._inflight.get(job.key) is job:
+            del self._inflight[job.key]
+        if job.task is not None:
+            job.task.cancel()
+
+    async def stream(self, hpo_list, deadline=None):
+        """
+        診断を依頼し、進行状況のイベントを逐次返す非同期ジェネレータ。
+        最初に {"event": "queued", "job_id", "coalesced": 既存の実行に合流したか, "position"} を返し、
+        以降はジョブのイベント（started, stage, verdict）を返して、resultまたはerrorで終了する。
+        Args:
+            deadline: 期限（秒）。Noneの場合はdefault_deadline
+        Raises:
+            asyncio.QueueFull: 実行待ちのジョブが上限に達している場合
+        """
+        if not hpo_list:
+            raise ValueError("hpo_list が空です")
+        if not self._worker_tasks:
+            raise RuntimeError("DiagnosisService が開始されていません")
+        loop = asyncio.get_running_loop()
+        deadline = self.default_deadline if deadline is None else deadline
+        expires = loop.time() + deadline if deadline is not None else None
+
+        key = hpo_set_key(hpo_list)
+        job = self._inflight.get(key)
+        coalesced = job is not None
+        if job is None:
+            job = _Job(key, hpo_list, loop)
+            try:
+                self._queue.put_nowait(job)
+            except asyncio.QueueFull:
+                self.stats["rejected"] += 1
+                raise
+            self._inflight[key] = job
+            self.stats["accepted"] += 1
+        else:
+            self.stats["coalesced"] += 1
+        subscriber = job.subscribe()
+        try:
+            yield {
+                "event": "queued", "job_id": job.id, "coalesced": coalesced,
+                "position": None if job.task is not None else self._queue.qsize()
+            }
+            while True:
+                timeout = None if expires is None else expires - loop.time()
+                try:
+                    if timeout is not None and timeout <= 0:
+                        raise asyncio.TimeoutError()
+                    event = await asyncio.wait_for(subscriber.get(), timeout)
+                except asyncio.TimeoutError:
+                    self.stats["expired"] += 1
+                    yield {
+                        "event": "error", "job_id": job.id, "reason": "deadline",
+                        "error": f"deadline of {deadline}s exceeded"
+                    }
+                    return
+                yield event
+                if event["event"] in TERMINAL_EVENTS:
+                    return
+        finally:
+            job.subscribers.discard(subscriber)
+            if not job.subscribers and not job.done:
+                self._abandon(job)
+
+    async def diagnose(self, hpo_list, deadline=None):
+        """
+        streamを最後まで受信し、runと同じ形式の結果を返す。
+        Raises:
+            asyncio.QueueFull: 実行待ちのジョブが上限に達している場合
+            asyncio.TimeoutError: 期限を過ぎた場合
+            RuntimeError: パイプラインの実行に失敗した、またはサービスが停止した場合
+        """
+        async for event in self.stream(hpo_list, deadline):
+            if event["event"] == "result":
+                return {key: value for key, value in event.items() if key not in ("event", "job_id")}
+            if event["event"] == "error":
+                if event["reason"] == "deadline":
+                    raise asyncio.TimeoutError(event["error"])
+                raise RuntimeError(event["error"])
+
+    async def handle_connection(self, reader, writer):
+        """
+        JSON Lines形式の接続を処理する。1行に1リクエスト（{"hpo_list": [...], "deadline": 秒}）を受け取り、
+        イベントを1行1件のJSONで返す。リクエストは接続ごとに順に処理する。
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    hpo_list = request["hpo_list"]
+                    events = self.stream(hpo_list, request.get("deadline"))
+                    event = await events.__anext__()
+                except asyncio.QueueFull:
+                    await self._send(writer, {"event": "error", "reason": "busy", "error": "queue is full"})
+                    continue
+                except (ValueError, KeyError, TypeError) as e:
+                    await self._send(writer, {"event": "error", "reason": "invalid", "error": f"{type(e).__name__}: {e}"})
+                    continue
+                try:
+                    await self._send(writer, event)
+                    async for event in events:
+                        await self._send(writer, event)
+                finally:
+                    await events.aclose()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _send(writer, event):
+        writer.write((json.dumps(event, ensure_ascii=False, default=str) + "\n").encode("utf-8"))
+        await writer.drain()
+
+    async def serve(self, host=DEFAULT_SERVICE_HOST, port=DEFAULT_SERVICE_PORT, warm_up=False):
+        """
+        ワーカーを起動し、JSON LinesのTCPサーバーとして待ち受ける（キャンセルされるまで戻らない）。
+        """
+        timings = await self.start(warm_up=warm_up)
+        if warm_up:
+            print(f"[DiagnosisService] 初期化にかかった時間(ms): {timings}")
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_REQUEST_BYTES)
+        print(f"[DiagnosisService] {host}:{port} で待ち受けています（ワーカー数: {self.workers}）")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="診断パイプラインをJSON LinesのTCPサービスとして提供する")
+    parser.add_argument("--host", default=DEFAULT_SERVICE_HOST, help="待ち受けるアドレス")
+    parser.add_argument("--port", type=int, default=DEFAULT_SERVICE_PORT, help="待ち受けるポート")
+    parser.add_argument("--workers", type=int, default=2, help="同時に実行するパイプライン数")
+    parser.add_argument("--max-queue", type=int, default=DEFAULT_MAX_QUEUE, help="実行待ちのジョブ数の上限")
+    parser.add_argument("--deadline", type=float, default=None, help="リクエストの既定の期限（秒）")
+    parser.add_argument("--warm-up", action="store_true", help="待ち受けの開始前にエージェントとデータを読み込む")
+    args = parser.parse_args()
+
+    service = DiagnosisService(workers=args.workers, max_queue=args.max_queue, default_deadline=args.deadline)
+    try:
+        asyncio.run(service.serve(args.host, args.port, warm_up=args.warm_up))
+    except KeyboardInterrupt:
+        print(f"[DiagnosisService] 停止しました: {service.stats}")
@@ -0,0 +1,83 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from agents.embedding_store import open_embedding_store
+from agents.vector_index import ExactIndex, build_vector_index
+
+def make_queries(vectors, n_queries=1000, noise=0.05, seed=0):
+    """
+    ストア内のベクトルにノイズを加えてクエリを作る（embedding APIを呼ばずに評価するため）。
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(vectors), min(n_queries, len(vectors)), replace=False)
+    queries = np.asarray(vectors[np.sort(rows)], dtype=np.float32)
+    queries += rng.normal(scale=noise / np.sqrt(queries.shape[1]), size=queries.shape).astype(np.float32)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+def measure(index, vectors, queries, k, **search_params):
+    started = time.perf_counter()
+    indices = [index.search(vectors, query, k, **search_params)[0][0] for query in queries]
+    elapsed = time.perf_counter() - started
+    return np.array(indices), elapsed / len(queries) * 1000
+
+def benchmark(store_path, n_queries=1000, k=10, nlist=None, m=16, nprobes=(1, 4, 8, 16, 32), reranks=(0, 16, 64)):
+    """
+    厳密検索を基準に、近似インデックスのrecall@1・recall@kと1クエリあたりの遅延を測定する。
+    Returns:
+        list: 設定ごとの結果
+    """
+    store = open_embedding_store(store_path)
+    vectors = store['vectors']
+    queries = make_queries(vectors, n_queries)
+    exact_indices, exact_ms = measure(ExactIndex(), vectors, queries, k)
+    results = [{"backend": "exact", "recall@1": 1.0, f"recall@{k}": 1.0, "latency_ms": exact_ms, "build_sec": 0.0}]
+
+    def recall(indices):
+        at1 = float(np.mean(indices[:, 0] == exact_indices[:, 0]))
+        at_k = float(np.mean([
+            len(set(found) & set(truth)) / len(truth) for found, truth in zip(indices, exact_indices)
+        ]))
+        return at1, at_k
+
+    started = time.perf_counter()
+    ivf = build_vector_index("ivf", vectors, nlist=nlist)
+    ivf_build = time.perf_counter() - started
+    for nprobe in nprobes:
+        indices, latency = measure(ivf, vectors, queries, k, nprobe=nprobe)
+        at1, at_k = recall(indices)
+        results.append({"backend": "ivf", "nprobe": nprobe, "recall@1": at1, f"recall@{k}": at_k,
+                        "latency_ms": latency, "build_sec": ivf_build})
+
+    started = time.perf_counter()
+    ivfpq = build_vector_index("ivfpq", vectors, nlist=nlist, m=m)
+    ivfpq_build = time.perf_counter() - started
+    for nprobe in nprobes:
+        for rerank in reranks:
+            indices, latency = measure(ivfpq, vectors, queries, k, nprobe=nprobe, rerank=rerank)
+            at1, at_k = recall(indices)
+            results.append({"backend": "ivfpq", "nprobe": nprobe, "rerank": rerank, "recall@1": at1,
+                            f"recall@{k}": at_k, "latency_ms": latency, "build_sec": ivfpq_build})
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DiseaseNormalizerの検索インデックスを比較する")
+    parser.add_argument("--store", default="./data/omim_embeddings.npy")
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--pq-m", type=int, default=16)
+    parser.add_argument("--output", default=None, help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    results = benchmark(args.store, n_queries=args.queries, k=args.k, nlist=args.nlist, m=args.pq_m)
+    for result in results:
+        print(json.dumps(result, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
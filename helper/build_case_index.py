@@ -0,0 +1,41 @@
+import os
+import sys
+import argparse
+from tqdm import tqdm
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from agents.case_index import LocalCaseIndex, DEFAULT_CASE_INDEX_DIR
+from cohort_runner import iter_patient_records
+
+def build_case_index(input_path, index_dir=DEFAULT_CASE_INDEX_DIR, batch_size=1000, nlist=None):
+    """
+    Phenopacketのディレクトリ（または患者レコードのJSONL）からローカル症例インデックスを構築する。
+    既存のインデックスがある場合は、未登録の症例IDのみ追記する。
+    nlistを指定した場合は構築後にIVF（近似検索用）を学習する。
+    """
+    index = LocalCaseIndex(index_dir)
+    known_ids = {case["id"] for case in index.cases}
+    batch = []
+    appended = 0
+    for record in tqdm(iter_patient_records(input_path), desc="Indexing cases"):
+        if record["id"] in known_ids or not record["hpo_list"]:
+            continue
+        known_ids.add(record["id"])
+        batch.append({"id": record["id"], "hpo_list": record["hpo_list"], "diagnosis": record["expected"]})
+        if len(batch) >= batch_size:
+            appended += index.append(batch)
+            batch = []
+    appended += index.append(batch)
+    if nlist:
+        index.train_ivf(nlist=nlist)
+    print(f"{appended}件の症例を追加しました（合計 {len(index)}件）: {index_dir}")
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ローカル症例インデックスを構築する")
+    parser.add_argument("input", help="Phenopacketのディレクトリ、または患者レコードのJSONL")
+    parser.add_argument("--index-dir", default=DEFAULT_CASE_INDEX_DIR)
+    parser.add_argument("--nlist", type=int, default=None, help="IVFのクラスタ数（指定時のみ学習）")
+    args = parser.parse_args()
+    build_case_index(args.input, args.index_dir, nlist=args.nlist)
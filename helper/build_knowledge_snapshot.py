@@ -0,0 +1,51 @@
+import os
+import sys
+import json
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from agents.knowledge_snapshot import KnowledgeSnapshot, DEFAULT_SNAPSHOT_PATH, DEFAULT_SNAPSHOT_TOKENIZE
+
+def iter_documents(input_path):
+    """
+    JSONLのダンプ（1行1記事、{"title", "summary" または "text", "url"}）を読み込む。
+    """
+    with open(input_path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield {
+                "title": record.get("title"),
+                "summary": record.get("summary") or record.get("text"),
+                "url": record.get("url")
+            }
+
+def build_knowledge_snapshot(input_path, snapshot_path=DEFAULT_SNAPSHOT_PATH, lang="ja",
+                             tokenize=DEFAULT_SNAPSHOT_TOKENIZE, batch_size=10000):
+    """
+    ダンプからKnowledgeSearcherのオフライン用スナップショット（SQLite FTS）を構築する。
+    """
+    snapshot = KnowledgeSnapshot(snapshot_path, tokenize=tokenize)
+    batch = []
+    total = 0
+    for document in iter_documents(input_path):
+        batch.append(document)
+        if len(batch) >= batch_size:
+            total += snapshot.add_documents(batch, lang=lang)
+            batch = []
+    total += snapshot.add_documents(batch, lang=lang)
+    snapshot.optimize()
+    print(f"{total}件の記事を {snapshot_path} に追加しました（合計 {len(snapshot)}件）。")
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="知識検索用のオフラインスナップショットを構築する")
+    parser.add_argument("input", help="記事のJSONLダンプ")
+    parser.add_argument("--snapshot", default=DEFAULT_SNAPSHOT_PATH)
+    parser.add_argument("--lang", default="ja")
+    parser.add_argument("--tokenize", default=DEFAULT_SNAPSHOT_TOKENIZE,
+                        help="FTS5のトークナイザ（既定はtrigram。英語のみなら unicode61 remove_diacritics 2 も可）")
+    args = parser.parse_args()
+    build_knowledge_snapshot(args.input, args.snapshot, lang=args.lang, tokenize=args.tokenize)
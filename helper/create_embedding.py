@@ -1,74 +1,244 @@
 import os
+import sys
 import json
+import argparse
 import pickle
-import time # timeモジュールをインポート
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
-import google.generativeai as genai
 from tqdm import tqdm # 進捗表示のためにtqdmをインポート
 
-def create_omim_embeddings(omim_mapping_path, output_path, batch_size=100):
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from agents.embedding_store import DEFAULT_EMBEDDING_MODEL, open_embedding_store, save_embedding_store, store_exists
+from agents.embedding_cache import embed_texts, get_embedding_cache
+from agents.vector_index import build_vector_index, index_path_prefix
+
+def save_embeddings(vectors, ids, labels, output_path, dtype="float32"):
+    """
+    出力パスの拡張子に応じて保存形式を切り替える。
+    .pklは旧形式のpickle、それ以外はメモリマップ可能なembeddingストア。
+    """
+    if output_path.endswith(".pkl"):
+        with open(output_path, 'wb') as f:
+            pickle.dump({'vectors': vectors, 'ids': ids, 'labels': labels}, f)
+    else:
+        save_embedding_store(vectors, ids, labels, output_path, model=DEFAULT_EMBEDDING_MODEL, dtype=dtype)
+
+def convert_pickle_to_store(pickle_path, output_path, dtype="float32"):
+    """
+    既存のomim_embeddings.pklを再embeddingせずにembeddingストア形式へ変換する。
+    """
+    with open(pickle_path, 'rb') as f:
+        data = pickle.load(f)
+    save_embedding_store(data['vectors'], data['ids'], data['labels'], output_path,
+                         model=DEFAULT_EMBEDDING_MODEL, dtype=dtype)
+    print(f"{len(data['ids'])}件のEmbeddingデータを {output_path} に変換しました。")
+
+def build_normalizer_index(store_path, backend="ivfpq", **params):
+    """
+    embeddingストアからDiseaseNormalizer用の近似検索インデックスを構築して保存する。
+    Args:
+        backend (str): "ivf" または "ivfpq"
+        params: nlist, nprobe, m, rerank
+    """
+    store = open_embedding_store(store_path)
+    index = build_vector_index(backend, store['vectors'], **params)
+    prefix = index_path_prefix(store_path, backend)
+    index.save(prefix)
+    print(f"{len(store['ids'])}件の{backend}インデックスを {prefix} に保存しました。")
+    return index
+
+def _label_hash(omim_id, label):
+    return hashlib.sha256(f"{omim_id}\t{label}".encode("utf-8")).hexdigest()
+
+def build_directory(output_path):
+    """
+    ビルド途中のチャンクとマニフェストを置くディレクトリ（出力ストアの隣）を返す。
+    """
+    prefix = output_path[:-len(".npy")] if output_path.endswith(".npy") else output_path
+    return prefix + ".build"
+
+def load_build_manifest(directory, model):
+    """
+    manifest.jsonl（追記専用、1行=完了したチャンク1件）を読み込み、
+    {(id, 病名のハッシュ): ベクトル} を返す。中断で壊れた最終行と、別モデルのチャンクは無視する。
+    """
+    manifest_path = os.path.join(directory, "manifest.jsonl")
+    completed = {}
+    if not os.path.exists(manifest_path):
+        return completed
+    with open(manifest_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            if entry.get("model") != model:
+                continue
+            chunk_path = os.path.join(directory, entry["file"])
+            if not os.path.exists(chunk_path):
+                continue
+            vectors = np.load(chunk_path)
+            for key, vector in zip(entry["keys"], vectors):
+                completed[tuple(key)] = vector
+    return completed
+
+def _write_chunk(directory, chunk_number, batch, vectors, model, manifest_lock):
     """
-    omim_mapping.jsonを読み込み、レートリミットを考慮しながら
-    バッチ処理で各疾患名をembeddingして保存する関数。
+    チャンクを一時ファイル経由で保存し、その後マニフェストに1行追記してコミットする。
+    """
+    file_name = f"chunk-{chunk_number:06d}-{os.getpid()}.npy"
+    chunk_path = os.path.join(directory, file_name)
+    with open(chunk_path + ".tmp", "wb") as f:
+        np.save(f, vectors)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(chunk_path + ".tmp", chunk_path)
+    entry = {
+        "file": file_name,
+        "model": model,
+        "keys": [[omim_id, _label_hash(omim_id, label)] for omim_id, label in batch]
+    }
+    with manifest_lock:
+        with open(os.path.join(directory, "manifest.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+def _embed_batch(batch, cache):
+    """
+    1バッチをembeddingする。429・一時的なエラーの再試行はLLMGatewayが行い、最後まで失敗した場合は例外を送出する。
+    """
+    labels = [label for _, label in batch]
+    return embed_texts(labels, model=DEFAULT_EMBEDDING_MODEL, task_type="RETRIEVAL_DOCUMENT", cache=cache)
+
+def _existing_vectors(output_path, model):
+    """
+    既存ストアから {(id, 病名のハッシュ): ベクトル} を返す（差分ビルド用）。モデルが異なる場合は空。
+    """
+    if output_path.endswith(".pkl") or not store_exists(output_path):
+        return {}
+    store = open_embedding_store(output_path)
+    if store['model'] != model:
+        print(f"[Embedding] 既存ストアのモデル({store['model']})が異なるため全件を再embeddingします。")
+        return {}
+    return {
+        (omim_id, _label_hash(omim_id, label)): store['vectors'][i]
+        for i, (omim_id, label) in enumerate(zip(store['ids'], store['labels']))
+    }
+
+def _remove_stale_indexes(output_path):
+    # ストアが更新されたため、保存済みの近似インデックスは使えなくなる
+    for backend in ("ivf", "ivfpq"):
+        prefix = index_path_prefix(output_path, backend)
+        for path in (prefix + ".centroids.npy", prefix + ".assignments.npy", prefix + ".npz"):
+            if os.path.exists(path):
+                os.remove(path)
+                print(f"[Embedding] 古いインデックス {path} を削除しました。")
+
+def create_omim_embeddings(omim_mapping_path, output_path, batch_size=100, dtype="float32", use_cache=True,
+                           workers=4, incremental=True):
+    """
+    omim_mapping.jsonを読み込み、各疾患名をembeddingして保存する関数。
+    - バッチはworkers個のスレッドで並行に処理し、レートリミットはLLMGatewayのトークンバケットで制御する
+    - 429・一時的なエラーはLLMGatewayが指数バックオフで再試行し、最後まで失敗したバッチがある場合は
+      ストアを書き換えずに例外を送出する
+    - 完了したバッチは<出力>.build/ にチャンクとして追記し、manifest.jsonlに記録するため、
+      中断したビルドは再実行すると未完了のバッチだけを処理して再開する
+    - incrementalがTrueの場合、既存ストアと病名が変わっていないIDのベクトルは再利用し、
+      新規・変更されたIDだけをembeddingする（削除されたIDはストアから除かれる）
+    output_pathが.npyの場合はL2正規化済みのembeddingストア（dtype: float32/float16）で保存する。
+    use_cacheがTrueの場合、embedding済みの病名はキャッシュから再利用する。
+    Returns:
+        int: 保存した件数
     """
     # 環境変数からGoogle APIキーを読み込む
     api_key = os.getenv("GOOGLE_API_KEY")
     if not api_key:
         raise ValueError("環境変数 'GOOGLE_API_KEY' が設定されていません。")
-    
-    genai.configure(api_key=api_key)
 
     with open(omim_mapping_path, 'r', encoding='utf-8') as f:
         omim_data = json.load(f)
 
     omim_ids = list(omim_data.keys())
     omim_labels = list(omim_data.values())
+    keys = [(omim_id, _label_hash(omim_id, label)) for omim_id, label in zip(omim_ids, omim_labels)]
 
-    print(f"{len(omim_labels)}件のOMIM疾患名をembeddingします (バッチサイズ: {batch_size})")
-
-    all_embeddings = []
-    
-    # バッチ処理のループ (tqdmで進捗を表示)
-    for i in tqdm(range(0, len(omim_labels), batch_size), desc="Embedding Progress"):
-        batch_labels = omim_labels[i:i + batch_size]
-        
-        try:
-            # Googleのembeddingモデルを利用
-            result = genai.embed_content(
-                model="models/embedding-001",
-                content=batch_labels,
-                task_type="RETRIEVAL_DOCUMENT"
-            )
-            all_embeddings.extend(result['embedding'])
-        
-        except Exception as e:
-            print(f"バッチ {i//batch_size + 1} の処理中にエラーが発生しました: {e}")
-            # エラーが発生した場合、少し長めに待機してリトライするなどの処理も考えられます
-            time.sleep(10) # 10秒待機
-            continue
-
-        # APIのレートリミットを避けるために1秒待機
-        time.sleep(1)
-
-    omim_vectors = np.array(all_embeddings)
-    
-    # embeddingが成功したデータのみを保存対象とする
-    successful_count = len(omim_vectors)
-    
-    normalized_data = {
-        'vectors': omim_vectors,
-        'ids': omim_ids[:successful_count],
-        'labels': omim_labels[:successful_count]
-    }
+    directory = build_directory(output_path)
+    os.makedirs(directory, exist_ok=True)
+    available = _existing_vectors(output_path, DEFAULT_EMBEDDING_MODEL) if incremental else {}
+    reused = sum(1 for key in keys if key in available)
+    available.update(load_build_manifest(directory, DEFAULT_EMBEDDING_MODEL))
+    resumed = sum(1 for key in keys if key in available) - reused
+
+    pending = [(omim_id, label) for omim_id, label, key in zip(omim_ids, omim_labels, keys) if key not in available]
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    print(f"{len(omim_labels)}件のOMIM疾患名のうち、既存ストアから{reused}件・中断したビルドから{resumed}件を再利用し、"
+          f"{len(pending)}件をembeddingします (バッチサイズ: {batch_size}, 並列数: {workers})")
+
+    cache = get_embedding_cache() if use_cache else None
+    manifest_lock = threading.Lock()
+    failed = []
+
+    def process(chunk_number, batch):
+        vectors = _embed_batch(batch, cache)
+        _write_chunk(directory, chunk_number, batch, vectors, DEFAULT_EMBEDDING_MODEL, manifest_lock)
+        return batch, vectors
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process, n, batch): n for n, batch in enumerate(batches)}
+        # バッチ処理の進捗をtqdmで表示
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Embedding Progress"):
+            try:
+                batch, vectors = future.result()
+            except Exception as e:
+                print(f"バッチ {futures[future] + 1} の処理中にエラーが発生しました: {e}")
+                failed.append(futures[future])
+                continue
+            for (omim_id, label), vector in zip(batch, vectors):
+                available[(omim_id, _label_hash(omim_id, label))] = vector
 
-    with open(output_path, 'wb') as f:
-        pickle.dump(normalized_data, f)
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)}個のバッチのembeddingに失敗しました。完了分は {directory} に保存済みのため、"
+            f"再実行すると失敗したバッチから再開します。"
+        )
 
-    print(f"\n{successful_count}件のEmbeddingデータを {output_path} に保存しました。")
+    # omim_mapping.jsonの順序でIDとベクトルを揃えて保存する（件数の不一致は起こらない）
+    omim_vectors = np.stack([np.asarray(available[key], dtype=np.float32) for key in keys]) \
+        if keys else np.zeros((0, 0), dtype=np.float32)
+    save_embeddings(omim_vectors, omim_ids, omim_labels, output_path, dtype=dtype)
+    if not output_path.endswith(".pkl"):
+        _remove_stale_indexes(output_path)
+    shutil.rmtree(directory, ignore_errors=True)
 
+    print(f"\n{len(omim_ids)}件のEmbeddingデータを {output_path} に保存しました。")
+    return len(omim_ids)
 
 
-try:
-    create_omim_embeddings('./data/omim_mapping.json', './data/omim_embeddings.pkl')
-except ValueError as e:
-    print(e)
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OMIM疾患名のembeddingストアと検索インデックスを作成する")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16"])
+    parser.add_argument("--index", default=None, choices=["ivf", "ivfpq"], help="近似検索インデックスも構築する")
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--pq-m", type=int, default=16, help="PQのサブ空間数（次元数の約数）")
+    parser.add_argument("--rerank", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=4, help="並行して処理するバッチ数")
+    parser.add_argument("--full", action="store_true", help="既存ストアを再利用せず全件を再embeddingする")
+    args = parser.parse_args()
+    try:
+        if os.path.exists('./data/omim_embeddings.pkl') and not os.path.exists('./data/omim_embeddings.npy') \
+                and not args.full:
+            # 旧形式を変換したうえで、差分ビルドで新規・変更された病名だけをembeddingする
+            convert_pickle_to_store('./data/omim_embeddings.pkl', './data/omim_embeddings.npy', dtype=args.dtype)
+        create_omim_embeddings('./data/omim_mapping.json', './data/omim_embeddings.npy', batch_size=args.batch_size,
+                               dtype=args.dtype, workers=args.workers, incremental=not args.full)
+        if args.index:
+            build_normalizer_index('./data/omim_embeddings.npy', args.index, nlist=args.nlist,
+                                   nprobe=args.nprobe, m=args.pq_m, rerank=args.rerank)
+    except (ValueError, RuntimeError) as e:
+        print(e)
\ No newline at end of file
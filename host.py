@@ -1,11 +1,23 @@
 import os
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from agents.knowledge_searcher import KnowledgeSearcher
 from agents.case_searcher import CaseSearcher
-from agents.phenotype_analyzer import PhenotypeAnalyzer
-from agents.disease_normalizer import DiseaseNormalizer
-from agents.self_reflection_agent import SelfReflectionAgent
-import google.generativeai as genai
+from agents.phenotype_analyzer import PhenotypeAnalyzer, DEFAULT_ANALYZER_TIMEOUT
+from agents.disease_normalizer import get_disease_normalizer
+from agents.lexical_index import DEFAULT_LEXICAL_THRESHOLD
+from agents.self_reflection_agent import SelfReflectionAgent, PROMPT6_PREFIX_TEMPLATE, PROMPT6_TEMPLATE
 from agents.hpo_mapping import HPOMapping
+from agents.hpo_ontology import load_hpo_ontology, DEFAULT_HPO_PATH
+from agents.case_index import load_case_index, DEFAULT_CASE_INDEX_DIR
+from agents.llm_gateway import get_llm_gateway, PRIORITY_REPORT, DEFAULT_GENERATION_MODEL
+from agents.embedding_store import DEFAULT_EMBEDDING_MODEL
+from agents.result_store import DiagnosisResultStore, RESULT_STORE_FORMAT_VERSION, fingerprint
+from agents.context_assembler import (ContextAssembler, DEFAULT_REPORT_TOKEN_BUDGET,
+                                      DEFAULT_JUDGE_CASES_TOKEN_BUDGET)
+from agents import tracing
 
 PROMPT4_TEMPLATE = """
 You are a specialist in the field of rare diseases.
@@ -48,8 +60,129 @@ Based on the above and your knowledge, enumerate the **top 5 most likely rare di
 6. Use bold formatting (**) only for the 'DIAGNOSIS NAME'. Do not use it anywhere else in the output.
 """
 
+RETRY_PROMPT_TEMPLATE = """
+**Previously rejected diagnoses:**
+The following diagnoses were proposed in an earlier attempt and judged incorrect for this patient after review:
+{rejected_diagnoses}
+Do not propose these diagnoses again. Reconsider the evidence above and propose alternative rare diseases.
+"""
+
+
+
 
+# 情報収集ソースごとのタイムアウト（秒）。configの"source_timeouts"で上書きできる。
+DEFAULT_SOURCE_TIMEOUTS = {
+    "knowledge_searcher": 60,
+    "case_searcher": 30,
+    "phenotype_analyzer": 120
+}
+# 情報収集の並行数（ソースの数。1回のrunで各ソースを1つずつ実行する）
+DEFAULT_MAX_WORKERS = len(DEFAULT_SOURCE_TIMEOUTS)
+# 情報収集ソース名とmemory上のキーの対応
+EVIDENCE_KEYS = {
+    "knowledge_searcher": "knowledge",
+    "case_searcher": "cases",
+    "phenotype_analyzer": "candidates"
+}
+REPORT_FAILED_MESSAGE = "診断レポート生成に失敗しました。"
 
+# 診断結果に影響しない設定（保存済みの結果を検索する際の指紋に含めない）
+NON_SEMANTIC_CONFIG_KEYS = (
+    "max_workers", "source_timeouts", "trace_path", "trace_format", "knowledge_cache", "prefetch_knowledge",
+    "reflection_concurrency", "result_store_path", "reuse_results", "reuse_evidence", "result_max_age"
+)
+# 情報収集の結果に影響する設定（保存済みの根拠を再利用する際の指紋に含める）
+EVIDENCE_CONFIG_KEYS = (
+    "knowledge_searcher", "case_searcher", "case_search_backend", "case_index_dir", "phenotype_analyzer",
+    "knowledge_lang", "knowledge_backend", "pubcasefinder_backend", "hpoa_path", "hpo_ontology_path",
+    "local_ranker_method", "canonicalize_hpo", "normalizer_index_backend", "normalizer_index_params",
+    "normalizer_lexical_threshold"
+)
+DEFAULT_HOST_CONFIG = {
+    "knowledge_searcher": True,
+    "case_searcher": True,
+    "case_search_backend": "local",
+    "phenotype_analyzer": True,
+    "disease_normalizer": True,
+    "self_reflection": True
+}
+
+
+def shared_disease_normalizer(config):
+    """
+    configに対応するプロセス共通のDiseaseNormalizerを返す。
+    """
+    return get_disease_normalizer(
+        index_backend=config.get("normalizer_index_backend", "exact"),
+        # {"nlist", "nprobe", "m", "rerank"} のうち指定したもの（近似インデックスの構築・検索のパラメータ）
+        index_params=config.get("normalizer_index_params"),
+        lexical_threshold=config.get("normalizer_lexical_threshold", DEFAULT_LEXICAL_THRESHOLD)
+    )
+
+
+def shared_local_ranker(config):
+    """
+    configの"pubcasefinder_backend"が"local"の場合に、プロセス共通のローカルランカーを返す（それ以外はNone）。
+    """
+    if config.get("pubcasefinder_backend", "remote") != "local":
+        return None
+    # scipyのimportを伴うため、ローカルランカーを使う場合のみ読み込む
+    from agents.local_phenotype_ranker import load_local_phenotype_ranker, DEFAULT_HPOA_PATH
+    return load_local_phenotype_ranker(
+        hpoa_path=config.get("hpoa_path", DEFAULT_HPOA_PATH),
+        hpo_path=config.get("hpo_ontology_path", DEFAULT_HPO_PATH),
+        method=config.get("local_ranker_method", "ic_overlap")
+    )
+
+
+def warm_up_shared_data(config=None):
+    """
+    hostを生成せずに、configで使うプロセス共通のデータ（OMIMのembedding・検索インデックス・字句インデックス、
+    HPOオントロジー、ローカルランカー、症例インデックス、Gemini SDK）を読み込む。
+    ワーカーごとにhostを生成するランナーが、ワーカーの開始前に呼び出す。
+    Returns:
+        dict: {データ名: 読み込みにかかった時間（ミリ秒）}
+    """
+    config = config or DEFAULT_HOST_CONFIG
+    loaders = {}
+    if config.get("phenotype_analyzer") or config.get("self_reflection", True):
+        loaders["disease_normalizer"] = lambda: shared_disease_normalizer(config).load()
+    if config.get("canonicalize_hpo"):
+        loaders["hpo_ontology"] = lambda: load_hpo_ontology(config.get("hpo_ontology_path", DEFAULT_HPO_PATH))
+    if config.get("phenotype_analyzer"):
+        loaders["local_ranker"] = lambda: shared_local_ranker(config)
+    case_index_dir = config.get("case_index_dir", DEFAULT_CASE_INDEX_DIR)
+    if (config.get("case_searcher") and config.get("case_search_backend", "remote") == "local"
+            and os.path.exists(os.path.join(case_index_dir, "meta.json"))):
+        loaders["case_index"] = lambda: load_case_index(case_index_dir)
+    timings = {}
+    for name, load in loaders.items():
+        started = time.perf_counter()
+        load()
+        timings[name] = round((time.perf_counter() - started) * 1000, 1)
+    started = time.perf_counter()
+    try:
+        get_llm_gateway().get_model()
+    except Exception as e:
+        print(f"[Host] Geminiの初期化をスキップしました: {e}")
+    timings["llm_gateway"] = round((time.perf_counter() - started) * 1000, 1)
+    return timings
+
+
+class _Component:
+    """
+    RareDiseaseDiagnosisHostのエージェントを、初回アクセス時に_build_<名前>で生成するデスクリプタ。
+    """
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, host, owner=None):
+        if host is None:
+            return self
+        return host._component(self.name)
+
+    def __set__(self, host, value):
+        host._components[self.name] = value
 
 
 class RareDiseaseDiagnosisHost:
@@ -57,98 +190,606 @@ class RareDiseaseDiagnosisHost:
     希少疾患診断支援AIエージェントの中央ホスト/制御クラス
     各エージェントを統合し、ワークフローを制御する
     """
-    def __init__(self, config=None):
-        self.config = config or {
-            "knowledge_searcher": True,
-            "case_searcher": False,
-            "phenotype_analyzer": True,
-            "disease_normalizer": True,
-            "self_reflection": True
-        }
-        self.knowledge_searcher = KnowledgeSearcher()
-        self.case_searcher = CaseSearcher()
-        self.phenotype_analyzer = PhenotypeAnalyzer()
-        self.disease_normalizer = DiseaseNormalizer()
-        self.self_reflection_agent = SelfReflectionAgent(
-            disease_normalizer=self.disease_normalizer,
-            knowledge_searcher=self.knowledge_searcher,
-             
+    knowledge_searcher = _Component()
+    case_searcher = _Component()
+    phenotype_analyzer = _Component()
+    self_reflection_agent = _Component()
+    disease_normalizer = _Component()
+    hpo_mapping = _Component()
+    llm_gateway = _Component()
+
+    def __init__(self, config=None, llm_gateway=None, http_client=None, knowledge_client=None,
+                 hpo_mapping=None, disease_normalizer=None):
+        """
+        llm_gateway / http_client / knowledge_client（Wikipedia検索） / hpo_mapping / disease_normalizer を
+        指定した場合は、プロセス共通の既定のクライアントの代わりに使う（記録済みレスポンスの再生など）。
+        各エージェントは初回の利用時に生成する（起動を速くするため）。前もって生成する場合はwarm_upを呼ぶ。
+        """
+        self.config = config or dict(DEFAULT_HOST_CONFIG)
+        self.executor = self._new_executor()
+        # 知識の先読みは情報収集のスレッドを占有しないよう別のスレッドで行う（並行取得はKnowledgeSearcher内のプールで行う）
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="host-prefetch")
+        self.http_client = http_client
+        self.knowledge_client = knowledge_client
+        # configの"trace_path"を指定するとspanをファイルに書き出す（"trace_format": "jsonl" / "otlp"）
+        self.trace_exporters = tracing.build_exporters(
+            self.config.get("trace_path"), self.config.get("trace_format", "jsonl")
+        )
+        # プロンプトに入れる根拠のトークン予算（"report_context_tokens": 診断レポート、"judge_cases_tokens": 自己評価の類似症例）
+        self.context_assembler = ContextAssembler(
+            token_budget=self.config.get("report_context_tokens", DEFAULT_REPORT_TOKEN_BUDGET)
         )
+        self._components = {}
+        # エージェントの生成は他のエージェントの生成を呼び出すため再入可能なロックを使う
+        self._components_lock = threading.RLock()
+        # コンポーネントごとの生成にかかった時間（ミリ秒）
+        self.startup_timings = {}
+        for name, component in (("llm_gateway", llm_gateway), ("hpo_mapping", hpo_mapping),
+                                ("disease_normalizer", disease_normalizer)):
+            if component is not None:
+                self._components[name] = component
+        self._check_case_index()
+        # configの"result_store_path"を指定すると各runの結果と根拠を保存する。
+        # "reuse_results"で同じHPOセット・設定の保存済みの結果を返し、"reuse_evidence"で保存済みの根拠を再利用する
+        result_store_path = self.config.get("result_store_path")
+        self.result_store = DiagnosisResultStore(result_store_path) if result_store_path else None
         self.memory = []
         self.diagnosis_list = []
 
+    def _new_executor(self):
+        return ThreadPoolExecutor(
+            max_workers=self.config.get("max_workers", DEFAULT_MAX_WORKERS),
+            thread_name_prefix="host-source"
+        )
 
-    
-    def run(self, hpo_list):
-        max_retry = 2  # In order to limit the usage of API Key, set maximum for self-reflection.
-        retry_count = 0
-
-        hpo_mapping = HPOMapping()
-        hpoid_label_list = hpo_mapping.convert(hpo_list)
-
-        while (retry_count < max_retry):
-        # collecting information and generating candidates
-            if self.config["knowledge_searcher"]:
-                knowledge = self.knowledge_searcher.search(", ".join(hpoid_label_list))
-            else:
-                knowledge = []
-            if self.config["case_searcher"]:
-                cases = self.case_searcher.search(",".join(hpoid_label_list))
-            else:
-                cases = []
-            if self.config["phenotype_analyzer"]:
-                candidates = self.phenotype_analyzer.analyze(hpo_list)
-            else:
-                candidates = {"pubcasefinder": [], "gemini": []}
-        # reset memory when it is first try.
-            if retry_count == 0:
-                self.memory = []
-            self.memory.append({
-                "knowledge": knowledge,
-                "cases": cases,
-                "candidates": candidates
-            })
-
-            prompt = PROMPT4_TEMPLATE.format(
-            web_diagnosis=str(knowledge),
-            llm_response=str(candidates.get("gemini")),
-            diagnosis_api_response=str(candidates.get("pubcasefinder")),
-            similar_case_detailed=str(cases),
-            patient_info=str(hpo_list)
+    def close(self):
+        """
+        情報収集・先読みのスレッドと結果ストアの接続を解放する。実行中のソースの完了は待たない。
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.prefetch_executor.shutdown(wait=False, cancel_futures=True)
+        if self.result_store is not None:
+            self.result_store.close()
+            self.result_store = None
+
+    def source_timeouts(self):
+        """
+        情報収集ソースごとのタイムアウト（秒）。configの"source_timeouts"で上書きできる。
+        """
+        timeouts = dict(DEFAULT_SOURCE_TIMEOUTS)
+        timeouts.update(self.config.get("source_timeouts", {}))
+        return timeouts
+
+    def _component(self, name):
+        component = self._components.get(name)
+        if component is not None:
+            return component
+        with self._components_lock:
+            component = self._components.get(name)
+            if component is None:
+                started = time.perf_counter()
+                component = getattr(self, f"_build_{name}")()
+                self.startup_timings[name] = round((time.perf_counter() - started) * 1000, 1)
+                self._components[name] = component
+        return component
+
+    def enabled_components(self):
+        """
+        configで有効な処理に必要なコンポーネント名を、依存されるものから順に返す。
+        """
+        names = ["llm_gateway", "hpo_mapping"]
+        if self.config.get("phenotype_analyzer") or self.config.get("self_reflection", True):
+            names.append("disease_normalizer")
+        if self.config.get("knowledge_searcher") or self.config.get("self_reflection", True):
+            names.append("knowledge_searcher")
+        if self.config.get("case_searcher"):
+            names.append("case_searcher")
+        if self.config.get("phenotype_analyzer"):
+            names.append("phenotype_analyzer")
+        if self.config.get("self_reflection", True):
+            names.append("self_reflection_agent")
+        return names
+
+    def warm_up(self, components=None):
+        """
+        エージェントの生成と重いデータの読み込み（OMIMのembedding・検索インデックス・字句インデックス、
+        Gemini SDKのimportなど）を前もって行う。常駐サービスの起動時やワーカーのフォーク前に呼び出すと、
+        最初の診断に初期化の待ち時間が含まれない。APIキーがない場合も失敗せず、警告のみ表示する。
+        Args:
+            components (list): 初期化するコンポーネント名（Noneの場合はconfigで有効なものすべて）
+        Returns:
+            dict: {コンポーネント名: 初期化にかかった時間（ミリ秒）}
+        """
+        timings = {}
+        for name in components or self.enabled_components():
+            started = time.perf_counter()
+            component = getattr(self, name)
+            if name == "disease_normalizer":
+                component.load()
+            elif name == "llm_gateway":
+                try:
+                    component.get_model()
+                except Exception as e:
+                    print(f"[Host] Geminiの初期化をスキップしました: {e}")
+            timings[name] = round((time.perf_counter() - started) * 1000, 1)
+        if self.config.get("canonicalize_hpo"):
+            started = time.perf_counter()
+            load_hpo_ontology(self.config.get("hpo_ontology_path", DEFAULT_HPO_PATH))
+            timings["hpo_ontology"] = round((time.perf_counter() - started) * 1000, 1)
+        return timings
+
+    def _build_llm_gateway(self):
+        return get_llm_gateway()
+
+    def _build_hpo_mapping(self):
+        return HPOMapping()
+
+    def _build_knowledge_searcher(self):
+        return KnowledgeSearcher(
+            lang=self.config.get("knowledge_lang", "ja"),
+            backend=self.config.get("knowledge_backend", "wikipedia"),
+            use_cache=self.config.get("knowledge_cache", True),
+            wiki=self.knowledge_client
+        )
+
+    def _build_disease_normalizer(self):
+        return shared_disease_normalizer(self.config)
+
+    def _build_phenotype_analyzer(self):
+        local_ranker = shared_local_ranker(self.config)
+        return PhenotypeAnalyzer(
+            disease_normalizer=self.disease_normalizer,
+            hpo_mapper=self.hpo_mapping,
+            http_client=self.http_client,
+            llm_gateway=self.llm_gateway,
+            local_ranker=local_ranker,
+            # PubCaseFinderとGeminiの呼び出しは並行するが、その後に病名の正規化があるため余裕を残す
+            timeout=min(DEFAULT_ANALYZER_TIMEOUT, self.source_timeouts()["phenotype_analyzer"])
+        )
+
+    def _build_self_reflection_agent(self):
+        return SelfReflectionAgent(
+            disease_normalizer=self.disease_normalizer,
+            knowledge_searcher=self.knowledge_searcher,
+            llm_gateway=self.llm_gateway,
+            context_assembler=self.context_assembler,
+            max_concurrency=self.config.get("reflection_concurrency", 5),
+            min_accepted=self.config.get("reflection_min_accepted")
+        )
+
+    def _check_case_index(self):
+        """
+        症例検索のバックエンドが"local"でインデックスが構築されていなければ症例検索を無効にする。
+        """
+        if self.config.get("case_search_backend", "remote") != "local" or not self.config["case_searcher"]:
+            return
+        index_dir = self.config.get("case_index_dir", DEFAULT_CASE_INDEX_DIR)
+        if not os.path.exists(os.path.join(index_dir, "meta.json")):
+            print(f"[Host] 症例インデックス {index_dir} が見つからないため症例検索を無効にします。")
+            self.config = dict(self.config, case_searcher=False)
+
+    def _build_case_searcher(self):
+        """
+        症例検索のバックエンドを選ぶ。"local"の場合はローカル症例インデックスを使う。
+        """
+        if self.config.get("case_search_backend", "remote") != "local":
+            return CaseSearcher(http_client=self.http_client, timeout=self.source_timeouts()["case_searcher"])
+        index_dir = self.config.get("case_index_dir", DEFAULT_CASE_INDEX_DIR)
+        if not os.path.exists(os.path.join(index_dir, "meta.json")):
+            return CaseSearcher(local_index=None)
+        return CaseSearcher(local_index=load_case_index(index_dir))
+
+    def gather_evidence(self, hpo_list, hpoid_label_list, sources=None):
+        """
+        知識検索・症例検索・表現型解析を並行して実行する。
+        ソースごとのタイムアウトを超えたもの、失敗したものは空の結果とし、
+        得られた結果だけで処理を続ける（部分結果）。
+        sourcesを指定した場合はそのソースのみ実行する（再試行時の再取得用）。
+        Returns:
+            tuple: (knowledge, cases, candidates, failed_sources)
+        """
+        timeouts = self.source_timeouts()
+        defaults = {
+            "knowledge_searcher": [],
+            "case_searcher": [],
+            "phenotype_analyzer": {"pubcasefinder": [], "gemini": []}
+        }
+        tasks = {}
+        if sources is None:
+            sources = list(defaults)
+        if self.config["knowledge_searcher"]:
+            tasks["knowledge_searcher"] = (self.knowledge_searcher.search, ", ".join(hpoid_label_list))
+        if self.config["case_searcher"]:
+            tasks["case_searcher"] = (self.case_searcher.search, ",".join(hpoid_label_list))
+        if self.config["phenotype_analyzer"]:
+            tasks["phenotype_analyzer"] = (self.phenotype_analyzer.analyze, hpo_list)
+        tasks = {name: task for name, task in tasks.items() if name in sources}
+
+        def run_source(name, func, arg):
+            with tracing.span(f"source.{name}"):
+                return func(arg)
+
+        with tracing.span("host.gather_evidence", sources=",".join(tasks)) as span:
+            started = time.monotonic()
+            futures = {
+                name: self.executor.submit(tracing.bind_context(run_source), name, func, arg)
+                for name, (func, arg) in tasks.items()
+            }
+            results = dict(defaults)
+            failed_sources = []
+            stalled = False
+            for name, future in futures.items():
+                remaining = max(0, started + timeouts[name] - time.monotonic())
+                try:
+                    results[name] = future.result(timeout=remaining)
+                except FutureTimeoutError as e:
+                    stalled = not future.cancel() or stalled
+                    span.record_error(e)
+                    print(f"[Host] {name} がタイムアウトしました ({timeouts[name]}秒)")
+                    failed_sources.append(name)
+                except Exception as e:
+                    span.record_error(e)
+                    print(f"[Host] {name} 失敗: {e}")
+                    failed_sources.append(name)
+            span.set(failed_sources=",".join(failed_sources))
+        if stalled:
+            # 実行中のソースは止められないため、後続の情報収集がその完了を待たないよう新しいスレッドで行う
+            stalled_executor, self.executor = self.executor, self._new_executor()
+            stalled_executor.shutdown(wait=False)
+        return (
+            results["knowledge_searcher"],
+            results["case_searcher"],
+            results["phenotype_analyzer"],
+            failed_sources
+        )
+
+    def build_report_prompt(self, hpo_list, knowledge, cases, candidates, rejected_diagnoses=None):
+        """
+        根拠を重複除去・予算内に切り詰めた形（ContextAssembler）で診断レポート用プロンプトを組み立てる。
+        """
+        with tracing.span("host.build_prompt"):
+            context = self.context_assembler.assemble_report(knowledge, cases, candidates)
+        prompt = PROMPT4_TEMPLATE.format(
+        patient_info=", ".join(hpo_list),
+        **context
+        )
+        if rejected_diagnoses:
+            prompt += RETRY_PROMPT_TEMPLATE.format(
+                rejected_diagnoses="\n".join(f"- {name}" for name in rejected_diagnoses)
             )
+        return prompt
 
-            genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-            model = genai.GenerativeModel("gemini-2.5-flash")
+    def generate_report(self, prompt):
+        with tracing.span("host.report") as span:
             try:
-                response = model.generate_content(prompt)
-                diagnosis_report = response.text
+                return self.llm_gateway.generate(prompt, priority=PRIORITY_REPORT)
             except Exception as e:
+                span.record_error(e)
                 print(f"[Host] Gemini診断レポート生成失敗: {e}")
-                diagnosis_report = "診断レポート生成に失敗しました。"
-
-        
-            if self.config.get("self_reflection", True):
-                reflection_result = self.self_reflection_agent.reflect(
-                    diagnosis_report=diagnosis_report,
-                    patient_info=", ".join(hpo_list),
-                    similar_case_detailed=str(cases),
-                )
-                retry_count += 1
-            else:
-                reflection_result = None
+                return REPORT_FAILED_MESSAGE
+
+    def stream_report(self, prompt, received):
+        """
+        診断レポートをストリーミングで生成し、断片を順に返す。受信した断片はreceivedに蓄積する。
+        """
+        try:
+            for text in self.llm_gateway.generate_stream(prompt, priority=PRIORITY_REPORT):
+                received.append(text)
+                yield text
+        except Exception as e:
+            tracing.current_span().record_error(e)
+            print(f"[Host] Gemini診断レポート生成失敗: {e}")
+            if not received:
+                received.append(REPORT_FAILED_MESSAGE)
+
+    def prepare(self, hpo_list):
+        """
+        HPOリストを（設定に応じて）正規化し、情報収集を行ってmemoryに保存する。
+        Returns:
+            tuple: (hpo_list, hpoid_label_list)
+        """
+        if self.config.get("canonicalize_hpo"):
+            # 冗長な祖先タームと旧IDをローカルのHPOオントロジーで整理する
+            ontology = load_hpo_ontology(self.config.get("hpo_ontology_path", DEFAULT_HPO_PATH))
+            hpo_list = ontology.canonicalize(hpo_list)
+        hpoid_label_list = self.hpo_mapping.convert(hpo_list)
+
+        # collecting information and generating candidates (concurrently)
+        evidence = self.stored_evidence(hpo_list)
+        if evidence is not None:
+            knowledge, cases, candidates, failed_sources = (
+                evidence["knowledge"], evidence["cases"], evidence["candidates"], []
+            )
+        else:
+            knowledge, cases, candidates, failed_sources = self.gather_evidence(hpo_list, hpoid_label_list)
+        self.memory = [{
+            "hpo_list": list(hpo_list),
+            "knowledge": knowledge,
+            "cases": cases,
+            "candidates": candidates,
+            "failed_sources": failed_sources,
+            "stored": evidence is not None
+        }]
+        if self.config.get("self_reflection", True) and self.config.get("prefetch_knowledge", True):
+            # 自己評価で参照される候補疾患の知識を、診断レポートの生成と並行して先読みする
+            self.prefetch_executor.submit(tracing.bind_context(self.knowledge_searcher.prefetch),
+                                          self.candidate_labels(candidates))
+        return hpo_list, hpoid_label_list
+
+    def judge_cases(self, cases):
+        """
+        自己評価の各プロンプトで共通に使う類似症例の文字列（全診断で同一にして共通の接頭辞にする）。
+        """
+        return self.context_assembler.format_cases(
+            cases, self.config.get("judge_cases_tokens", DEFAULT_JUDGE_CASES_TOKEN_BUDGET)
+        )
+
+    @staticmethod
+    def candidate_labels(candidates):
+        labels = [item.get("label") for item in candidates.get("gemini", []) if isinstance(item, dict)]
+        labels += [item.get("omim_disease_name_en") for item in candidates.get("pubcasefinder", [])
+                   if isinstance(item, dict)]
+        return [label for label in labels if label]
+
+    def refresh_evidence(self, hpo_list, hpoid_label_list):
+        """
+        再試行時は決定的な情報源の結果をmemoryから再利用し、失敗したソースのみ再取得する。
+        Returns:
+            dict: memory[0]（knowledge, cases, candidates, failed_sources）
+        """
+        evidence = self.memory[0]
+        if evidence["failed_sources"]:
+            *retried, still_failed = self.gather_evidence(
+                hpo_list, hpoid_label_list, sources=evidence["failed_sources"]
+            )
+            retried = dict(zip(EVIDENCE_KEYS.values(), retried))
+            for name in evidence["failed_sources"]:
+                if name not in still_failed:
+                    evidence[EVIDENCE_KEYS[name]] = retried[EVIDENCE_KEYS[name]]
+            evidence["failed_sources"] = still_failed
+        return evidence
+
+    def run_fingerprint(self):
+        """
+        診断結果に影響する設定・モデル・プロンプトの指紋（保存済みの結果の検索キー）。
+        """
+        return fingerprint({
+            "format_version": RESULT_STORE_FORMAT_VERSION,
+            "config": {key: value for key, value in self.config.items() if key not in NON_SEMANTIC_CONFIG_KEYS},
+            "generation_model": DEFAULT_GENERATION_MODEL,
+            "embedding_model": DEFAULT_EMBEDDING_MODEL,
+            "prompts": [PROMPT4_TEMPLATE, RETRY_PROMPT_TEMPLATE, PROMPT6_PREFIX_TEMPLATE, PROMPT6_TEMPLATE]
+        })
+
+    def evidence_fingerprint(self):
+        """
+        情報収集の結果に影響する設定・モデルの指紋（保存済みの根拠の検索キー）。
+        """
+        return fingerprint({
+            "format_version": RESULT_STORE_FORMAT_VERSION,
+            "config": {key: self.config.get(key) for key in EVIDENCE_CONFIG_KEYS},
+            "generation_model": DEFAULT_GENERATION_MODEL,
+            "embedding_model": DEFAULT_EMBEDDING_MODEL
+        })
+
+    def stored_result(self, hpo_list):
+        """
+        同じHPOセット・設定の保存済みの結果を返す（ないか、"result_max_age"秒より古い場合はNone）。
+        """
+        if self.result_store is None:
+            return None
+        with tracing.span("host.result_store.lookup") as span:
+            stored = self.result_store.latest_run(hpo_list, self.run_fingerprint(), self.config.get("result_max_age"))
+            span.set(hit=stored is not None)
+        if stored is None:
+            return None
+        result = stored["result"]
+        self.memory = [{
+            "hpo_list": list(hpo_list),
+            "knowledge": result["knowledge"],
+            "cases": result["cases"],
+            "candidates": result["candidates"],
+            "failed_sources": result["failed_sources"],
+            "stored": True
+        }]
+        result["result_store"] = {"hit": True, "run_id": stored["id"], "created": stored["created"]}
+        return result
+
+    def stored_evidence(self, hpo_list):
+        """
+        "reuse_evidence"が有効な場合、同じHPOセット・設定で保存済みの根拠を返す（ない場合はNone）。
+        """
+        if self.result_store is None or not self.config.get("reuse_evidence"):
+            return None
+        with tracing.span("host.result_store.evidence") as span:
+            evidence = self.result_store.load_evidence(
+                hpo_list, self.evidence_fingerprint(), self.config.get("result_max_age")
+            )
+            span.set(hit=evidence is not None)
+        return evidence
+
+    def store_result(self, hpo_list, result):
+        """
+        runの結果と、再利用できるよう根拠を別に保存する。
+        情報源・レポート生成・自己評価のいずれかが失敗した結果は、根拠も含めて保存しない（一時的な障害の結果を再利用しないため）。
+        """
+        if self.result_store is None:
+            return
+        try:
+            if self.is_degraded(result):
+                result["result_store"] = {"hit": False, "run_id": None}
+                return
+            run_id = self.result_store.save_run(hpo_list, self.run_fingerprint(), self.config, result)
+            evidence = self.memory[0] if self.memory else None
+            # 保存済みの根拠を再利用した場合は保存し直さない（保存日時を更新するとresult_max_ageが効かなくなる）
+            if evidence is not None and not evidence.get("stored"):
+                self.result_store.save_evidence(evidence["hpo_list"], self.evidence_fingerprint(), {
+                    "knowledge": evidence["knowledge"],
+                    "cases": evidence["cases"],
+                    "candidates": evidence["candidates"]
+                })
+        except Exception as e:
+            print(f"[Host] 診断結果の保存失敗: {e}")
+            return
+        result["result_store"] = {"hit": False, "run_id": run_id}
+
+    @staticmethod
+    def is_degraded(result):
+        """
+        失敗した情報源がある、レポート生成に失敗した、またはtraceにエラーが記録された結果かどうか。
+        """
+        return bool(
+            result.get("failed_sources")
+            or result.get("diagnosis_report") == REPORT_FAILED_MESSAGE
+            or (result.get("trace") or {}).get("errors")
+        )
+
+    def _reuse_results(self, reuse):
+        return self.config.get("reuse_results", False) if reuse is None else reuse
+
+    def run(self, hpo_list, reuse=None):
+        """
+        診断を実行する。戻り値の"trace"にはステージごとの所要時間・トークン数・キャッシュヒット数・
+        エラーの集計（tracing.Trace.summary）を含める。
+        result_storeがある場合は結果（失敗を含むものを除く）を保存し、reuse（Noneの場合はconfigの"reuse_results"）がTrueなら
+        同じHPOセット・設定の保存済みの結果をそのまま返す（戻り値の"result_store"に保存済みの結果のIDを含める）。
+        """
+        with tracing.start_trace("host.run", exporters=self.trace_exporters, hpo_terms=len(hpo_list)) as trace:
+            stored = self.stored_result(hpo_list) if self._reuse_results(reuse) else None
+            result = stored if stored is not None else self._run(hpo_list)
+        result["trace"] = trace.summary()
+        if stored is None:
+            self.store_result(hpo_list, result)
+        return result
 
-        # acceptedがなければ再診断（上限回数まで）
-            if reflection_result and reflection_result.get("accepted") == [] and retry_count < max_retry:
-                retry_count += 1
-                continue  # 1からやり直し
-            else:
+    def _run(self, hpo_list):
+        max_retry = 2  # In order to limit the usage of API Key, set maximum for self-reflection.
+
+        hpo_list, hpoid_label_list = self.prepare(hpo_list)
+        evidence = self.memory[0]
+
+        rejected_diagnoses = []
+        for attempt in range(max_retry):
+            if attempt > 0:
+                evidence = self.refresh_evidence(hpo_list, hpoid_label_list)
+            knowledge = evidence["knowledge"]
+            cases = evidence["cases"]
+            candidates = evidence["candidates"]
+            failed_sources = evidence["failed_sources"]
+
+            # LLMの段階（診断レポート生成と自己評価）のみ毎回やり直す
+            prompt = self.build_report_prompt(hpo_list, knowledge, cases, candidates, rejected_diagnoses)
+            diagnosis_report = self.generate_report(prompt)
+
+            if not self.config.get("self_reflection", True):
+                reflection_result = None
                 break
+            reflection_result = self.self_reflection_agent.reflect(
+                diagnosis_report=diagnosis_report,
+                patient_info=", ".join(hpo_list),
+                similar_case_detailed=self.judge_cases(cases),
+            )
+            # acceptedがなければ却下された診断をフィードバックして再診断（上限回数まで）
+            if reflection_result.get("accepted"):
+                break
+            rejected_diagnoses.extend(
+                item["disease_name"] for item in reflection_result.get("rejected", [])
+                if item["disease_name"] not in rejected_diagnoses
+            )
 
         return {
         "diagnosis_report": diagnosis_report,
         "knowledge": knowledge,
         "cases": cases,
         "candidates": candidates,
+        "failed_sources": failed_sources,
+        "self_reflection": reflection_result
+        }
+
+    async def run_stream(self, hpo_list, reuse=None):
+        """
+        runのストリーミング版（非同期ジェネレータ）。診断レポートをストリーミングで受信し、
+        各診断ブロックが完結した時点で自己評価を開始する（後続の診断の生成と評価が並行する）。
+        次のイベントを順に返す:
+            {"event": "stage", "stage": "evidence", "failed_sources": [...]}（情報収集の完了）
+            {"event": "stage", "stage": "report", "attempt": 試行番号}（診断レポートの生成開始）
+            {"event": "verdict", "attempt": 試行番号, ...評価結果（rank, disease_name, disease, eval_result, is_accepted など）}
+            {"event": "result", ...runと同じ形式の最終結果}
+        """
+        trace, previous = tracing.begin_trace("host.run_stream", hpo_terms=len(hpo_list))
+        ended = False
+        try:
+            stored = self.stored_result(hpo_list) if self._reuse_results(reuse) else None
+            if stored is not None:
+                # 保存済みの結果がある場合は自己評価のイベントを返さず、結果のみを返す
+                tracing.end_trace(trace, previous, self.trace_exporters)
+                ended = True
+                yield dict(stored, event="result", trace=trace.summary())
+                return
+            async for event in self._run_stream(hpo_list):
+                if event["event"] == "result":
+                    tracing.end_trace(trace, previous, self.trace_exporters)
+                    ended = True
+                    event["trace"] = trace.summary()
+                    result = {key: value for key, value in event.items() if key != "event"}
+                    self.store_result(hpo_list, result)
+                    event["result_store"] = result.get("result_store")
+                yield event
+        except Exception as e:
+            trace.root.record_error(e)
+            raise
+        finally:
+            if not ended:
+                tracing.end_trace(trace, previous, self.trace_exporters)
+
+    async def _run_stream(self, hpo_list):
+        max_retry = 2
+        loop = asyncio.get_running_loop()
+        hpo_list, hpoid_label_list = await loop.run_in_executor(None, tracing.bind_context(self.prepare), hpo_list)
+        evidence = self.memory[0]
+        yield {"event": "stage", "stage": "evidence", "failed_sources": list(evidence["failed_sources"])}
+
+        rejected_diagnoses = []
+        for attempt in range(max_retry):
+            if attempt > 0:
+                evidence = await loop.run_in_executor(
+                    None, tracing.bind_context(self.refresh_evidence), hpo_list, hpoid_label_list
+                )
+            knowledge = evidence["knowledge"]
+            cases = evidence["cases"]
+            candidates = evidence["candidates"]
+            failed_sources = evidence["failed_sources"]
+
+            yield {"event": "stage", "stage": "report", "attempt": attempt}
+            prompt = self.build_report_prompt(hpo_list, knowledge, cases, candidates, rejected_diagnoses)
+            received = []
+            if not self.config.get("self_reflection", True):
+                await loop.run_in_executor(None, tracing.bind_context(lambda: list(self.stream_report(prompt, received))))
+                reflection_result = None
+                break
+            verdicts = {}
+            async for verdict in self.self_reflection_agent.reflect_stream(
+                self.stream_report(prompt, received),
+                patient_info=", ".join(hpo_list),
+                similar_case_detailed=self.judge_cases(cases),
+            ):
+                verdicts[verdict["rank"]] = verdict
+                yield dict(verdict, event="verdict", attempt=attempt)
+            reflection_result = self.self_reflection_agent.summarize(verdicts)
+            if reflection_result.get("accepted"):
+                break
+            rejected_diagnoses.extend(
+                item["disease_name"] for item in reflection_result.get("rejected", [])
+                if item["disease_name"] not in rejected_diagnoses
+            )
+
+        yield {
+        "event": "result",
+        "diagnosis_report": "".join(received),
+        "knowledge": knowledge,
+        "cases": cases,
+        "candidates": candidates,
+        "failed_sources": failed_sources,
         "self_reflection": reflection_result
         }
 
@@ -0,0 +1,103 @@
+import os
+import sys
+import pytest
+
+# リポジトリはパッケージとしてインストールしないため、helper/ と同様にルートをパスに追加する
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# テスト用の小さなHPOオントロジー（神経系・眼の2系統、旧IDと廃止タームを含む）
+HPO_OBO = """format-version: 1.2
+
+[Term]
+id: HP:0000001
+name: All
+
+[Term]
+id: HP:0000118
+name: Phenotypic abnormality
+is_a: HP:0000001 ! All
+
+[Term]
+id: HP:0000707
+name: Abnormality of the nervous system
+is_a: HP:0000118 ! Phenotypic abnormality
+
+[Term]
+id: HP:0001250
+name: Seizure
+alt_id: HP:0009999
+is_a: HP:0000707 ! Abnormality of the nervous system
+
+[Term]
+id: HP:0001251
+name: Ataxia
+is_a: HP:0000707 ! Abnormality of the nervous system
+
+[Term]
+id: HP:0001249
+name: Intellectual disability
+is_a: HP:0000707 ! Abnormality of the nervous system
+
+[Term]
+id: HP:0000478
+name: Abnormality of the eye
+is_a: HP:0000118 ! Phenotypic abnormality
+
+[Term]
+id: HP:0000505
+name: Visual impairment
+is_a: HP:0000478 ! Abnormality of the eye
+
+[Term]
+id: HP:0000518
+name: Cataract
+is_a: HP:0000478 ! Abnormality of the eye
+
+[Term]
+id: HP:0000002
+name: obsolete Seizures
+is_obsolete: true
+replaced_by: HP:0001250
+
+[Typedef]
+id: part_of
+name: part of
+"""
+
+HPOA_COLUMNS = ["database_id", "disease_name", "qualifier", "hpo_id", "reference", "evidence", "onset",
+                "frequency", "sex", "modifier", "aspect", "biocuration"]
+HPOA_ROWS = [
+    ("OMIM:100001", "SEIZURE DISORDER", "", "HP:0001250", "P"),
+    ("OMIM:100001", "SEIZURE DISORDER", "", "HP:0001249", "P"),
+    ("OMIM:100002", "ATAXIA DISORDER", "", "HP:0001251", "P"),
+    ("OMIM:100003", "EYE DISORDER", "", "HP:0000518", "P"),
+    ("OMIM:100003", "EYE DISORDER", "", "HP:0000505", "P"),
+    ("OMIM:100003", "EYE DISORDER", "NOT", "HP:0001250", "P"),
+    ("OMIM:100003", "EYE DISORDER", "", "HP:0000007", "I"),
+    ("ORPHA:1", "ORPHAN SEIZURES", "", "HP:0001250", "P"),
+]
+
+
+@pytest.fixture
+def hpo_path(tmp_path):
+    path = tmp_path / "hp.obo"
+    path.write_text(HPO_OBO, encoding="utf-8")
+    return str(path)
+
+
+@pytest.fixture
+def hpoa_path(tmp_path):
+    lines = ["#description: test annotations", "\t".join(HPOA_COLUMNS)]
+    for disease_id, name, qualifier, hpo_id, aspect in HPOA_ROWS:
+        row = dict.fromkeys(HPOA_COLUMNS, "")
+        row.update(database_id=disease_id, disease_name=name, qualifier=qualifier, hpo_id=hpo_id, aspect=aspect)
+        lines.append("\t".join(row[column] for column in HPOA_COLUMNS))
+    path = tmp_path / "phenotype.hpoa"
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return str(path)
+
+
+@pytest.fixture
+def ontology(hpo_path):
+    from agents.hpo_ontology import HPOOntology
+    return HPOOntology(hpo_path)
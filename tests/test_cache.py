@@ -0,0 +1,132 @@
+import pytest
+from agents import cache as cache_module
+from agents.cache import PersistentLRUCache
+
+
+class Clock:
+    """
+    agents.cacheのtimeモジュールの代わりに使う、手動で進める時計。
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def make_cache(tmp_path):
+    caches = []
+
+    def make(**kwargs):
+        cache = PersistentLRUCache(str(tmp_path / "cache.sqlite3"), **kwargs)
+        caches.append(cache)
+        return cache
+    yield make
+    for cache in caches:
+        cache.close()
+
+
+def test_set_get_and_persist(make_cache):
+    cache = make_cache()
+    cache.set_many({"a": {"value": 1}, "b": [2]})
+    assert cache.get("a") == {"value": 1}
+    assert cache.get("missing", "default") == "default"
+    assert cache.get_many(["a", "b", "missing"]) == {"a": {"value": 1}, "b": [2]}
+    cache.close()
+    reopened = make_cache()
+    assert reopened.get("b") == [2] and len(reopened) == 2
+
+
+def test_memory_lru_falls_back_to_disk(make_cache):
+    cache = make_cache(memory_entries=1)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert list(cache._memory) == ["b"]
+    assert cache.get("a") == 1
+    assert list(cache._memory) == ["a"]
+
+
+def test_evicts_least_recently_accessed(make_cache, clock):
+    cache = make_cache(max_entries=3, memory_entries=1)
+    for key in "abc":
+        clock.now += 1
+        cache.set(key, key)
+    clock.now += 1
+    # ディスクから読んだ"a"は最近参照されたものとして残る
+    assert cache.get("a") == "a"
+    clock.now += 1
+    cache.set("d", "d")
+    assert len(cache) == 3
+    cache._memory.clear()
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in "acd"] == ["a", "c", "d"]
+
+
+def test_ttl_expires_entries(make_cache, clock):
+    cache = make_cache(ttl=60)
+    cache.set("old", 1)
+    clock.now += 30
+    cache.set("new", 2)
+    clock.now += 31
+    assert cache.get("old") is None
+    assert cache.get("new") == 2
+    cache._memory.clear()
+    assert cache.get("old") is None and cache.get("new") == 2
+    # 期限切れのエントリは上限の確認時にディスクからも削除する
+    cache._evict()
+    assert len(cache) == 1
+
+
+def test_clear(make_cache):
+    cache = make_cache()
+    cache.set("a", 1)
+    cache.clear()
+    assert cache.get("a") is None and len(cache) == 0
+
+
+def accessed(cache, key):
+    return cache._conn.execute("SELECT accessed FROM cache WHERE key = ?", (key,)).fetchone()[0]
+
+
+def test_memory_hits_count_for_eviction(make_cache, clock):
+    cache = make_cache(max_entries=3)
+    for key in "abc":
+        clock.now += 1
+        cache.set(key, key)
+    clock.now += 1
+    # メモリ上のヒットも参照として扱い、次の書き込み時にディスクへ反映する
+    assert cache.get("a") == "a"
+    clock.now += 1
+    cache.set("d", "d")
+    cache._memory.clear()
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in "acd"] == ["a", "c", "d"]
+
+
+def test_access_times_are_flushed_in_batches(make_cache, clock):
+    cache = make_cache(access_batch=3)
+    cache.set_many({key: key for key in "abc"})
+    clock.now += 10
+    cache.get("a")
+    cache.get("b")
+    assert accessed(cache, "a") == 1000.0
+    cache.get("c")
+    assert [accessed(cache, key) for key in "abc"] == [1010.0] * 3
+
+
+def test_close_flushes_access_times(make_cache, clock):
+    cache = make_cache()
+    cache.set("a", 1)
+    clock.now += 10
+    cache.get("a")
+    cache.close()
+    reopened = make_cache()
+    assert accessed(reopened, "a") == 1010.0
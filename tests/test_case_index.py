@@ -0,0 +1,82 @@
+import json
+import pytest
+from agents.case_index import LocalCaseIndex, load_case_index
+
+CASES = [
+    {"id": "seizure-1", "hpo_list": ["HP:0001250", "HP:0001249"], "diagnosis": ["OMIM:100001"]},
+    {"id": "ataxia-1", "hpo_list": ["HP:0001251"], "diagnosis": ["OMIM:100002"]},
+    {"id": "eye-1", "hpo_list": ["HP:0000518", "HP:0000505"], "diagnosis": ["OMIM:100003"]},
+    {"id": "empty", "hpo_list": []},
+]
+
+
+@pytest.fixture
+def directory(tmp_path):
+    return str(tmp_path / "case_index")
+
+
+def ids(results):
+    return [result["id"] for result in results]
+
+
+def test_append_and_search(directory, ontology):
+    index = LocalCaseIndex(directory, ontology=ontology, dim=64)
+    # HPOタームのない症例は追加しない
+    assert index.append(CASES) == 3 and len(index) == 3
+    results = index.search(["HP:0001250", "HP:0001249"], top_k=3)
+    assert ids(results)[0] == "seizure-1"
+    assert results[0]["similarity"] == pytest.approx(1.0, abs=1e-5)
+    assert results[0]["diagnosis"] == ["OMIM:100001"]
+    assert "eye-1" not in ids(index.search(["HP:0001250"], top_k=3, min_cosine_similarity=0.5))
+    assert index.search(["HP:1234567"]) == []
+
+
+def test_reopen_and_append(directory, ontology):
+    LocalCaseIndex(directory, ontology=ontology, dim=64).append(CASES[:2])
+    reopened = LocalCaseIndex(directory, ontology=ontology)
+    assert len(reopened) == 2 and reopened.dim == 64
+    reopened.append(CASES[2:])
+    assert ids(reopened.search(["HP:0000518"], top_k=1)) == ["eye-1"]
+
+
+def test_interrupted_append_is_discarded(directory, ontology):
+    index = LocalCaseIndex(directory, ontology=ontology, dim=64)
+    index.append(CASES[:1])
+    # meta.jsonを更新する前に中断された書き込み
+    with open(index.vectors_path, "ab") as f:
+        f.write(b"\0" * 64 * 4)
+    with open(index.cases_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"id": "uncommitted", "hpo_list": ["HP:0001251"]}) + "\n")
+    reopened = LocalCaseIndex(directory, ontology=ontology)
+    assert len(reopened) == 1 and ids(reopened.cases) == ["seizure-1"]
+    reopened.append(CASES[1:2])
+    assert ids(LocalCaseIndex(directory, ontology=ontology).cases) == ["seizure-1", "ataxia-1"]
+
+
+def test_ivf_search_matches_exact(directory, ontology):
+    index = LocalCaseIndex(directory, ontology=ontology, dim=64)
+    index.append(CASES)
+    index.train_ivf(nlist=2)
+    index.append([{"id": "seizure-2", "hpo_list": ["HP:0001250"], "diagnosis": []}])
+    query = ["HP:0001250", "HP:0001249"]
+    exact = index.search(query, top_k=2, approximate=False)
+    assert ids(index.search(query, top_k=2, approximate=True, nprobe=2)) == ids(exact)
+    # IVFの割り当ても追記に合わせて保存される
+    assert len(LocalCaseIndex(directory, ontology=ontology).ivf.assignments) == 4
+
+
+def test_rejects_unknown_format(directory, ontology):
+    LocalCaseIndex(directory, ontology=ontology, dim=64).append(CASES[:1])
+    meta_path = LocalCaseIndex(directory, ontology=ontology).meta_path
+    with open(meta_path, encoding="utf-8") as f:
+        meta = json.load(f)
+    meta["format_version"] = 999
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    with pytest.raises(ValueError):
+        LocalCaseIndex(directory, ontology=ontology)
+
+
+def test_load_case_index_is_shared(directory, ontology):
+    LocalCaseIndex(directory, ontology=ontology, dim=64).append(CASES)
+    assert load_case_index(directory, ontology) is load_case_index(directory, ontology)
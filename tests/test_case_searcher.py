@@ -0,0 +1,26 @@
+from agents.case_searcher import CaseSearcher
+from agents.http_client import HTTPClient
+
+
+class RecordingHTTPClient:
+    make_cache_key = staticmethod(HTTPClient.make_cache_key)
+
+    def __init__(self):
+        self.requests = []
+
+    def post_json(self, url, payload, headers=None, timeout=30, cache_key=None):
+        self.requests.append((payload, cache_key))
+        return {"results": [{"id": "case-1"}]}
+
+
+def test_togoseek_sends_original_query_and_canonical_cache_key():
+    client = RecordingHTTPClient()
+    searcher = CaseSearcher(http_client=client)
+    assert searcher.search("HP:0001251:Ataxia, HP:0001250:Seizure, cortical") == [{"id": "case-1"}]
+    searcher.search("HP:0001250:Seizure, cortical,HP:0001251:Ataxia,HP:0001251:Ataxia")
+    (first, first_key), (second, second_key) = client.requests
+    assert first["query"] == "HP:0001251:Ataxia, HP:0001250:Seizure, cortical"
+    assert second["query"] == "HP:0001250:Seizure, cortical,HP:0001251:Ataxia,HP:0001251:Ataxia"
+    # 順序・重複だけが異なるクエリは同じキャッシュのエントリを使う
+    assert first_key == second_key and first_key.startswith("togoseek:")
+    assert CaseSearcher.canonicalize_query(first["query"]) == "HP:0001250:Seizure, cortical,HP:0001251:Ataxia"
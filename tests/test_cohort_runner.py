@@ -0,0 +1,109 @@
+import json
+import pytest
+from cohort_runner import CohortRunner, iter_patient_records, load_phenopacket
+
+
+class StubHost:
+    """
+    outcomesに従って結果を返すhost（"ok" / "degraded" / "error"）。
+    """
+    def __init__(self, outcomes, calls, hosts):
+        self.outcomes = outcomes
+        self.calls = calls
+        self.closed = False
+        hosts.append(self)
+
+    def run(self, hpo_list):
+        patient_id = hpo_list[0]
+        self.calls.append(patient_id)
+        outcome = self.outcomes.get(patient_id, "ok")
+        if outcome == "error":
+            raise RuntimeError("source unavailable")
+        return {"diagnosis_report": patient_id, "degraded": outcome == "degraded"}
+
+    @staticmethod
+    def is_degraded(result):
+        return result["degraded"]
+
+    def close(self):
+        self.closed = True
+
+
+def records(count):
+    # 患者IDをHPOリストの先頭に入れ、stubのhostが患者を識別できるようにする
+    return [{"id": f"p{i}", "hpo_list": [f"p{i}", "HP:0001250"], "expected": []} for i in range(count)]
+
+
+def make_runner(output_path, outcomes=None, **kwargs):
+    calls, hosts = [], []
+    runner = CohortRunner(output_path, host_factory=lambda: StubHost(outcomes or {}, calls, hosts), **kwargs)
+    return runner, calls, hosts
+
+
+def read_entries(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.fixture
+def output_path(tmp_path):
+    return str(tmp_path / "results" / "cohort.jsonl")
+
+
+def test_run_records_each_status_and_closes_hosts(output_path):
+    runner, calls, hosts = make_runner(output_path, {"p1": "degraded", "p2": "error"}, workers=2)
+    patients = records(5) + [{"id": "no-terms", "hpo_list": []}]
+    counts = runner.run(iter(patients))
+    assert counts == {"ok": 3, "degraded": 1, "error": 1, "skipped": 1}
+    statuses = {entry["id"]: entry["status"] for entry in read_entries(output_path)}
+    assert statuses == {"p0": "ok", "p1": "degraded", "p2": "error", "p3": "ok", "p4": "ok"}
+    assert 1 <= len(hosts) <= 2 and all(host.closed for host in hosts)
+
+
+def test_resume_skips_completed_and_retries_failures(output_path):
+    runner, _, _ = make_runner(output_path, {"p1": "degraded", "p2": "error"})
+    runner.run(iter(records(4)), limit=3)
+    resumed, calls, _ = make_runner(output_path)
+    counts = resumed.run(iter(records(4)))
+    assert sorted(calls) == ["p1", "p2", "p3"]
+    assert counts == {"ok": 3, "degraded": 0, "error": 0, "skipped": 1}
+    assert resumed.load_checkpoint() == {"p0", "p1", "p2", "p3"}
+
+
+def test_resume_without_retrying_errors(output_path):
+    make_runner(output_path, {"p1": "degraded", "p2": "error"})[0].run(iter(records(3)))
+    resumed, calls, _ = make_runner(output_path, retry_errors=False)
+    assert resumed.run(iter(records(3))) == {"ok": 0, "degraded": 0, "error": 0, "skipped": 3}
+    assert calls == []
+
+
+def test_truncated_last_line_is_discarded(output_path):
+    make_runner(output_path)[0].run(iter(records(2)))
+    with open(output_path, "a", encoding="utf-8") as f:
+        f.write('{"id": "p2", "status": "o')
+    resumed, calls, _ = make_runner(output_path)
+    assert resumed.load_checkpoint() == {"p0", "p1"}
+    resumed.run(iter(records(3)))
+    assert calls == ["p2"]
+    assert [entry["id"] for entry in read_entries(output_path)] == ["p0", "p1", "p2"]
+
+
+def test_iter_patient_records(tmp_path):
+    phenopacket = {
+        "id": "case-1",
+        "phenotypicFeatures": [
+            {"type": {"id": "HP:0001250"}}, {"type": {"id": "HP:0001251"}, "excluded": True}
+        ],
+        "interpretations": [{"diagnosis": {"disease": {"id": "OMIM:100001"}}}],
+        "diseases": [{"term": {"id": "OMIM:100001"}}, {"term": {"id": "OMIM:100002"}}]
+    }
+    assert load_phenopacket(phenopacket) == {
+        "id": "case-1", "hpo_list": ["HP:0001250"], "expected": ["OMIM:100001", "OMIM:100002"]
+    }
+    directory = tmp_path / "phenopackets" / "nested"
+    directory.mkdir(parents=True)
+    (directory / "case.json").write_text(json.dumps(dict(phenopacket, id=None)), encoding="utf-8")
+    assert [record["id"] for record in iter_patient_records(str(tmp_path / "phenopackets"))] == ["nested/case.json"]
+    jsonl = tmp_path / "patients.jsonl"
+    jsonl.write_text('{"hpo_list": ["HP:0001250"]}\n\n' + json.dumps(phenopacket) + "\n", encoding="utf-8")
+    assert [record["id"] for record in iter_patient_records(str(jsonl))] == ["line-1", "case-1"]
@@ -0,0 +1,69 @@
+from agents.context_assembler import (ContextAssembler, EMPTY_SECTION, allocate_budget, compact_json, fit_lines,
+                                      truncate_to_tokens)
+from agents.llm_gateway import estimate_tokens
+
+KNOWLEDGE = [
+    {"title": "Rett syndrome", "summary": "Page: Rett syndrome\nSummary: A neurodevelopmental disorder.\n\n"
+                                          "Page: MECP2\nSummary: A gene on the X chromosome."},
+    {"title": "MECP2", "summary": "Page: MECP2\nSummary: A gene on the X chromosome."},
+    {"title": "Other", "summary": "No good Wikipedia Search Result was found"},
+]
+CASES = [
+    {"id": "c1", "similarity": 0.5, "diagnosis": ["OMIM:1"], "note": ""},
+    {"id": "c2", "similarity": 0.9, "diagnosis": ["OMIM:2"]},
+    {"id": "c1", "similarity": 0.5, "diagnosis": ["OMIM:1"]},
+]
+CANDIDATES = {
+    "pubcasefinder": [
+        {"omim_disease_name_en": "Rett syndrome", "score": 0.91234, "description": "OMIM:312750\n  match"},
+        {"omim_disease_name_en": "RETT SYNDROME", "score": 0.5},
+        {"omim_disease_name_en": "Angelman syndrome"},
+    ],
+    "gemini": [{"label": "rett syndrome", "id": "OMIM:312750"}, {"label": "Dravet syndrome"}],
+}
+
+
+def test_knowledge_lines_split_pages_and_deduplicate():
+    lines = ContextAssembler().knowledge_lines(KNOWLEDGE)
+    assert lines == ["- Rett syndrome: A neurodevelopmental disorder.", "- MECP2: A gene on the X chromosome."]
+
+
+def test_case_lines_sorted_by_similarity_without_duplicates():
+    lines = ContextAssembler().case_lines(CASES)
+    assert lines == ['- {"id":"c2","similarity":0.9,"diagnosis":["OMIM:2"]}',
+                     '- {"id":"c1","similarity":0.5,"diagnosis":["OMIM:1"]}']
+
+
+def test_candidate_lines_mark_overlap_with_llm():
+    api_lines, llm_lines = ContextAssembler().candidate_lines(CANDIDATES)
+    assert api_lines == ["- Rett syndrome (score 0.912): OMIM:312750 match [also proposed by LLM]",
+                         "- Angelman syndrome"]
+    assert llm_lines == ["- Dravet syndrome"]
+
+
+def test_assemble_report_within_budget():
+    knowledge = [{"title": f"Page {i}", "summary": f"topic {i} " + "word " * 200} for i in range(20)]
+    sections = ContextAssembler(max_item_tokens=100).assemble_report(knowledge, CASES, CANDIDATES, budget=400)
+    assert sum(estimate_tokens(text) for text in sections.values()) <= 420
+    assert sections["web_diagnosis"].endswith("more omitted)")
+    assert sections["similar_case_detailed"].startswith('- {"id":"c2"')
+    empty = ContextAssembler().assemble_report([], [], {})
+    assert set(empty.values()) == {EMPTY_SECTION}
+
+
+def test_allocate_budget_redistributes_unused_share():
+    allocation = allocate_budget(100, {"knowledge": 10, "cases": 500, "api": 0}, {"knowledge": 1, "cases": 1, "api": 1})
+    assert allocation == {"knowledge": 10, "cases": 90, "api": 0}
+
+
+def test_fit_lines_keeps_truncated_first_line():
+    text, omitted = fit_lines(["x" * 400, "y"], 10)
+    assert text.startswith("x" * 39) and text.endswith("(+1 more omitted)") and omitted == 1
+    assert fit_lines([], 10) == (EMPTY_SECTION, 0)
+
+
+def test_truncate_and_compact_json():
+    assert truncate_to_tokens("short", 10) == "short"
+    assert truncate_to_tokens("alpha beta gamma delta", 3) == "alpha beta…"
+    assert truncate_to_tokens("あ" * 20, 2) == "あ" * 8 + "…"
+    assert compact_json({"a": 0.123456, "b": None, "c": [], "d": [1, ""]}) == '{"a":0.123,"d":[1]}'
@@ -0,0 +1,142 @@
+import asyncio
+import pytest
+from diagnosis_service import DiagnosisService
+
+
+class StubHost:
+    """
+    run_streamがreleaseされるまで待ってから結果を返すhost。
+    """
+    def __init__(self, registry):
+        self.registry = registry
+        self.closed = False
+        registry["hosts"].append(self)
+
+    def warm_up(self):
+        return {"stub": 0.0}
+
+    def close(self):
+        self.closed = True
+
+    async def run_stream(self, hpo_list, reuse=None):
+        self.registry["runs"].append(list(hpo_list))
+        yield {"event": "stage", "stage": "evidence", "failed_sources": []}
+        await self.registry["release"].wait()
+        yield {"event": "result", "diagnosis_report": ",".join(hpo_list)}
+
+
+def make_service(workers=1, **kwargs):
+    registry = {"hosts": [], "runs": [], "release": asyncio.Event()}
+    service = DiagnosisService(lambda: StubHost(registry), workers=workers, **kwargs)
+    return service, registry
+
+
+async def collect(events):
+    return [event async for event in events]
+
+
+async def wait_for_runs(registry, count):
+    while len(registry["runs"]) < count:
+        await asyncio.sleep(0.001)
+
+
+def test_coalesces_same_hpo_set_in_different_order():
+    async def scenario():
+        service, registry = make_service()
+        await service.start()
+        first = asyncio.ensure_future(collect(service.stream(["HP:2", "HP:1"])))
+        await wait_for_runs(registry, 1)
+        second = asyncio.ensure_future(collect(service.stream(["HP:1", "HP:2", "HP:1"])))
+        await asyncio.sleep(0.01)
+        registry["release"].set()
+        results = await asyncio.gather(first, second)
+        await service.stop()
+        return service, registry, results
+
+    service, registry, (first, second) = asyncio.run(scenario())
+    assert len(registry["runs"]) == 1
+    assert second[0]["coalesced"] is True and second[0]["job_id"] == first[0]["job_id"]
+    # 途中から合流した購読者にも、それまでのイベントが再送される
+    assert [event["event"] for event in second] == [event["event"] for event in first]
+    assert first[-1]["event"] == "result"
+    assert service.stats["accepted"] == 1 and service.stats["coalesced"] == 1
+
+
+def test_rejects_with_queue_full_at_max_queue():
+    async def scenario():
+        service, registry = make_service(max_queue=1)
+        await service.start()
+        running = service.stream(["HP:1"])
+        await running.__anext__()
+        await wait_for_runs(registry, 1)
+        waiting = service.stream(["HP:2"])
+        queued = await waiting.__anext__()
+        with pytest.raises(asyncio.QueueFull):
+            await service.stream(["HP:3"]).__anext__()
+        registry["release"].set()
+        await collect(running)
+        await collect(waiting)
+        await service.stop()
+        return service, queued
+
+    service, queued = asyncio.run(scenario())
+    assert queued["position"] == 1
+    assert service.stats["rejected"] == 1 and service.stats["completed"] == 2
+
+
+def test_deadline_expires_and_cancels_abandoned_job():
+    async def scenario():
+        service, registry = make_service()
+        await service.start()
+        events = await collect(service.stream(["HP:1"], deadline=0.05))
+        await asyncio.sleep(0.01)
+        status = service.status()
+        await service.stop()
+        return service, registry, events, status
+
+    service, registry, events, status = asyncio.run(scenario())
+    assert events[-1]["event"] == "error" and events[-1]["reason"] == "deadline"
+    assert service.stats["expired"] == 1 and service.stats["cancelled"] == 1
+    assert status["inflight"] == 0
+    # キャンセルしたジョブのhostは閉じ、新しいhostに作り直す
+    assert registry["hosts"][0].closed and len(registry["hosts"]) == 2
+
+
+def test_client_cancellation_drops_queued_job():
+    async def scenario():
+        service, registry = make_service()
+        await service.start()
+        running = service.stream(["HP:1"])
+        await running.__anext__()
+        await wait_for_runs(registry, 1)
+        waiting = service.stream(["HP:2"])
+        await waiting.__anext__()
+        # 実行待ちのジョブの唯一の購読者が受信をやめる
+        await waiting.aclose()
+        registry["release"].set()
+        await collect(running)
+        await asyncio.sleep(0.01)
+        await service.stop()
+        return service, registry
+
+    service, registry = asyncio.run(scenario())
+    assert registry["runs"] == [["HP:1"]]
+    assert service.stats["dropped"] == 1 and service.stats["completed"] == 1
+
+
+def test_stop_notifies_subscribers_and_closes_hosts():
+    async def scenario():
+        service, registry = make_service(workers=2)
+        timings = await service.start(warm_up=True)
+        events = service.stream(["HP:1"])
+        await events.__anext__()
+        await wait_for_runs(registry, 1)
+        await service.stop()
+        remaining = await collect(events)
+        return service, registry, timings, remaining
+
+    service, registry, timings, remaining = asyncio.run(scenario())
+    assert timings == {"stub": 0.0}
+    assert remaining[-1]["event"] == "error" and remaining[-1]["reason"] == "stopped"
+    assert all(host.closed for host in registry["hosts"])
+    assert service.status()["workers"] == 0 and service.status()["inflight"] == 0
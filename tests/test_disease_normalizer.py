@@ -0,0 +1,20 @@
+import pytest
+from agents import disease_normalizer
+from agents.disease_normalizer import get_disease_normalizer
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch):
+    # 既定のembeddingキャッシュ（./data）を開かず、プロセス共通のnormalizerも汚さない
+    monkeypatch.setattr(disease_normalizer, "get_embedding_cache", lambda: None)
+    monkeypatch.setattr(disease_normalizer, "_shared_normalizer", None)
+
+
+def test_shared_normalizer_is_keyed_by_index_params(tmp_path):
+    path = str(tmp_path / "omim_embeddings.npy")
+    normalizer = get_disease_normalizer(path, "ivfpq", index_params={"nprobe": 16, "rerank": 32})
+    assert normalizer.index_params == {"nprobe": 16, "rerank": 32}
+    assert get_disease_normalizer(path, "ivfpq", index_params={"rerank": 32, "nprobe": 16}) is normalizer
+    other = get_disease_normalizer(path, "ivfpq", index_params={"nprobe": 4})
+    assert other is not normalizer and other.index_params == {"nprobe": 4}
+    assert get_disease_normalizer(path, "ivfpq") is not other
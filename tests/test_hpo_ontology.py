@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from agents.hpo_ontology import load_hpo_ontology, ROOT_TERM
+
+SEIZURE, ATAXIA, INTELLECTUAL_DISABILITY = "HP:0001250", "HP:0001251", "HP:0001249"
+NERVOUS_SYSTEM, CATARACT = "HP:0000707", "HP:0000518"
+
+
+def test_resolve_alt_and_obsolete_ids(ontology):
+    assert len(ontology) == 9
+    assert ontology.resolve(" hp:0009999") == SEIZURE
+    assert ontology.resolve("HP:0000002") == SEIZURE
+    assert ontology.resolve("HP:1234567") is None
+    assert ontology.label("HP:0009999") == "Seizure"
+    assert ontology.indices(["HP:0009999", "HP:1234567", CATARACT]).tolist() == [
+        ontology.index[SEIZURE], ontology.index[CATARACT]
+    ]
+
+
+def test_ancestors_include_self_and_root(ontology):
+    ancestors = {ontology.term_ids[i] for i in ontology.ancestors_of(ontology.index[SEIZURE])}
+    assert ancestors == {SEIZURE, NERVOUS_SYSTEM, "HP:0000118", ROOT_TERM}
+    mask = ontology.ancestor_mask([ontology.index[SEIZURE], ontology.index[CATARACT]])
+    assert mask.sum() == 6
+
+
+def test_information_content(ontology):
+    ic = ontology.information_content
+    assert ic[ontology.index[ROOT_TERM]] == pytest.approx(0.0)
+    assert ic[ontology.index[SEIZURE]] > ic[ontology.index[NERVOUS_SYSTEM]] > 0
+    annotation_ic = ontology.annotation_information_content({"D1": [SEIZURE], "D2": [ATAXIA]})
+    assert annotation_ic[ontology.index[NERVOUS_SYSTEM]] == pytest.approx(0.0)
+    assert annotation_ic[ontology.index[SEIZURE]] == pytest.approx(np.log(2))
+    # 注釈のないタームは最大値
+    assert annotation_ic[ontology.index[CATARACT]] == pytest.approx(np.log(2))
+
+
+def test_canonicalize_drops_redundant_ancestors(ontology):
+    assert ontology.canonicalize(["HP:0000002", NERVOUS_SYSTEM, "hp:0001250", CATARACT, "HP:1234567"]) == [
+        CATARACT, SEIZURE, "HP:1234567"
+    ]
+
+
+def test_set_similarity(ontology):
+    same = ontology.set_similarity([SEIZURE], [SEIZURE])
+    sibling = ontology.set_similarity([SEIZURE], [ATAXIA])
+    unrelated = ontology.set_similarity([SEIZURE], [CATARACT])
+    assert same > sibling > unrelated
+    # 兄弟タームのResnik類似度は共通の親のIC
+    assert sibling == pytest.approx(float(ontology.information_content[ontology.index[NERVOUS_SYSTEM]]))
+    assert 0 < ontology.set_similarity([SEIZURE], [ATAXIA], method="lin") < 1
+    assert ontology.set_similarity([SEIZURE], ["HP:1234567"]) == 0.0
+    forward = ontology.set_similarity([SEIZURE], [SEIZURE, CATARACT], symmetric=False)
+    assert forward == pytest.approx(same)
+
+
+def test_load_hpo_ontology_is_shared(hpo_path):
+    assert load_hpo_ontology(hpo_path) is load_hpo_ontology(hpo_path)
@@ -0,0 +1,49 @@
+import pytest
+from agents.knowledge_snapshot import KnowledgeSnapshot
+
+DOCUMENTS = [
+    {"title": "Rett syndrome", "summary": "Rett syndrome is a genetic disorder of brain development in girls."},
+    {"title": "Marfan syndrome", "summary": "Marfan syndrome is a disease of connective tissue, type 1 fibrillin."},
+    {"title": "ドラベ症候群", "summary": "ドラベ症候群は乳児期に発症するてんかん性脳症である。"},
+]
+
+
+@pytest.fixture(params=["trigram", "unicode61 remove_diacritics 2"])
+def snapshot(request, tmp_path):
+    snapshot = KnowledgeSnapshot(str(tmp_path / "snapshot.sqlite3"), tokenize=request.param)
+    snapshot.add_documents(DOCUMENTS, lang="ja")
+    yield snapshot
+    snapshot.close()
+
+
+def titles(results):
+    return [result["title"] for result in results]
+
+
+def test_exact_title(snapshot):
+    assert titles(snapshot.search("rett SYNDROME")) == ["Rett syndrome"]
+
+
+@pytest.mark.parametrize("query", ["Dravet syndrome", "Noonan syndrome type 1", "Marfan-like disease"])
+def test_near_miss_returns_nothing(snapshot, query):
+    # 共通の語（syndrome, type, disease）だけが一致する別の疾患の記事は返さない
+    assert snapshot.search(query) == []
+
+
+def test_all_terms_match(snapshot):
+    assert titles(snapshot.search("marfan connective tissue")) == ["Marfan syndrome"]
+
+
+def test_japanese_full_text(tmp_path):
+    # unicode61は日本語を語に分割しないため、本文中の語はtrigramでのみ検索できる
+    snapshot = KnowledgeSnapshot(str(tmp_path / "snapshot.sqlite3"))
+    snapshot.add_documents(DOCUMENTS, lang="ja")
+    assert snapshot.trigram
+    assert titles(snapshot.search("てんかん性脳症")) == ["ドラベ症候群"]
+    assert snapshot.search("てんかん性脳症", lang="en") == []
+
+
+def test_existing_snapshot_keeps_tokenizer(tmp_path):
+    path = str(tmp_path / "snapshot.sqlite3")
+    KnowledgeSnapshot(path, tokenize="unicode61 remove_diacritics 2").close()
+    assert not KnowledgeSnapshot(path).trigram
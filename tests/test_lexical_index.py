@@ -0,0 +1,85 @@
+import pytest
+from agents.lexical_index import LexicalIndex, DEFAULT_LEXICAL_THRESHOLD, fold, label_synonyms, subtype_tokens
+
+# 番号・病型だけが異なる別の疾患にファジー一致させてはいけない
+# （正しい疾患がラベルにない場合はembeddingに回すため、一致なしが正解）
+LABELS = [
+    "SPINOCEREBELLAR ATAXIA 1; SCA1", "SPINOCEREBELLAR ATAXIA 3; SCA3", "SPINOCEREBELLAR ATAXIA 31; SCA31",
+    "BARDET-BIEDL SYNDROME 1; BBS1", "BARDET-BIEDL SYNDROME 2; BBS2", "BARDET-BIEDL SYNDROME 10; BBS10",
+    "NEUROFIBROMATOSIS, TYPE I; NF1", "NEUROFIBROMATOSIS, TYPE II; NF2",
+    "GAUCHER DISEASE, TYPE I", "GAUCHER DISEASE, TYPE IIIC", "GLYCOGEN STORAGE DISEASE Ia; GSD1A",
+    "MARFAN SYNDROME; MFS;; MARFAN SYNDROME, TYPE I", "LOEYS-DIETZ SYNDROME 1; LDS1", "LOEYS-DIETZ SYNDROME 2; LDS"
+]
+REGRESSION_CASES = [
+    ("Spinocerebellar ataxia 13", None),
+    ("Bardet Biedl syndrome 12", None),
+    ("neurofibromatosis type 3", None),
+    ("Gaucher disease type 3", None),
+    ("Glycogen storage disease Ib", None),
+    ("spinocerebellar ataxia type 3", "SPINOCEREBELLAR ATAXIA 3; SCA3"),
+    ("Bardet-Biedl syndrom 10", "BARDET-BIEDL SYNDROME 10; BBS10"),
+    ("Neurofibromatosis type 2", "NEUROFIBROMATOSIS, TYPE II; NF2"),
+    ("Gaucher disease type IIIc", "GAUCHER DISEASE, TYPE IIIC"),
+    ("glycogen storage disease type 1a", "GLYCOGEN STORAGE DISEASE Ia; GSD1A")
+]
+
+
+@pytest.fixture(scope="module")
+def index():
+    return LexicalIndex(LABELS)
+
+
+def matched_label(index, name, **kwargs):
+    found = index.lookup(name, **kwargs)
+    return LABELS[found[0][0]] if found else None
+
+
+@pytest.mark.parametrize("query,expected", REGRESSION_CASES)
+def test_fuzzy_match_respects_subtype(index, query, expected):
+    assert matched_label(index, query, min_score=DEFAULT_LEXICAL_THRESHOLD) == expected
+
+
+@pytest.mark.parametrize("text,folded", [
+    ("NEUROFIBROMATOSIS, TYPE II", "neurofibromatosis type 2"),
+    ("Gaucher disease, type I", "gaucher disease type 1"),
+    ("GAUCHER DISEASE, TYPE IIIC", "gaucher disease type 3c"),
+    ("GLYCOGEN STORAGE DISEASE Ib", "glycogen storage disease 1b"),
+    ("Ｍａｒｆａｎ　Syndrome", "marfan syndrome"),
+])
+def test_fold(text, folded):
+    assert fold(text) == folded
+
+
+def test_label_synonyms():
+    names, abbreviations = label_synonyms("MARFAN SYNDROME; MFS;; MARFAN SYNDROME, TYPE I")
+    assert names == ["MARFAN SYNDROME; MFS;; MARFAN SYNDROME, TYPE I", "MARFAN SYNDROME", "MARFAN SYNDROME, TYPE I"]
+    assert abbreviations == ["MFS"]
+
+
+def test_subtype_tokens():
+    assert subtype_tokens(fold("Spinocerebellar ataxia 3")) == ("3",)
+    assert subtype_tokens(fold("Niemann-Pick disease, type C")) == ("c",)
+    assert subtype_tokens(fold("Marfan syndrome")) == ()
+
+
+def test_exact_name_and_unique_abbreviation(index):
+    assert index.lookup("Marfan syndrome") == [(LABELS.index("MARFAN SYNDROME; MFS;; MARFAN SYNDROME, TYPE I"), 1.0, "exact")]
+    assert matched_label(index, "sca31") == "SPINOCEREBELLAR ATAXIA 31; SCA31"
+
+
+def test_ambiguous_abbreviation_is_not_exact():
+    # 複数の疾患が同じ略称を持つ場合は、略称だけでは1疾患に特定しない
+    index = LexicalIndex(["LOEYS-DIETZ SYNDROME 1; LDS", "LOEYS-DIETZ SYNDROME 2; LDS"])
+    assert all(kind != "exact" for _, _, kind in index.lookup("LDS", k=2))
+
+
+def test_fuzzy_typo_and_top_k(index):
+    found = index.lookup("Bardet-Biedl syndrom 2", k=2)
+    assert LABELS[found[0][0]] == "BARDET-BIEDL SYNDROME 2; BBS2"
+    assert found[0][2] == "fuzzy" and DEFAULT_LEXICAL_THRESHOLD <= found[0][1] < 1.0
+    assert len({owner for owner, _, _ in found}) == len(found)
+
+
+def test_unrelated_name_returns_nothing(index):
+    assert index.lookup("cystic fibrosis") == []
+    assert index.lookup("  ,; ") == []
@@ -0,0 +1,45 @@
+import pytest
+from agents.local_phenotype_ranker import LocalPhenotypeRanker, load_hpoa_annotations, load_local_phenotype_ranker
+
+
+def test_load_hpoa_annotations(hpoa_path):
+    annotations, names = load_hpoa_annotations(hpoa_path)
+    # NOT・表現型以外（aspect != P）・OMIM以外のアノテーションは除く
+    assert annotations == {
+        "OMIM:100001": ["HP:0001250", "HP:0001249"],
+        "OMIM:100002": ["HP:0001251"],
+        "OMIM:100003": ["HP:0000518", "HP:0000505"]
+    }
+    assert names["OMIM:100003"] == "EYE DISORDER"
+    assert "ORPHA:1" in load_hpoa_annotations(hpoa_path, databases=("OMIM", "ORPHA"))[0]
+
+
+@pytest.mark.parametrize("method", ["ic_overlap", "bma"])
+def test_rank(ontology, hpoa_path, method):
+    ranker = LocalPhenotypeRanker(ontology, hpoa_path, method=method)
+    results = ranker.rank(["HP:0001250", "HP:0001249"], top_k=3)
+    assert results[0]["omim_disease_name_en"] == "SEIZURE DISORDER"
+    assert results[0]["description"].startswith("OMIM:100001")
+    assert [result["score"] for result in results] == sorted((result["score"] for result in results), reverse=True)
+    assert ranker.rank(["HP:0000518"])[0]["omim_disease_name_en"] == "EYE DISORDER"
+
+
+def test_rank_many_matches_rank(ontology, hpoa_path):
+    ranker = LocalPhenotypeRanker(ontology, hpoa_path)
+    queries = [["HP:0001251"], ["HP:0000505"], ["HP:1234567"]]
+    batch = ranker.rank_many(queries, top_k=2)
+    assert batch[:2] == [ranker.rank(query, top_k=2) for query in queries[:2]]
+    # 未知のタームのみの患者はスコア0のため候補なし
+    assert batch[2] == []
+    assert ranker.score_many([]).shape == (0, 3)
+
+
+def test_invalid_method(ontology, hpoa_path):
+    with pytest.raises(ValueError):
+        LocalPhenotypeRanker(ontology, hpoa_path, method="cosine")
+
+
+def test_load_local_phenotype_ranker_is_shared(hpoa_path, hpo_path):
+    ranker = load_local_phenotype_ranker(hpoa_path, hpo_path)
+    assert ranker is load_local_phenotype_ranker(hpoa_path, hpo_path)
+    assert ranker is not load_local_phenotype_ranker(hpoa_path, hpo_path, method="bma")
@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+import pytest
+from agents import result_store as result_store_module
+from agents.result_store import DiagnosisResultStore, hpo_set_key, fingerprint
+
+
+@pytest.fixture
+def now(monkeypatch):
+    # 保存時刻が同じにならないよう、time.time()を呼ぶたびに1秒進む時計に置き換える
+    now = [1000.0]
+
+    def tick():
+        now[0] += 1
+        return now[0]
+    monkeypatch.setattr(result_store_module, "time", SimpleNamespace(time=tick))
+    return now
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = DiagnosisResultStore(str(tmp_path / "results.sqlite3"))
+    yield store
+    store.close()
+
+
+def test_hpo_set_key_ignores_order_case_and_duplicates():
+    assert hpo_set_key([" hp:0001250", "HP:0000118", "HP:0001250", ""]) == "HP:0000118,HP:0001250"
+
+
+def test_fingerprint_is_stable_across_key_order():
+    assert fingerprint({"a": 1, "b": [1, 2]}) == fingerprint({"b": [1, 2], "a": 1})
+    assert fingerprint({"a": 1}) != fingerprint({"a": 2})
+    assert len(fingerprint({})) == 16
+
+
+def test_latest_run_by_hpo_set_and_fingerprint(store, now):
+    store.save_run(["HP:2", "HP:1"], "f1", {"mode": 1}, {"report": "first"})
+    second = store.save_run(["HP:1", "HP:2"], "f1", {"mode": 1}, {"report": "second"})
+    store.save_run(["HP:1", "HP:2"], "f2", {"mode": 2}, {"report": "other config"})
+    latest = store.latest_run(["HP:2", "HP:1", "HP:2"], "f1")
+    assert latest["id"] == second and latest["result"] == {"report": "second"}
+    assert store.latest_run(["HP:1"], "f1") is None
+    assert len(store) == 3
+
+
+def test_max_age(store, now):
+    store.save_run(["HP:1"], "f", {}, {"report": "old"})
+    store.save_evidence(["HP:1"], "e", {"knowledge": []})
+    now[0] += 100
+    assert store.latest_run(["HP:1"], "f", max_age=50) is None
+    assert store.latest_run(["HP:1"], "f", max_age=200)["result"] == {"report": "old"}
+    assert store.load_evidence(["HP:1"], "e", max_age=50) is None
+    assert store.load_evidence(["HP:1"], "e") == {"knowledge": []}
+
+
+def test_evidence_is_replaced(store):
+    store.save_evidence(["HP:1"], "e", {"cases": [1]})
+    store.save_evidence(["HP:1"], "e", {"cases": [2]})
+    assert store.load_evidence(["hp:1"], "e") == {"cases": [2]}
+    assert store.load_evidence(["HP:1"], "other") is None
+
+
+def test_iter_runs_filters_and_persists(tmp_path, store):
+    store.save_run(["HP:1"], "f1", {"mode": 1}, {"report": "a"})
+    store.save_run(["HP:2", "HP:3"], "f1", {"mode": 1}, {"report": "b"})
+    store.save_run(["HP:1"], "f2", {"mode": 2}, {"report": "c"})
+    assert [run["result"]["report"] for run in store.iter_runs()] == ["a", "b", "c"]
+    assert [run["result"]["report"] for run in store.iter_runs(run_fingerprint="f1")] == ["a", "b"]
+    runs = list(store.iter_runs(hpo_list=["HP:1"], run_fingerprint="f2"))
+    assert runs[0]["hpo_list"] == ["HP:1"] and runs[0]["config"] == {"mode": 2}
+    reopened = DiagnosisResultStore(store.path)
+    assert len(reopened) == 3
+    reopened.close()
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+from agents.vector_index import (ExactIndex, IVFIndex, IVFPQIndex, build_vector_index, load_vector_index,
+                                 index_path_prefix, cosine_similarities, top_k_indices)
+
+
+def normalized(vectors):
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    # クラスタ構造を持つ正規化済みベクトルと、各クラスタ付近のクエリ
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((20, 32))
+    vectors = normalized(np.repeat(centers, 100, axis=0) + 0.3 * rng.standard_normal((2000, 32)))
+    queries = normalized(vectors[rng.choice(len(vectors), 50, replace=False)] + 0.05 * rng.standard_normal((50, 32)))
+    return vectors, queries
+
+
+def recall_at_k(index, vectors, queries, k=10, **params):
+    expected, _ = ExactIndex().search(vectors, queries, k)
+    found, _ = index.search(vectors, queries, k, **params)
+    return np.mean([len(set(e) & set(f)) / k for e, f in zip(expected, found)])
+
+
+def test_exact_index_matches_brute_force(corpus):
+    vectors, queries = corpus
+    indices, scores = ExactIndex().search(vectors, queries, 5)
+    similarities = queries @ vectors.T
+    assert np.array_equal(indices[:, 0], similarities.argmax(axis=1))
+    assert np.allclose(scores, np.take_along_axis(similarities, indices, axis=1), atol=1e-5)
+    assert np.all(np.diff(scores, axis=1) <= 1e-6)
+
+
+def test_top_k_indices_sorted():
+    similarities = np.array([[0.1, 0.9, 0.5, 0.7]])
+    assert top_k_indices(similarities, 3).tolist() == [[1, 3, 2]]
+    assert np.allclose(cosine_similarities(np.eye(3, dtype=np.float32), np.eye(3, dtype=np.float32)[:1]), [[1, 0, 0]])
+
+
+@pytest.mark.parametrize("backend,params,min_recall", [
+    ("ivf", {"nlist": 20, "nprobe": 4}, 0.95),
+    ("ivfpq", {"nlist": 20, "nprobe": 4, "m": 8, "rerank": 64}, 0.9),
+])
+def test_approximate_recall(corpus, backend, params, min_recall):
+    vectors, queries = corpus
+    index = build_vector_index(backend, vectors, **params)
+    assert recall_at_k(index, vectors, queries) >= min_recall
+
+
+def test_nprobe_increases_recall(corpus):
+    vectors, queries = corpus
+    index = IVFIndex.train(vectors, nlist=40, nprobe=1)
+    assert recall_at_k(index, vectors, queries, nprobe=40) == 1.0
+    assert recall_at_k(index, vectors, queries, nprobe=1) <= recall_at_k(index, vectors, queries, nprobe=8)
+
+
+def test_ivf_add_assigns_new_vectors(corpus):
+    vectors, _ = corpus
+    index = IVFIndex.train(vectors[:1500], nlist=20)
+    index.add(vectors[1500:])
+    assert index.fits(vectors.shape)
+    found, scores = index.search(vectors, vectors[1999], 1, nprobe=20)
+    assert found[0, 0] == 1999 and scores[0, 0] == pytest.approx(1.0, abs=1e-5)
+
+
+@pytest.mark.parametrize("backend", ["ivf", "ivfpq"])
+def test_save_load_roundtrip(tmp_path, corpus, backend):
+    vectors, queries = corpus
+    prefix = index_path_prefix(str(tmp_path / "omim.npy"), backend)
+    assert prefix == str(tmp_path / f"omim.{backend}")
+    params = {"nlist": 20, "m": 8} if backend == "ivfpq" else {"nlist": 20}
+    index = build_vector_index(backend, vectors, **params)
+    index.save(prefix)
+    loaded = load_vector_index(backend, prefix, shape=vectors.shape, **params)
+    assert np.array_equal(loaded.search(vectors, queries, 5)[0], index.search(vectors, queries, 5)[0])
+
+
+def test_load_rejects_mismatched_index(tmp_path, corpus):
+    vectors, _ = corpus
+    prefix = str(tmp_path / "omim.ivfpq")
+    IVFPQIndex.train(vectors, nlist=20, m=8, nprobe=2, rerank=16).save(prefix)
+    assert load_vector_index("ivfpq", prefix, shape=(len(vectors) + 1, vectors.shape[1])) is None
+    assert load_vector_index("ivfpq", prefix, shape=vectors.shape, nlist=10) is None
+    assert load_vector_index("ivf", str(tmp_path / "missing.ivf")) is None
+    # 検索時のパラメータは保存時の値より指定した値を優先する
+    loaded = load_vector_index("ivfpq", prefix, shape=vectors.shape, nprobe=6, rerank=32)
+    assert loaded.ivf.nprobe == 6 and loaded.rerank == 32
+    assert load_vector_index("ivfpq", prefix).ivf.nprobe == 2
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        build_vector_index("hnsw", np.zeros((1, 4), dtype=np.float32))